@@ -82,3 +82,158 @@ class SELinuxContext:
             return str(self) == str(rhs)
 
         return NotImplemented
+
+# Dataflow of the permissions of allow rules, see SEPolicyInst.get_dataflow_direction
+# We consider binder:call and *:ioctl to be bi-directional
+
+# ignore fd:use for now
+# we ignore getattr as this is not security sensitive enough
+# ignore DRMservice for now (pread)
+
+# TODO: handle class key*
+# TODO: handle class security
+# TODO: handle class filesystem
+# TODO: handle class system
+READ_PERMS = [
+    'read', 'ioctl', 'unix_read', 'search',
+    'recv', 'receive', 'recv_msg',  'recvfrom', 'rawip_recv', 'tcp_recv', 'dccp_recv', 'udp_recv',
+    'nlmsg_read', 'nlmsg_readpriv',
+    # Android specific
+    'call', # binder
+    'list', # service_manager
+    'find', # service_manager
+]
+
+# ignore setattr for now. ignore create types
+WRITE_PERMS = [
+    'write', 'append',
+    #'ioctl',
+    'add_name', 'unix_write', 'enqueue',
+    'send', 'send_msg',  'sendto', 'rawip_send', 'tcp_send', 'dccp_send', 'udp_send',
+    'connectto',
+    'nlmsg_write',
+    # Android specific
+    'call', # binder
+    #'transfer', # binder
+    'set', # property_service
+    'add', # service_manager
+    'find', # service_manager - this is not necessarily a write type,
+            #but why bother finding a service if you aren't going to send a message to it?
+    'ptrace',
+    'transition',
+]
+
+# management types
+MANAGE_PERMS = [
+    'create', 'open'
+]
+
+class PolicyIndex(object):
+    """
+    Interned view of a SELinuxPolicyGraph.build_graph() policy: an integer
+    id per type and attribute, and a bit per permission of each class. Allow
+    edges carry their permissions as a bitmask (perm_mask) next to the perms
+    list, which is kept for display.
+    """
+    def __init__(self, policy):
+        # types first, aliases share the id of their type
+        self.names = [name for name in policy["types"] if name not in policy["aliases"]]
+        self.ntypes = len(self.names)
+        self.names += [name for name in policy["attributes"] if name not in policy["types"]]
+        self.ids = dict([[name, i] for i, name in enumerate(self.names)])
+
+        for alias in policy["aliases"]:
+            self.ids[alias] = self.ids[policy["types"][alias]]
+
+        # {class: {perm: bit}}, common permissions first
+        self.perm_bits = {}
+        self.perm_names = {}
+        commons = policy.get("commons", {})
+
+        for teclass, cls in policy["classes"].items():
+            self.perm_names[teclass] = []
+            self.perm_bits[teclass] = {}
+
+            for perm in commons.get(cls["parent"], []) + cls["perms"]:
+                self._add_perm(teclass, perm)
+
+        G = policy["graphs"]["allow"]
+
+        for node in G:
+            self.type_id(node)
+
+        # edges sharing a class and permission list share the mask
+        masks = {}
+
+        for _, _, edge in G.edges(data=True):
+            key = (edge["teclass"], tuple(edge["perms"]))
+            mask = masks.get(key)
+
+            if mask is None:
+                for perm in edge["perms"]:
+                    self._add_perm(edge["teclass"], perm)
+
+                mask = masks[key] = self.perm_mask(*key)
+
+            edge["perm_mask"] = mask
+
+        self.read_mask = {}
+        self.write_mask = {}
+        self.manage_mask = {}
+
+        for teclass in self.perm_bits:
+            self.read_mask[teclass] = self.perm_mask(teclass, READ_PERMS)
+            self.write_mask[teclass] = self.perm_mask(teclass, WRITE_PERMS)
+            self.manage_mask[teclass] = self.perm_mask(teclass, MANAGE_PERMS)
+
+    def _add_perm(self, teclass, perm):
+        # policies built before the commons were kept only know the
+        # common permissions from their edges
+        bits = self.perm_bits.setdefault(teclass, {})
+        names = self.perm_names.setdefault(teclass, [])
+
+        if perm not in bits:
+            bits[perm] = 1 << len(names)
+            names.append(perm)
+
+    def type_id(self, name):
+        """The id of a type, alias or attribute"""
+        i = self.ids.get(name)
+
+        if i is None:
+            i = self.ids[name] = len(self.names)
+            self.names.append(name)
+
+        return i
+
+    def perm_mask(self, teclass, perms):
+        """The mask of the permissions perms of teclass, ignoring the ones it does not have"""
+        bits = self.perm_bits.get(teclass, {})
+        mask = 0
+
+        for perm in perms:
+            mask |= bits.get(perm, 0)
+
+        return mask
+
+    def perms(self, teclass, mask):
+        """The names of the permissions of a mask, in bit order"""
+        return [perm for i, perm in enumerate(self.perm_names.get(teclass, [])) if mask & (1 << i)]
+
+    def has_perm(self, edge, *perms):
+        """True if an allow edge has any of perms"""
+        return (edge["perm_mask"] & self.perm_mask(edge["teclass"], perms)) != 0
+
+    def dataflow(self, edge):
+        """(read, write, manage) of an allow edge"""
+        teclass = edge["teclass"]
+        mask = edge["perm_mask"]
+
+        return (mask & self.read_mask.get(teclass, 0)) != 0, \
+            (mask & self.write_mask.get(teclass, 0)) != 0, \
+            (mask & self.manage_mask.get(teclass, 0)) != 0
+
+def index_policy(policy):
+    """Add the PolicyIndex of a build_graph() policy to it (policy["index"])"""
+    policy["index"] = PolicyIndex(policy)
+    return policy
@@ -1,6 +1,5 @@
 
 import os
-import re
 import sys
 import time
 import pickle
@@ -10,11 +9,18 @@ import subprocess as sp
 
 sys.path.insert(1, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
 import overlay
+from engine import cache, csr, instgraph, manifest, plserver, strength
+from engine.results import read_process
+from engine.paths import PathEngine
+from engine.reach import ReachIndex
+from engine.count import PathCount, PathCounter
+from engine.surface import AttackSurface
 
 log = logging.getLogger(__name__)
 
 QUERY_WILDCARD = "_"
 QUERY_WILDCARD_AST = "*"
+QUERY_ENGINES = ["prolog", "native"]
 
 class NodeNotFoundException(Exception):
     pass
@@ -22,35 +28,7 @@ class NodeNotFoundException(Exception):
 class MalformedResultException(Exception):
     pass
 
-def _parse_result(result):
-    if len(result) == 0:
-        return []
-
-    orig_result = result.decode()
-    lines = orig_result.split("\n")
-
-    if len(lines) < 5:
-        raise MalformedResultException("result had less than 5 lines")
-
-    result = lines[-1]
-
-    # remove all whitespace
-    result = re.sub(r'\s+', ' ', result)
-    result = re.sub(r'([a-zA-Z0-9]),([a-zA-Z0-9])', "\\1','\\2", result)
-    result = re.sub(r'\[([a-zA-Z0-9])', r'[' + r"'\1", result)
-    result = re.sub(r'([a-zA-Z0-9])\]', r'\1' + "'" + ']', result)
-
-    try:
-        res = eval(result)
-    except SyntaxError:
-        with open('bad-result', 'w') as fp:
-            fp.write(orig_result)
-        
-        raise MalformedResultException("SyntaxError on eval, bad result dumped to %s" % 
-                                            os.path.join(os.getcwd(), "bad-result"))
-    return res
-
-def exec_query(db_dir, start, end, cutoff, cap=None, source=None, mac_only=False):
+def exec_query_iter(db_dir, start, end, cutoff, cap=None, source=None, mac_only=False, limit=None):
     if type(start) != str or type(end) != str:
         raise TypeError("expected str for start and end")
 
@@ -61,39 +39,71 @@ def exec_query(db_dir, start, end, cutoff, cap=None, source=None, mac_only=False
         if cutoff <= 0: 
             raise ValueError("cutoff must be a positive integer (> 0)")
 
-    cmdline = [start, end, str(cutoff)]
+    cmdline = [plserver.node_arg(start), plserver.node_arg(end), str(cutoff)]
 
     if mac_only:
-        binary = "inst2"
+        level = 2
     else:
-        binary = "inst3"
+        level = 3
         if cap:
             cmdline += [cap]
             log.debug("Cap %s", cap)
-            binary = "inst4"
+            level = 4
 
         if source:
             cmdline += [source]
             log.debug("External Source %s", source)
-            binary = "inst5"
+            level = 5
+
+    if limit:
+        # shortest paths first, stopping after limit paths
+        cmdline += [str(limit)]
+        log.debug("Limit %d", limit)
+
+    binary = "inst%d" % level
+
+    server = plserver.get_server(db_dir)
+    if server:
+        log.debug("querying server with '%s' args : %s", binary, cmdline)
+        stime = time.time()
+
+        try:
+            reader = server.query(level, start, end, cutoff, cap, source, limit=limit)
+            # nothing has been handed out until the first path, so the
+            # binary can still take over if the server fails immediately
+            paths = iter(reader)
+            first = next(paths, None)
+        except (plserver.PrologServerError, ValueError) as e:
+            log.warning("Query server unavailable, falling back to %s: %s", binary, e)
+        else:
+            if first is not None:
+                yield first
+
+            for path in paths:
+                yield path
+
+            _check_result(reader, stime)
+            return
 
     log.debug("executing '%s' args : %s", binary, cmdline)
     binary_path = os.path.join(db_dir, binary)
-    proc = sp.Popen([binary_path] + cmdline, stdout=sp.PIPE)
-
+    reader = read_process([binary_path] + cmdline)
     stime = time.time()
-    try:
-        stdout, stderr = proc.communicate()
-    except KeyboardInterrupt as e:
-        proc.kill()
-        raise e
 
-    etime = time.time()
+    for path in reader:
+        yield path
+
+    _check_result(reader, stime)
 
-    result = _parse_result(stdout)
-    log.debug("Got %d paths in %.2f seconds", len(result), etime-stime)
+def _check_result(reader, stime):
+    if not reader.complete():
+        raise MalformedResultException("result ended after %d paths (expected %s)" % (
+            reader.paths_read, reader.count))
 
-    return result
+    log.debug("Got %d paths in %.2f seconds", reader.paths_read, time.time()-stime)
+
+def exec_query(db_dir, start, end, cutoff, *args, **kwargs):
+    return list(exec_query_iter(db_dir, start, end, cutoff, *args, **kwargs))
 
 class Image:
 
@@ -121,26 +131,50 @@ class Image:
         self.node_objs = None
         self.node_id_map = None
         self.node_id_map_inv = None
+        self.path_engine = None
+        self.reach_index = None
+        self.query_cache = cache.QueryCache(self.db_path, os.path.join(self.db_path, "facts.pl"))
         if instantiate:
             self.instantiate()
     
-    def generate_db_files(self):
-        # Delete previously generated inst files
-        do_not_delete = {"policy_files.db", "filesystems.db"}
-        files_in_db = os.listdir(self.db_path)
-        for f in files_in_db:
-            if f in do_not_delete:
-                continue
+    def status(self):
+        """{generated db file: why it is stale, or None if it is current}"""
+        return manifest.DbManifest(self.db_path).status()
+
+    def generate_db_files(self, force=False):
+        """
+        Regenerate the stale db files (see status()), or all of them with
+        force. Only the Prolog files are rebuilt if db/inst is current.
+        Returns True if anything was regenerated.
+        """
+        stale = manifest.DbManifest(self.db_path).stale_stages()
+
+        if not force and not stale:
+            log.info("Generated files of %s are current", self.db_path)
+            return False
 
-            path = os.path.join(self.db_path, f)
-            if os.path.isfile(path):
-                os.remove(path)
-
-        # Generate new ones
         bigmac_dir = os.path.normpath(os.path.join(os.path.dirname(os.path.realpath(__file__)), os.pardir)) # ./cross_image_diff/..
         process_path = os.path.join(bigmac_dir, "process.py")
 
-        process_args = [process_path, "--vendor", self.vendor, self.name, "--save", "--compile-prolog"]
+        if force or "inst" in stale:
+            log.info("Regenerating all files of %s: %s", self.db_path, stale.get("inst", "forced"))
+
+            # Delete previously generated inst files
+            do_not_delete = {"policy_files.db", "filesystems.db"}
+            files_in_db = os.listdir(self.db_path)
+            for f in files_in_db:
+                if f in do_not_delete:
+                    continue
+
+                path = os.path.join(self.db_path, f)
+                if os.path.isfile(path):
+                    os.remove(path)
+
+            process_args = [process_path, "--vendor", self.vendor, self.name, "--save", "--compile-prolog"]
+        else:
+            log.info("Regenerating the Prolog files of %s: %s", self.db_path, stale["prolog"])
+            process_args = [process_path, "--vendor", self.vendor, self.name, "--load", "--compile-prolog"]
+
         log.info(process_args)
         sp.run(process_args, cwd=bigmac_dir, stdout=sp.DEVNULL, stderr=sp.DEVNULL)
 
@@ -149,6 +183,8 @@ class Image:
         if not is_generated:
             raise Exception("Failed to generate inst and prolog files!")
 
+        return True
+
     def check_generated_files(self):
         should_exist = {"inst", "inst2", "inst3", "inst4", "inst5", "inst-map", "facts.pl"}
         files_in_db = os.listdir(self.db_path)
@@ -156,8 +192,13 @@ class Image:
 
         return len(missing_files) == 0
 
-    def instantiate(self):
-        self.generate_db_files()
+    def instantiate(self, force=False):
+        if self.generate_db_files(force=force):
+            # load the new db/inst along with its graph
+            self.inst = None
+            self.path_engine = None
+            self.reach_index = None
+
         self.node_objs = self.load_node_objs(self.inst)
         self.node_id_map = self.load_node_map()
         self.node_id_map_inv = dict([[v,k] for k,v in self.node_id_map.items()])
@@ -227,7 +268,8 @@ class Image:
         return inst
 
     def load_node_objs(self, inst):
-        G = inst.fully_instantiate()
+        # the saved graph comes with the instance its objects refer to
+        self.inst, G = instgraph.load(self.db_path, inst)
         return nx.get_node_attributes(G, 'obj')
 
     def load_node_map(self):
@@ -237,6 +279,54 @@ class Image:
 
         return node_id_map
 
+    def get_path_engine(self):
+        if self.path_engine is None:
+            facts_path = os.path.join(self.db_path, "facts.pl")
+            self.path_engine = PathEngine(csr.load_graph(facts_path))
+
+        return self.path_engine
+
+    def get_reach_index(self):
+        if self.reach_index is None:
+            self.reach_index = ReachIndex(self.get_path_engine().graph)
+
+        return self.reach_index
+
+    def reachable(self, start, end, max_hops=None):
+        """Whether node start can influence end (within max_hops edges), under DAC"""
+        return self.get_reach_index().reachable(self.node_id_map[start], self.node_id_map[end], max_hops)
+
+    def distance(self, start, end):
+        """Number of edges of the shortest DAC path from start to end, or None"""
+        return self.get_reach_index().distance(self.node_id_map[start], self.node_id_map[end])
+
+    def reachable_set(self, node, max_hops=None, reverse=False):
+        """
+        Names of the nodes that node can influence (or, with reverse, that
+        can influence node) within max_hops edges, under DAC
+        """
+        reached = self.get_reach_index().reachable_set(self.node_id_map[node], max_hops, reverse)
+        return [self.node_id_map_inv[plnode] for plnode in reached]
+
+    def count_paths(self, start, end, cutoff, *args, mac_only=False):
+        """
+        Count the paths of a query without materializing them. Returns a
+        PathCount whose per_end/per_node counts are keyed by node name;
+        they are upper bounds when the result is not exact (and then the
+        per_node bounds ignore CAP).
+        """
+        WILDCARDS = [QUERY_WILDCARD, QUERY_WILDCARD_AST]
+
+        plstart = start if start in WILDCARDS else self.node_id_map[start]
+        plend = end if end in WILDCARDS else self.node_id_map[end]
+
+        result = PathCounter(self.get_path_engine().graph).count(plstart, plend, cutoff, *args, mac_only=mac_only)
+
+        def rename(counts):
+            return dict([[self.node_id_map_inv[k], v] for k, v in counts.items()])
+
+        return PathCount(result.total, result.exact, rename(result.per_end), rename(result.per_node))
+
     def get_obj_by_id(self, obj_id):
         return self.node_objs[self.node_id_map_inv[obj_id]]
 
@@ -291,7 +381,7 @@ class Image:
                 yield node_name
 
 
-    def query(self, start, end, cutoff, *args, mac_only=False):
+    def _query_ids(self, start, end, cutoff, *args, mac_only=False, engine="prolog", limit=None, max_length=None):
         WILDCARDS = [QUERY_WILDCARD, QUERY_WILDCARD_AST]
 
         if start in WILDCARDS:
@@ -304,13 +394,80 @@ class Image:
         else:
             plend = self.node_id_map[end]
 
+        if max_length is not None:
+            cutoff = min(cutoff, max_length)
+
         log.debug("Query <%s> -> <%s> (cutoff %s)", start, end, cutoff)
 
-        result = exec_query(self.db_path, plstart, plend, cutoff, *args, mac_only=mac_only)
+        if engine == "native":
+            return self.get_path_engine().query(plstart, plend, cutoff, *args, mac_only=mac_only, limit=limit)
+        elif engine == "prolog":
+            return exec_query_iter(self.db_path, plstart, plend, cutoff, *args, mac_only=mac_only, limit=limit)
+        else:
+            raise ValueError("unknown query engine '%s', expected one of %s" % (engine, QUERY_ENGINES))
+
+    def iter_query(self, start, end, cutoff, *args, mac_only=False, engine="prolog", limit=None, max_length=None):
+        """
+        Yield the paths of a query (as lists of node objects) while they are
+        being found, in no particular order. Stop iterating to end the query
+        early. With a limit, paths come in order of length and at most limit
+        paths are found. max_length lowers the cutoff.
+        """
+        for path in self._query_ids(start, end, cutoff, *args, mac_only=mac_only, engine=engine,
+                limit=limit, max_length=max_length):
+            for path_objs in self.retrieve_objs_in_query_result([path]):
+                yield path_objs
+
+    def query(self, start, end, cutoff, *args, mac_only=False, engine="prolog", limit=None, max_length=None,
+            use_cache=True):
+        cache_key = None
+        result = None
+
+        if use_cache:
+            cache_key = self._query_cache_key(start, end, cutoff, args, mac_only=mac_only, engine=engine,
+                    limit=limit, max_length=max_length)
+
+            if cache_key is not None:
+                result = self.query_cache.get(cache_key)
+
+        if result is None:
+            result = list(self._query_ids(start, end, cutoff, *args, mac_only=mac_only, engine=engine,
+                limit=limit, max_length=max_length))
+
+            if cache_key is not None:
+                self.query_cache.put(cache_key, result)
+
         # show the shortest (easiest) paths first
-        result = sorted(result, key=lambda x: len(x))
+        result = sorted(result, key=lambda x: (len(x), x))
         return self.retrieve_objs_in_query_result(result)
 
+    def _query_cache_key(self, start, end, cutoff, args, mac_only=False, engine="prolog", limit=None, max_length=None):
+        WILDCARDS = [QUERY_WILDCARD, QUERY_WILDCARD_AST]
+        plstart = start if start in WILDCARDS else self.node_id_map[start]
+        plend = end if end in WILDCARDS else self.node_id_map[end]
+        cap = args[0] if len(args) > 0 else None
+        source = args[1] if len(args) > 1 else None
+
+        if max_length is not None:
+            cutoff = min(cutoff, max_length)
+
+        if mac_only:
+            level = 2
+            cap = source = None
+        elif source:
+            level = 5
+        elif cap:
+            level = 4
+        else:
+            level = 3
+
+        try:
+            return self.query_cache.make_query_key(engine, level,
+                plstart, plend, cutoff, cap, source, limit)
+        except (IOError, OSError) as e:
+            log.warning("Query cache unavailable: %s", e)
+            return None
+
     def load_query(self, filename):
         saved_queries_path = os.path.join(self.db_path, "saved_queries", filename)
         with open(saved_queries_path, 'rb') as fp:
@@ -319,9 +476,25 @@ class Image:
         return self.retrieve_objs_in_query_result(paths)
 
     def query_attack_surface(self, target):
-        all_writing_paths = self.query(QUERY_WILDCARD, target, 2)
-        writable_writing_paths = [path for path in all_writing_paths if len(path) == 3]
+        return self.query_attack_surfaces([target])[target]
+
+    def query_attack_surfaces(self, targets):
+        """
+        The writer -> object -> target paths and their summary for each
+        target, as {target: (paths, summary)}. The predecessor index is
+        built once and shared by all targets.
+        """
+        pltargets = [self.node_id_map[target] for target in targets]
+        surfaces = AttackSurface(self.get_path_engine().graph).paths_many(pltargets)
+
+        results = {}
+        for target, pltarget in zip(targets, pltargets):
+            paths = self.retrieve_objs_in_query_result(surfaces[pltarget])
+            results[target] = (paths, self._attack_surface_summary(paths))
+
+        return results
 
+    def _attack_surface_summary(self, writable_writing_paths):
         uniq_procs = set()
         uniq_ipc = set()
         uniq_types = set()
@@ -350,55 +523,13 @@ class Image:
                     "procs": len(uniq_procs),
                 }
 
-        return writable_writing_paths, summary
+        return summary
 
     def query_all_proc_strengths(self, sort_by):
-        results = {}
         sort_by = Image.strength[sort_by.upper()]
-        type_freq = {}
-        # frequency of occurence of an object type
-        # might be interesting to use this as an indicator of strength
-        # then sort objects by the combined strength of the types it has access to
-        # intuitively types with less objects that can access them are stronger...
-        intermediate_results = {}
-        for pn, p in self.inst.processes.items():
-            name = p.get_node_name()
-            try:
-                result = self.query(name, QUERY_WILDCARD, 1)
-            except KeyError as e:
-                log.warning("could not find %s in node_id_map" % str(e))
-                continue
+        # all processes in one pass, processes reaching nothing are kept with zeros
+        results = strength.process_strengths(self.get_path_engine().graph,
+                self.inst.processes.values(), self.node_id_map, self.node_objs,
+                include_empty=True)
 
-            uniq_types = set()
-            obj_types = {"ipc": [], "file": []}
-
-            for path in result:
-                obj = path[1]
-                if obj.sid.type not in uniq_types:
-                    uniq_types.add(obj.sid.type)
-                    
-                    type_freq[obj.sid.type] = type_freq.get(obj.sid.type, 0)
-                    if not (isinstance(obj, overlay.IPCNode) and obj.owner == p):
-                        type_freq[obj.sid.type] += 1
-
-                if isinstance(obj, overlay.IPCNode):
-                    obj_types["ipc"].append(obj)
-
-                elif isinstance(obj, overlay.FileNode):
-                    obj_types["file"].append(obj)
-
-            intermediate_results[name] = [uniq_types, len(result), obj_types["ipc"],
-                    obj_types["file"]]
-
-        for node_name, res in intermediate_results.items():
-            uniq_types = res[0]
-            n_uniq_type = len(uniq_types)
-            n_obj = res[1]
-            n_ipc = len(res[2])
-            n_file = len(res[3])
-            type_strength = sum(1 / type_freq[t] for t in uniq_types if type_freq[t] != 0)
-
-            results[node_name] = [n_uniq_type, n_obj, n_ipc, n_file, type_strength]
-        
-        results = sorted(list(results.items()), key=lambda x: (x[1][sort_by], x[1][1]), reverse=True)
-        return results
\ No newline at end of file
+        return strength.rank_strengths(results, sort_by)
\ No newline at end of file
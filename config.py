@@ -1,4 +1,6 @@
 POLICY_RESULTS_DIR = "policy/"
 AT_EXTRACT_PATH = './tools/android-extract.sh'
 
-
+# build_graph() results shared by every image, keyed by the sepolicy hash
+POLICY_GRAPH_CACHE_DIR = "policy-cache/"
+POLICY_GRAPH_CACHE_MAX_BYTES = 512*1024*1024
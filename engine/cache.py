@@ -0,0 +1,264 @@
+"""
+Persistent query result cache, one per db directory (db/query-cache).
+
+Every entry is a pickle file named after the SHA-256 of its key. The key
+starts with the SHA-256 of the facts the result was computed from, so
+results of older facts are never served and are dropped as soon as the
+facts change. It then stamps the engine that computed the result: the
+hash of its code and, for the Prolog engine, the size and modification
+time of the compiled query binaries, so recompiling them or changing the
+engines never serves a stale result. The cache is bounded in size and evicts the least recently
+used entries, using the file modification time as the access time.
+"""
+import os
+import glob
+import pickle
+import hashlib
+import logging
+
+from engine.plserver import SERVER_BINARY
+
+log = logging.getLogger(__name__)
+
+CACHE_DIR = "query-cache"
+FACTS_HASH_FILE = "facts-sha256"
+ENTRY_SUFFIX = ".pickle"
+# the hash of facts.pl is stored in facts.pl.sha256
+FACTS_HASH_SUFFIX = ".sha256"
+DEFAULT_MAX_BYTES = 256*1024*1024
+
+ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), os.pardir))
+
+# sources (globs relative to the repository) the results of each engine depend on
+ENGINE_CODE = {
+    "prolog": ["logic/*.pl"],
+    "native": ["engine/*.py"],
+}
+
+# the code doesn't change under a running process, so it is only hashed once
+_code_hashes = {}
+
+def file_sha256(path):
+    h = hashlib.sha256()
+
+    with open(path, 'rb') as fp:
+        for chunk in iter(lambda: fp.read(1024*1024), b""):
+            h.update(chunk)
+
+    return h.hexdigest()
+
+def stored_facts_hash(facts_path):
+    """
+    SHA-256 of a facts file, from the hash stored next to it when the
+    facts were emitted, or None if there are no facts
+    """
+    try:
+        with open(facts_path + FACTS_HASH_SUFFIX, 'r') as fp:
+            return fp.read().strip()
+    except IOError:
+        pass
+
+    # facts from before the hash was stored
+    try:
+        return file_sha256(facts_path)
+    except IOError:
+        return None
+
+def code_hash(patterns):
+    """Combined SHA-256 of the sources matching patterns"""
+    hashes = []
+
+    for pattern in patterns:
+        for path in sorted(glob.glob(os.path.join(ROOT, pattern))):
+            hashes += ["%s %s" % (os.path.relpath(path, ROOT), file_sha256(path))]
+
+    return hashlib.sha256("\n".join(hashes).encode()).hexdigest()
+
+def engine_code_hash(engine):
+    if engine not in _code_hashes:
+        _code_hashes[engine] = code_hash(ENGINE_CODE.get(engine, []))
+
+    return _code_hashes[engine]
+
+class QueryCache(object):
+    def __init__(self, db_dir, facts_path, max_bytes=DEFAULT_MAX_BYTES):
+        self.db_dir = db_dir
+        self.cache_dir = os.path.join(db_dir, CACHE_DIR)
+        self.facts_path = facts_path
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+
+        # (mtime, size) -> sha256 of the facts, to only hash them once
+        self._facts_stat = None
+        self._facts_hash = None
+
+    def facts_hash(self):
+        st = os.stat(self.facts_path)
+        facts_stat = (st.st_mtime, st.st_size)
+
+        if facts_stat != self._facts_stat:
+            self._facts_hash = file_sha256(self.facts_path)
+            self._facts_stat = facts_stat
+
+        return self._facts_hash
+
+    def _check_facts(self):
+        """Drop every entry if the facts changed since they were cached"""
+        facts_hash = self.facts_hash()
+        hash_path = os.path.join(self.cache_dir, FACTS_HASH_FILE)
+
+        try:
+            with open(hash_path, 'r') as fp:
+                cached_hash = fp.read().strip()
+        except IOError:
+            cached_hash = None
+
+        if cached_hash != facts_hash:
+            if cached_hash is not None:
+                log.info("Facts changed, clearing the query cache")
+
+            self.clear()
+
+            with open(hash_path, 'w') as fp:
+                fp.write(facts_hash)
+
+        return facts_hash
+
+    def _entry_path(self, key):
+        name = hashlib.sha256(repr(key).encode()).hexdigest()
+        return os.path.join(self.cache_dir, name + ENTRY_SUFFIX)
+
+    def make_key(self, *args):
+        """The facts hash followed by the query arguments"""
+        return (self._check_facts(),) + tuple(args)
+
+    def engine_stamp(self, engine, level):
+        """
+        The hash of the code of engine and, for the Prolog engine, the
+        (mtime, size) of the binaries answering level queries
+        """
+        stamp = [engine_code_hash(engine)]
+
+        if engine != "native":
+            for name in ["inst%d" % level, SERVER_BINARY]:
+                try:
+                    st = os.stat(os.path.join(self.db_dir, name))
+                    stamp += [(name, st.st_mtime, st.st_size)]
+                except OSError:
+                    stamp += [(name, None)]
+
+        return tuple(stamp)
+
+    def make_query_key(self, engine, level, *args, **kwargs):
+        """The key of a query, see query_key()"""
+        return self.make_key(self.engine_stamp(engine, level),
+                *query_key(engine, level, *args, **kwargs))
+
+    def get(self, key):
+        path = self._entry_path(key)
+
+        try:
+            with open(path, 'rb') as fp:
+                stored_key, value = pickle.load(fp)
+        except (IOError, EOFError, pickle.UnpicklingError):
+            self.misses += 1
+            return None
+
+        if stored_key != key:
+            self.misses += 1
+            return None
+
+        # mark as recently used
+        try:
+            os.utime(path, None)
+        except OSError:
+            pass
+
+        self.hits += 1
+        return value
+
+    def put(self, key, value):
+        path = self._entry_path(key)
+        tmp_path = path + ".tmp"
+
+        try:
+            with open(tmp_path, 'wb') as fp:
+                pickle.dump((key, value), fp, protocol=pickle.HIGHEST_PROTOCOL)
+
+            os.rename(tmp_path, path)
+        except IOError as e:
+            log.warning("Failed to cache query result: %s", e)
+            return
+
+        self.evict()
+
+    def entries(self):
+        """(mtime, size, path) of every entry"""
+        entries = []
+
+        for name in os.listdir(self.cache_dir):
+            if not name.endswith(ENTRY_SUFFIX):
+                continue
+
+            path = os.path.join(self.cache_dir, name)
+
+            try:
+                st = os.stat(path)
+            except OSError:
+                continue
+
+            entries += [(st.st_mtime, st.st_size, path)]
+
+        return entries
+
+    def evict(self):
+        entries = sorted(self.entries())
+        total = sum([size for _, size, _ in entries])
+
+        # least recently used first
+        for _, size, path in entries:
+            if total <= self.max_bytes:
+                break
+
+            try:
+                os.unlink(path)
+            except OSError:
+                continue
+
+            total -= size
+
+    def clear(self):
+        if not os.path.isdir(self.cache_dir):
+            os.makedirs(self.cache_dir)
+            return
+
+        for name in os.listdir(self.cache_dir):
+            try:
+                os.unlink(os.path.join(self.cache_dir, name))
+            except OSError:
+                pass
+
+    def stats(self):
+        entries = self.entries() if os.path.isdir(self.cache_dir) else []
+
+        return {"entries": len(entries),
+                "bytes": sum([size for _, size, _ in entries]),
+                "max_bytes": self.max_bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                }
+
+def query_key(engine, level, start, end, cutoff, cap=None, source=None, limit=None):
+    """
+    The query part of a cache key, shared by the query> shell and the api
+    so that both can serve each other's results
+    """
+    def opt(value):
+        return None if value is None else str(value)
+
+    def node(value):
+        # every engine reads both wildcards the same way
+        return "_" if value in ["_", "*"] else str(value)
+
+    return (engine, "inst%d" % level, node(start), node(end), str(cutoff), opt(cap), opt(source), limit)
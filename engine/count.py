@@ -0,0 +1,175 @@
+"""
+Path counts without materializing the paths, for reports that only need
+how many paths reach each node and which nodes they pass through.
+
+Counting simple paths is hard in general, so the counter works in two
+steps. It first bounds the number of paths of up to cutoff edges by
+counting non-backtracking walks: walks that never take an edge straight
+back (u -> v -> u), never loop on a node, never pass through the end or
+come back to the start. This is dynamic programming over the CSR edges,
+linear in the number of edges per hop. Every simple path is such a walk,
+so this is an upper bound. It is exact for paths of up to two edges and
+only overcounts walks that revisit a node three or more edges later (such
+as u -> v -> w -> u). If the bound is small enough for the paths to be
+enumerated, the exact counts are then computed with the native path
+engine, without keeping the paths. Otherwise the bounds are returned,
+flagged as inexact.
+
+The bounds are computed in floating point and saturate at MAX_COUNT, below
+which they are exact integers. A bound of MAX_COUNT means at least that
+many walks.
+"""
+import logging
+import numpy as np
+from collections import namedtuple
+
+from engine.paths import PathEngine
+
+log = logging.getLogger(__name__)
+
+# largest number of paths counted one by one
+DEFAULT_MAX_PATHS = 2000000
+# largest bound, every integer up to it is exact in a float64
+MAX_COUNT = 2**53
+
+# per_end: paths ending at each node, per_node: paths passing through each
+# node (not counting start and end), both {Prolog id: count}. Inexact
+# per_node bounds do not account for CAP.
+PathCount = namedtuple('PathCount', ['total', 'exact', 'per_end', 'per_node'])
+
+class PathCounter(PathEngine):
+    def count(self, start, end, cutoff, cap=None, source=None, mac_only=False,
+            max_paths=DEFAULT_MAX_PATHS):
+        """
+        Count the paths of a query (same arguments as PathEngine.query).
+        The counts are exact if the result says so, upper bounds otherwise.
+        """
+        level, start, end, cap, source = self._parse_args(start, end, cap, source, mac_only)
+        cutoff = int(cutoff)
+
+        bound = self._walk_counts(level, start, end, cutoff, cap, source)
+
+        if bound.total > max_paths:
+            log.info("Up to %d paths, too many to count exactly", bound.total)
+            return bound
+
+        return self._path_counts(level, start, end, cutoff, cap, source)
+
+    def _path_counts(self, level, start, end, cutoff, cap, source):
+        names = self.graph.names
+        per_end = {}
+        per_node = {}
+        total = 0
+
+        for path in self.iter_paths(level, start, end, cutoff, cap, source):
+            total += 1
+            per_end[names[path[-1]]] = per_end.get(names[path[-1]], 0) + 1
+
+            for x in path[1:-1]:
+                per_node[names[x]] = per_node.get(names[x], 0) + 1
+
+        return PathCount(total, True, per_end, per_node)
+
+    def _walk_counts(self, level, start, end, cutoff, cap, source):
+        G = self.graph
+        n = len(G)
+        max_edges = max(cutoff, 1)
+
+        src = G.edge_sources()
+        dst = G.fwd_idx
+
+        if level >= 3:
+            mask = G.dac_mask()
+            src, dst = src[mask], dst[mask]
+
+        # no simple path repeats a node right away, passes through its end
+        # or comes back to its start
+        keep = src != dst
+        if end is not None:
+            keep &= src != end
+        if start is not None:
+            keep &= dst != start
+
+        src, dst = src[keep], dst[keep]
+
+        # the edges back: walks over rev_pos[e] are the ones that would
+        # backtrack over e, if has_rev[e] (parallel edges add up)
+        keys = src * n + dst
+        pairs, pair_of = np.unique(keys, return_inverse=True)
+        rev_pos = np.minimum(np.searchsorted(pairs, dst * n + src), max(len(pairs)-1, 0))
+        has_rev = pairs[rev_pos] == dst * n + src if len(pairs) else np.zeros(0, dtype=bool)
+
+        def backtracks(walks):
+            """Walks over the edge back of each edge"""
+            per_pair = np.bincount(pair_of, weights=walks, minlength=len(pairs))
+            return np.where(has_rev, per_pair[rev_pos], 0)
+
+        def step(node_walks, at, walks):
+            """
+            Extend walks over edges onto the edges leaving node at[e]
+            without backtracking. Saturated sums stay saturated, so the
+            subtraction never lowers a bound below the true count.
+            """
+            total = node_walks[at]
+            return np.where(total >= MAX_COUNT, MAX_COUNT,
+                    np.minimum(total - backtracks(walks), MAX_COUNT))
+
+        starts = np.zeros(n)
+        if start is None:
+            starts[:] = 1
+        else:
+            starts[start] = 1
+
+        if level >= 5:
+            starts *= [G.has_tag(i, source) for i in range(n)]
+
+        ends = np.ones(n)
+        if end is not None:
+            ends[:] = 0
+            ends[end] = 1
+
+        # CAP only looks at the last edge: its source or target has the cap
+        last_ok = None
+        if level >= 4:
+            has_cap = np.asarray([G.has_cap(i, cap) for i in range(n)])
+            last_ok = has_cap[src] | has_cap[dst]
+
+        # fwd[e]: walks of l edges from a start ending with edge e, bwd[e]:
+        # walks of l edges starting with edge e to an end. fwd_in[l] and
+        # bwd_out[l] are their sums per node, into and out of it.
+        fwd = starts[src]
+        bwd = ends[dst]
+        fwd_in = [None]
+        bwd_out = [None]
+        per_end = np.zeros(n)
+
+        for l in range(1, max_edges+1):
+            if l > 1:
+                fwd = step(fwd_in[-1], src, fwd)
+                bwd = step(bwd_out[-1], dst, bwd)
+
+            fwd_in += [np.minimum(np.bincount(dst, weights=fwd, minlength=n), MAX_COUNT)]
+            bwd_out += [np.minimum(np.bincount(src, weights=bwd, minlength=n), MAX_COUNT)]
+
+            weights = fwd if last_ok is None else fwd * last_ok
+            per_end += np.bincount(dst, weights=weights, minlength=n) * ends
+            np.minimum(per_end, MAX_COUNT, out=per_end)
+
+        # joining walks at a node may still backtrack over it, which keeps
+        # per_node looser than per_end
+        per_node = np.zeros(n)
+        for a in range(1, max_edges):
+            after = np.minimum(sum(bwd_out[1:max_edges-a+1]), MAX_COUNT)
+            per_node += fwd_in[a] * after
+            np.minimum(per_node, MAX_COUNT, out=per_node)
+
+        names = G.names
+        total = int(min(per_end.sum(), MAX_COUNT))
+
+        return PathCount(total, False,
+                dict([[names[i], int(per_end[i])] for i in np.flatnonzero(per_end)]),
+                dict([[names[i], int(per_node[i])] for i in np.flatnonzero(per_node)]))
+
+def top_counts(counts, n):
+    """The n (Prolog id, count) pairs with the highest counts"""
+    return sorted(counts.items(), key=lambda x: (-x[1], x[0]))[:n]
@@ -0,0 +1,164 @@
+"""
+Memory-mappable export of the emitted graph (db/facts.csr), so it can be
+opened for analysis without parsing facts.pl or instantiating the policy
+again.
+
+The file is a small JSON header followed by the arrays of a FactGraph:
+
+    SEACSR1\\n            magic
+    <u8>                 length of the header
+    {...}                header: version, hash of the facts, array layout
+    arrays               each 64-byte aligned, in native byte order
+
+The arrays are the node kind, DAC fields (uid, gid, perms, groups), the
+capability and tag bits, the DAC mask of the edges and the CSR forward and
+backward adjacency. Loading maps the file once and views the arrays in
+place, without copying them.
+"""
+import os
+import json
+import struct
+import logging
+import numpy as np
+
+from engine import cache
+from engine.graph import FactGraph, ARRAY_FIELDS
+
+log = logging.getLogger(__name__)
+
+CSR_OUTPUT_FILE = "facts.csr"
+MAGIC = b"SEACSR1\n"
+VERSION = 1
+ALIGN = 64
+
+class CsrFormatError(Exception):
+    pass
+
+def _strings_to_arrays(strings):
+    """Variable length strings as (offsets, utf-8 bytes)"""
+    encoded = [("" if s is None else s).encode() for s in strings]
+    ptr = np.zeros(len(encoded)+1, dtype=np.int64)
+    np.cumsum([len(b) for b in encoded], out=ptr[1:])
+
+    return ptr, np.frombuffer(b"".join(encoded), dtype=np.uint8)
+
+def _arrays_to_strings(ptr, blob):
+    data = blob.tobytes()
+    ptr = ptr.tolist()
+
+    return [data[ptr[i]:ptr[i+1]].decode() for i in range(len(ptr)-1)]
+
+def save_csr(graph, path, facts_hash=None):
+    """Write graph to path (atomically). facts_hash ties it to its facts."""
+    arrays = [(field, getattr(graph, field)) for field in ARRAY_FIELDS]
+
+    names_ptr, names_blob = _strings_to_arrays(graph.names)
+    arrays += [("names_ptr", names_ptr), ("names", names_blob)]
+
+    if graph.labels is not None:
+        labels_ptr, labels_blob = _strings_to_arrays(graph.labels)
+        arrays += [("labels_ptr", labels_ptr), ("labels", labels_blob)]
+
+    arrays += [("dac_mask", graph.dac_mask().astype(np.uint8))]
+    arrays = [(name, np.ascontiguousarray(a)) for name, a in arrays]
+
+    # offsets are relative to the data, which starts at the first aligned
+    # position after the header
+    layout = {}
+    offset = 0
+
+    for name, a in arrays:
+        layout[name] = {"dtype": a.dtype.str, "shape": list(a.shape), "offset": offset}
+        offset += (a.nbytes + ALIGN - 1) // ALIGN * ALIGN
+
+    header = {"version": VERSION,
+            "facts_sha256": facts_hash,
+            "nodes": len(graph),
+            "edges": graph.num_edges(),
+            "arrays": layout}
+
+    header_bytes = json.dumps(header, sort_keys=True).encode()
+    data_start = (len(MAGIC) + 8 + len(header_bytes) + ALIGN - 1) // ALIGN * ALIGN
+    tmp_path = path + ".tmp"
+
+    with open(tmp_path, 'wb') as fp:
+        fp.write(MAGIC)
+        fp.write(struct.pack("<Q", len(header_bytes)))
+        fp.write(header_bytes)
+        fp.write(b"\0" * (data_start - fp.tell()))
+
+        for name, a in arrays:
+            fp.write(b"\0" * (data_start + layout[name]["offset"] - fp.tell()))
+            a.tofile(fp)
+
+    os.replace(tmp_path, path)
+
+    log.info("Saved %d nodes and %d edges to %s", len(graph), graph.num_edges(), path)
+
+def read_header(path):
+    with open(path, 'rb') as fp:
+        if fp.read(len(MAGIC)) != MAGIC:
+            raise CsrFormatError("%s is not a CSR graph file" % path)
+
+        try:
+            header_len, = struct.unpack("<Q", fp.read(8))
+            header = json.loads(fp.read(header_len).decode())
+        except (struct.error, ValueError) as e:
+            raise CsrFormatError("%s has a corrupt header: %s" % (path, e))
+
+    if header.get("version") != VERSION:
+        raise CsrFormatError("%s has version %s, expected %d" % (path, header.get("version"), VERSION))
+
+    header["data_start"] = (len(MAGIC) + 8 + header_len + ALIGN - 1) // ALIGN * ALIGN
+
+    return header
+
+def load_csr(path):
+    """Map path and return (FactGraph, header). The arrays are read-only."""
+    header = read_header(path)
+    data = np.memmap(path, dtype=np.uint8, mode='r')
+    arrays = {}
+
+    for name, info in header["arrays"].items():
+        dtype = np.dtype(info["dtype"])
+        start = header["data_start"] + info["offset"]
+        count = int(np.prod(info["shape"], dtype=np.int64))
+
+        if start + count*dtype.itemsize > len(data):
+            raise CsrFormatError("%s is truncated" % path)
+
+        arrays[name] = data[start:start+count*dtype.itemsize].view(dtype).reshape(info["shape"])
+
+    names = _arrays_to_strings(arrays["names_ptr"], arrays["names"])
+    labels = None
+
+    if "labels" in arrays:
+        labels = _arrays_to_strings(arrays["labels_ptr"], arrays["labels"])
+
+    graph = FactGraph.from_arrays(names, arrays, labels=labels,
+            dac_mask=arrays["dac_mask"].view(bool))
+
+    return graph, header
+
+def csr_path(facts_path):
+    return os.path.join(os.path.dirname(facts_path), CSR_OUTPUT_FILE)
+
+def load_graph(facts_path):
+    """
+    The FactGraph of facts_path, from the facts.csr next to it when it is
+    up to date, otherwise parsed from the facts
+    """
+    path = csr_path(facts_path)
+
+    if os.path.isfile(path):
+        try:
+            graph, header = load_csr(path)
+
+            if header["facts_sha256"] == cache.stored_facts_hash(facts_path):
+                return graph
+
+            log.info("%s is out of date, loading %s instead", path, facts_path)
+        except (CsrFormatError, IOError, ValueError) as e:
+            log.warning("Failed to load %s: %s", path, e)
+
+    return FactGraph.from_facts(facts_path)
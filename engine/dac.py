@@ -0,0 +1,55 @@
+"""
+Python mirror of the DAC rules in logic/sea_impl.pl (dac/2). Nodes are
+described with DacNode so the same checks can be run on emitted facts and
+on the records that are about to be emitted.
+"""
+from collections import namedtuple
+
+SUBJECT = 0
+OBJECT = 1
+
+# sub -> obj: group_sub_obj_allow/2 and other_sub_obj_allow/2
+SUB_OBJ_PERMS = frozenset([4, 6, 7, 3])
+# obj -> sub: group_obj_sub_allow/2 and other_obj_sub_allow/2
+OBJ_SUB_PERMS = frozenset([4, 5, 6, 7])
+
+# groups is only meaningful for subjects, gid and perms only for objects
+DacNode = namedtuple('DacNode', ['kind', 'uid', 'gid', 'uperm', 'gperm', 'operm', 'groups'])
+
+def is_root(node):
+    return node.kind == SUBJECT and node.uid == 0 and 0 in node.groups
+
+def dac_sub_obj(a, b):
+    if a.kind != SUBJECT:
+        return False
+
+    if is_root(a):
+        return True
+
+    if b.kind != OBJECT:
+        return False
+
+    return a.uid == b.uid or \
+            (b.gid in a.groups and b.gperm in SUB_OBJ_PERMS) or \
+            b.operm in SUB_OBJ_PERMS
+
+def dac_obj_sub(a, b):
+    if a.kind != OBJECT:
+        return False
+
+    if is_root(b):
+        return True
+
+    # other_obj_sub_allow/2 does not look at the subject at all
+    if a.operm in OBJ_SUB_PERMS:
+        return True
+
+    if b.kind != SUBJECT:
+        return False
+
+    return b.uid == a.uid or \
+            (a.gid in b.groups and a.gperm in OBJ_SUB_PERMS)
+
+def dac(a, b):
+    """True if data may flow along the edge a -> b under DAC"""
+    return dac_sub_obj(a, b) or dac_obj_sub(a, b)
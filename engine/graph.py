@@ -0,0 +1,249 @@
+import re
+import logging
+import numpy as np
+
+from engine.dac import DacNode, SUBJECT, OBJECT, dac
+
+log = logging.getLogger(__name__)
+
+SUB_RE = re.compile(r'^sub\(\s*(\w+),\s*(-?\d+),\s*\[([^\]]*)\],\s*\d+,\s*\d+,\s*\d+,\s*\[([^\]]*)\]\)\.')
+OBJ_RE = re.compile(r'^obj\(\s*(\w+),\s*(-?\d+),\s*(-?\d+),\s*(\d+),\s*(\d+),\s*(\d+),\s*\[([^\]]*)\]\)\.')
+EDGE_RE = re.compile(r'^edge\(\s*(\w+),\s*(\w+)\)\.')
+
+# every per-node and adjacency array of a FactGraph
+ARRAY_FIELDS = ["kind", "uid", "gid", "perms", "caps", "tags", "groups_ptr", "groups_idx",
+        "fwd_ptr", "fwd_idx", "bwd_ptr", "bwd_idx"]
+
+def _int_list(s):
+    return [int(x) for x in s.split(",") if x.strip() != ""]
+
+def _bitmask(bits):
+    mask = 0
+    for b in bits:
+        mask |= 1 << b
+    return mask
+
+def _csr(n, src, dst):
+    """Compressed sparse rows of the edges src -> dst, sorted by (src, dst)"""
+    order = np.lexsort((dst, src))
+    indices = dst[order].astype(np.int32)
+    counts = np.bincount(src, minlength=n)
+    indptr = np.zeros(n+1, dtype=np.int64)
+    np.cumsum(counts, out=indptr[1:])
+
+    return indptr, indices
+
+class FactGraph(object):
+    """
+    The emitted Prolog facts (sub/7, obj/7, edge/2) as arrays: one row per
+    node and CSR forward/backward adjacency. Node i is named names[i],
+    which is the Prolog id (s12, o345) used in query results.
+    """
+    def __init__(self, names, kind, uid, gid, perms, caps, tags, groups, src, dst, labels=None):
+        n = len(names)
+
+        self.names = names
+        self.index = dict([[name, i] for i, name in enumerate(names)])
+        # pretty node name per node, if known (from the facts comments)
+        self.labels = labels
+
+        self.kind = np.asarray(kind, dtype=np.int8)
+        self.uid = np.asarray(uid, dtype=np.int64)
+        self.gid = np.asarray(gid, dtype=np.int64)
+        # (uperm, gperm, operm) per node
+        self.perms = np.asarray(perms, dtype=np.int8).reshape((n, 3))
+        # capability bits of subjects, special file tag bits of objects
+        self.caps = np.asarray(caps, dtype=np.uint64)
+        self.tags = np.asarray(tags, dtype=np.uint64)
+
+        # supplementary groups of subjects (including their gid)
+        self.groups_ptr = np.zeros(n+1, dtype=np.int64)
+        np.cumsum([len(g) for g in groups], out=self.groups_ptr[1:])
+        self.groups_idx = np.asarray([x for g in groups for x in g], dtype=np.int64)
+
+        src = np.asarray(src, dtype=np.int64)
+        dst = np.asarray(dst, dtype=np.int64)
+
+        self.fwd_ptr, self.fwd_idx = _csr(n, src, dst)
+        self.bwd_ptr, self.bwd_idx = _csr(n, dst, src)
+
+        self._dac_nodes = None
+        self._dac_mask = None
+        self._adjacency = {}
+
+    @staticmethod
+    def from_arrays(names, arrays, labels=None, dac_mask=None):
+        """
+        A graph over existing node and CSR arrays (see ARRAY_FIELDS), such
+        as memory-mapped ones. The arrays are used as is, without copying.
+        """
+        graph = FactGraph.__new__(FactGraph)
+
+        graph.names = names
+        graph.index = dict([[name, i] for i, name in enumerate(names)])
+        graph.labels = labels
+
+        for field in ARRAY_FIELDS:
+            setattr(graph, field, arrays[field])
+
+        graph._dac_nodes = None
+        graph._dac_mask = dac_mask
+        graph._adjacency = {}
+
+        return graph
+
+    @staticmethod
+    def from_facts(path):
+        names = []
+        kind = []
+        uid = []
+        gid = []
+        perms = []
+        caps = []
+        tags = []
+        groups = []
+        labels = []
+        edges = []
+        comment = None
+
+        with open(path, 'r') as fp:
+            for line in fp:
+                if line.startswith("%"):
+                    comment = line[1:].strip()
+                    continue
+
+                m = EDGE_RE.match(line)
+                if m:
+                    edges += [(m.group(1), m.group(2))]
+                    continue
+
+                m = SUB_RE.match(line)
+                if m:
+                    names += [m.group(1)]
+                    kind += [SUBJECT]
+                    uid += [int(m.group(2))]
+                    gid += [-1]
+                    perms += [(7, 7, 7)]
+                    groups += [_int_list(m.group(3))]
+                    caps += [_bitmask(_int_list(m.group(4)))]
+                    tags += [0]
+                    labels += [comment]
+                    comment = None
+                    continue
+
+                m = OBJ_RE.match(line)
+                if m:
+                    names += [m.group(1)]
+                    kind += [OBJECT]
+                    uid += [int(m.group(2))]
+                    gid += [int(m.group(3))]
+                    perms += [(int(m.group(4)), int(m.group(5)), int(m.group(6)))]
+                    groups += [[]]
+                    caps += [0]
+                    tags += [_bitmask(_int_list(m.group(7)))]
+                    labels += [comment]
+                    comment = None
+                    continue
+
+        index = dict([[name, i] for i, name in enumerate(names)])
+        src = [index[u] for u, _ in edges]
+        dst = [index[v] for _, v in edges]
+
+        log.info("Loaded %d nodes and %d edges from %s", len(names), len(edges), path)
+
+        return FactGraph(names, kind, uid, gid, perms, caps, tags, groups, src, dst, labels=labels)
+
+    def __len__(self):
+        return len(self.names)
+
+    def num_edges(self):
+        return len(self.fwd_idx)
+
+    def is_subject(self, i):
+        return self.kind[i] == SUBJECT
+
+    def is_object(self, i):
+        return self.kind[i] == OBJECT
+
+    def has_cap(self, i, cap):
+        """cap_supp/2: a subject with capability bit cap (None for any)"""
+        if self.kind[i] != SUBJECT:
+            return False
+
+        caps = int(self.caps[i])
+
+        if cap is None:
+            return caps != 0
+
+        return (caps >> cap) & 1 == 1
+
+    def has_tag(self, i, tag):
+        """ext_supp/2: an object tagged with tag (None for any)"""
+        if self.kind[i] != OBJECT:
+            return False
+
+        tags = int(self.tags[i])
+
+        if tag is None:
+            return tags != 0
+
+        return (tags >> tag) & 1 == 1
+
+    def edge_sources(self):
+        """The source node of each forward edge"""
+        return np.repeat(np.arange(len(self), dtype=np.int64), np.diff(self.fwd_ptr))
+
+    def groups(self, i):
+        return self.groups_idx[self.groups_ptr[i]:self.groups_ptr[i+1]]
+
+    def dac_node(self, i):
+        if self._dac_nodes is None:
+            self._dac_nodes = [None]*len(self)
+
+        node = self._dac_nodes[i]
+
+        if node is None:
+            uperm, gperm, operm = self.perms[i].tolist()
+            node = DacNode(int(self.kind[i]), int(self.uid[i]), int(self.gid[i]),
+                    uperm, gperm, operm, frozenset(self.groups(i).tolist()))
+            self._dac_nodes[i] = node
+
+        return node
+
+    def dac_mask(self):
+        """For each forward edge, whether it passes dac/2"""
+        if self._dac_mask is None:
+            src = self.edge_sources().tolist()
+            dst = self.fwd_idx.tolist()
+            mask = [dac(self.dac_node(u), self.dac_node(v)) for u, v in zip(src, dst)]
+
+            self._dac_mask = np.asarray(mask, dtype=bool)
+
+        return self._dac_mask
+
+    def adjacency(self, use_dac=True, reverse=False):
+        """
+        Adjacency as a list of Python lists, which is much faster than
+        numpy indexing for the per-node work of a search.
+        """
+        key = (use_dac, reverse)
+
+        if key not in self._adjacency:
+            src = self.edge_sources()
+            dst = self.fwd_idx
+
+            if use_dac:
+                mask = self.dac_mask()
+                src = src[mask]
+                dst = dst[mask]
+
+            if reverse:
+                ptr, idx = _csr(len(self), dst, src)
+            else:
+                ptr, idx = _csr(len(self), src, dst)
+
+            ptr = ptr.tolist()
+            idx = idx.tolist()
+            self._adjacency[key] = [idx[ptr[i]:ptr[i+1]] for i in range(len(self))]
+
+        return self._adjacency[key]
@@ -0,0 +1,88 @@
+"""
+Persisted result of SEPolicyInst.fully_instantiate() (db/inst-graph), so
+opening an image does not flatten and inflate the policy every time.
+
+The instance and its graph are pickled together: the obj attributes of
+the graph share processes, subjects and owners with the instance, and
+code comparing them (e.g. an IPC owner against inst.processes) relies on
+that. The file is keyed by the SHA-256 of db/inst and GRAPH_VERSION, and
+is recomputed whenever either changes.
+"""
+import os
+import pickle
+import logging
+
+from engine.cache import file_sha256
+
+log = logging.getLogger(__name__)
+
+INST_FILE = "inst"
+GRAPH_FILE = "inst-graph"
+# bump whenever fully_instantiate() produces a different graph
+GRAPH_VERSION = 1
+
+def inst_key(db_dir):
+    return (GRAPH_VERSION, file_sha256(os.path.join(db_dir, INST_FILE)))
+
+def load_saved(db_dir, key):
+    """The saved (inst, G) for key, or None if there is none"""
+    path = os.path.join(db_dir, GRAPH_FILE)
+
+    if not os.path.isfile(path):
+        return None
+
+    try:
+        with open(path, 'rb') as fp:
+            saved_key = pickle.load(fp)
+
+            if saved_key != key:
+                return None
+
+            return pickle.load(fp)
+    except (IOError, EOFError, pickle.UnpicklingError, AttributeError, ImportError) as e:
+        log.warning("Unable to load the saved instantiated graph: %s", e)
+        return None
+
+def save(db_dir, inst, G, key=None):
+    """
+    Save the graph of inst, which must be the instance stored in db/inst
+    (e.g. just loaded from or saved to it)
+    """
+    if key is None:
+        key = inst_key(db_dir)
+
+    path = os.path.join(db_dir, GRAPH_FILE)
+    tmp_path = path + ".tmp"
+
+    try:
+        with open(tmp_path, 'wb') as fp:
+            # the key first, so a stale file is rejected without loading it all
+            pickle.dump(key, fp, protocol=pickle.HIGHEST_PROTOCOL)
+            pickle.dump((inst, G), fp, protocol=pickle.HIGHEST_PROTOCOL)
+
+        os.replace(tmp_path, path)
+    except (IOError, pickle.PicklingError) as e:
+        log.warning("Unable to save the instantiated graph: %s", e)
+
+def load(db_dir, inst=None):
+    """
+    The instance of db/inst and its fully instantiated graph, as (inst, G).
+    The saved graph is used when db/inst has not changed, otherwise the
+    graph is instantiated again and saved. inst, if given, must be the
+    already loaded db/inst and is only used when instantiating.
+    """
+    key = inst_key(db_dir)
+    saved = load_saved(db_dir, key)
+
+    if saved is not None:
+        log.info("Using the saved instantiated graph")
+        return saved
+
+    if inst is None:
+        with open(os.path.join(db_dir, INST_FILE), 'rb') as fp:
+            inst = pickle.load(fp)
+
+    G = inst.fully_instantiate()
+    save(db_dir, inst, G, key)
+
+    return inst, G
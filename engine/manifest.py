@@ -0,0 +1,186 @@
+"""
+Manifest of the generated files of a db directory (db/manifest.json), to
+tell which of them are out of date without regenerating them.
+
+The files are generated in two stages by process.py:
+    inst    - db/inst, from the extracted policy (filesystems.db,
+              policy_files.db and the saved policy files such as sepolicy
+              and file_contexts) with --save
+    prolog  - the facts, node map and query binaries, from db/inst with
+              --compile-prolog
+
+Each stage records the SHA-256 of its inputs and of the code that
+produces them once it completes. A stage is stale when one of its outputs
+is missing, it was never recorded or any of the hashes changed.
+
+The inputs are only the files process.py reads, and a process hashes each
+of them again only when its size or modification time changes.
+"""
+import os
+import json
+import pickle
+import logging
+
+from engine.cache import file_sha256, code_hash
+
+log = logging.getLogger(__name__)
+
+MANIFEST_FILE = "manifest.json"
+VERSION = 2
+
+STAGE_OUTPUTS = {
+    "inst": ["inst"],
+    "prolog": ["inst-map", "facts.pl", "inst2", "inst3", "inst4", "inst5"],
+}
+
+# sources (globs relative to the repository) whose changes change the outputs
+STAGE_CODE = {
+    "inst": ["process.py", "overlay.py", "security_policy.py", "segraph.py", "sedump.py",
+        "config.py", "android/*.py"],
+    "prolog": ["prolog.py", "engine/dac.py", "logic/*.pl"],
+}
+
+# read by process.py, besides the saved policy files listed in policy_files.db
+POLICY_INPUTS = ["all_properties.prop", "db/filesystems.db", "db/policy_files.db"]
+
+# written to the results directory by process.py itself (--save-policy)
+GENERATED_FILES = ["sepolicy.txt"]
+
+# generated in order, a stale stage makes every later stage stale
+STAGES = ["inst", "prolog"]
+
+# path -> (mtime, size, sha256) of the files hashed so far
+_digests = {}
+
+def cached_sha256(path):
+    """SHA-256 of a file, only hashed again if its size or mtime changed"""
+    st = os.stat(path)
+    cached = _digests.get(path)
+
+    if cached is not None and cached[:2] == (st.st_mtime, st.st_size):
+        return cached[2]
+
+    digest = file_sha256(path)
+    _digests[path] = (st.st_mtime, st.st_size, digest)
+
+    return digest
+
+class DbManifest(object):
+    def __init__(self, db_dir):
+        self.db_dir = os.path.normpath(db_dir)
+        # the extracted policy files are saved next to db/
+        self.results_dir = os.path.dirname(self.db_dir)
+        self.path = os.path.join(self.db_dir, MANIFEST_FILE)
+
+    def _policy_inputs(self):
+        """{path relative to the results directory: sha256} of the inst inputs"""
+        names = list(POLICY_INPUTS)
+
+        # the saved policy files, by their path in the results directory
+        try:
+            with open(os.path.join(self.db_dir, "policy_files.db"), 'rb') as fp:
+                names += sorted(pickle.load(fp))
+        except (IOError, EOFError, pickle.UnpicklingError) as e:
+            log.debug("Unable to list the saved policy files: %s", e)
+
+        inputs = {}
+
+        for name in names:
+            path = os.path.join(self.results_dir, name)
+
+            if name in GENERATED_FILES or not os.path.isfile(path):
+                continue
+
+            inputs[name] = cached_sha256(path)
+
+        return inputs
+
+    def current(self, stage):
+        """The inputs and code hash stage would be recorded with now"""
+        if stage == "inst":
+            inputs = self._policy_inputs()
+        else:
+            inst_path = os.path.join(self.db_dir, "inst")
+            inputs = {"db/inst": cached_sha256(inst_path) if os.path.isfile(inst_path) else None}
+
+        return {"inputs": inputs, "code": code_hash(STAGE_CODE[stage])}
+
+    def load(self):
+        try:
+            with open(self.path, 'r') as fp:
+                manifest = json.load(fp)
+        except (IOError, ValueError):
+            return {}
+
+        if manifest.get("version") != VERSION:
+            return {}
+
+        return manifest.get("stages", {})
+
+    def record(self, stage):
+        """Record that stage was just generated from the current inputs"""
+        stages = self.load()
+        stages[stage] = self.current(stage)
+
+        tmp_path = self.path + ".tmp"
+
+        try:
+            with open(tmp_path, 'w') as fp:
+                json.dump({"version": VERSION, "stages": stages}, fp, indent=2, sort_keys=True)
+
+            os.replace(tmp_path, self.path)
+        except IOError as e:
+            log.warning("Unable to write %s: %s", self.path, e)
+
+    def _stage_reason(self, stage, recorded):
+        """Why stage is stale, or None if it is current"""
+        missing = [name for name in STAGE_OUTPUTS[stage]
+                if not os.path.isfile(os.path.join(self.db_dir, name))]
+
+        if missing:
+            return "missing %s" % ", ".join(missing)
+
+        if stage not in recorded:
+            return "not in the manifest"
+
+        current = self.current(stage)
+
+        if recorded[stage].get("code") != current["code"]:
+            return "code changed"
+
+        old_inputs = recorded[stage].get("inputs", {})
+        changed = sorted([name for name in set(old_inputs) | set(current["inputs"])
+            if old_inputs.get(name) != current["inputs"].get(name)])
+
+        if changed:
+            return "inputs changed (%s)" % ", ".join(changed[:5] + (["..."] if len(changed) > 5 else []))
+
+        return None
+
+    def stale_stages(self):
+        """{stage: reason} of every stale stage"""
+        recorded = self.load()
+        stale = {}
+
+        for stage in STAGES:
+            if stale:
+                stale[stage] = "%s is stale" % list(stale)[0]
+                continue
+
+            reason = self._stage_reason(stage, recorded)
+
+            if reason is not None:
+                stale[stage] = reason
+
+        return stale
+
+    def status(self):
+        """{generated file: why it is stale, or None if it is current}"""
+        stale = self.stale_stages()
+        status = {}
+
+        for stage in STAGES:
+            for name in STAGE_OUTPUTS[stage]:
+                status[name] = stale.get(stage)
+
+        return status
@@ -0,0 +1,191 @@
+import time
+import logging
+import itertools
+
+log = logging.getLogger(__name__)
+
+WILDCARDS = ["_", "*"]
+
+class PathEngine(object):
+    """
+    In-process equivalent of query2..query5 from logic/sea_impl.pl.
+
+    Paths are the simple paths of 1 to max(cutoff, 1) edges from start to
+    end, exactly like travel/5 + is_uniq/1. Instead of filtering complete
+    paths, the layers are applied during the search:
+        query2 (MAC)      - every edge
+        query3 (+DAC)     - only edges passing dac/2
+        query4 (+CAP)     - path kept if its last or second to last node is
+                            a subject with the capability (cap_path/2)
+        query5 (+EXT)     - only start from objects with the external tag
+                            (ext_path/2)
+    """
+    def __init__(self, graph):
+        self.graph = graph
+
+    def query(self, start, end, cutoff, cap=None, source=None, mac_only=False, limit=None):
+        """
+        Run a query with the same arguments as the inst binaries and return
+        the sorted list of paths, each a list of Prolog node ids. With a
+        limit, only the first limit paths in order of length are found.
+        """
+        level, start, end, cap, source = self._parse_args(start, end, cap, source, mac_only)
+
+        stime = time.time()
+
+        if limit:
+            paths = self.iter_paths(level, start, end, int(cutoff), cap, source, shortest_first=True)
+            paths = itertools.islice(paths, limit)
+        else:
+            paths = self.iter_paths(level, start, end, int(cutoff), cap, source)
+
+        # sort by name, not by index, to get the order of sort/2
+        names = self.graph.names
+        paths = sorted([[names[n] for n in path] for path in paths])
+
+        log.debug("Native query%d took %.2f seconds for %d paths", level, time.time()-stime, len(paths))
+
+        return paths
+
+    def _parse_args(self, start, end, cap, source, mac_only):
+        if mac_only:
+            level = 2
+            cap = source = None
+        else:
+            level = 3
+
+            if cap is not None:
+                level = 4
+            if source is not None:
+                level = 5
+
+        return level, self._node(start), self._node(end), _number(cap), _number(source)
+
+    def _node(self, name):
+        if name in WILDCARDS:
+            return None
+
+        if name not in self.graph.index:
+            raise KeyError(name)
+
+        return self.graph.index[name]
+
+    def iter_paths(self, level, start, end, cutoff, cap=None, source=None, shortest_first=False):
+        """
+        Yield each path (as a list of node indices) once, in no particular
+        order unless shortest_first is set. start/end/cap/source are None
+        for wildcards.
+        """
+        G = self.graph
+        adj = G.adjacency(use_dac=level >= 3)
+
+        if start is None:
+            starts = range(len(G))
+        else:
+            starts = [start]
+
+        # EXT: only the first node matters, so prune starting nodes
+        if level >= 5:
+            starts = [s for s in starts if G.has_tag(s, source)]
+
+        accept = None
+        # CAP: only the last two nodes matter, so check when the path is complete
+        if level >= 4:
+            has_cap = [G.has_cap(i, cap) for i in range(len(G))]
+            accept = lambda path: has_cap[path[-1]] or has_cap[path[-2]]
+
+        max_edges = max(cutoff, 1)
+
+        if shortest_first:
+            # iterative deepening, like shortest_path/7 in sea_impl.pl
+            depths = range(1, max_edges+1)
+        else:
+            depths = [max_edges]
+
+        # With a concrete end, the BFS distance to it bounds every branch:
+        # a node that is d edges away is only worth visiting with d edges
+        # of budget left. Both ends concrete: search from the side with
+        # fewer useful first steps, backwards over the reverse adjacency.
+        search = lambda s, depth: _simple_paths(adj, s, end, depth)
+
+        if end is not None:
+            radj = G.adjacency(use_dac=level >= 3, reverse=True)
+            to_end = _bounded_bfs(radj, end, max_edges)
+            starts = [s for s in starts if s in to_end]
+            search = lambda s, depth: _simple_paths(adj, s, end, depth, to_end)
+
+            if start is not None and start in to_end:
+                from_start = _bounded_bfs(adj, start, max_edges)
+
+                fwd = len([x for x in adj[start] if to_end.get(x, max_edges) < max_edges])
+                bwd = len([x for x in radj[end] if from_start.get(x, max_edges) < max_edges])
+
+                if bwd < fwd:
+                    search = lambda s, depth: [path[::-1]
+                            for path in _simple_paths(radj, end, s, depth, from_start)]
+
+        for depth in depths:
+            for s in starts:
+                for path in search(s, depth):
+                    if shortest_first and len(path) != depth+1:
+                        continue
+
+                    if accept is None or accept(path):
+                        yield path
+
+def _number(value):
+    if value is None or value in WILDCARDS:
+        return None
+
+    return int(value)
+
+def _bounded_bfs(adj, root, max_depth):
+    """{node: number of edges from root} of the nodes at most max_depth away"""
+    dist = {root: 0}
+    frontier = [root]
+
+    for depth in range(1, max_depth+1):
+        next_frontier = []
+
+        for x in frontier:
+            for y in adj[x]:
+                if y not in dist:
+                    dist[y] = depth
+                    next_frontier.append(y)
+
+        frontier = next_frontier
+
+    return dist
+
+def _simple_paths(adj, start, end, max_edges, to_end=None):
+    """
+    Depth-first enumeration of the simple paths from start with at most
+    max_edges edges that end at end (or anywhere if end is None). Paths
+    never pass through end, matching travel/5. to_end, the distance of
+    each node to end, prunes branches that cannot reach end in time.
+    """
+    path = [start]
+    on_path = set(path)
+    stack = [iter(adj[start])]
+
+    while stack:
+        for nxt in stack[-1]:
+            if nxt in on_path:
+                continue
+
+            if to_end is not None and to_end.get(nxt, max_edges+1) > max_edges - len(path):
+                continue
+
+            if end is None or nxt == end:
+                path.append(nxt)
+                yield list(path)
+                path.pop()
+
+            if nxt != end and len(path) < max_edges:
+                path.append(nxt)
+                on_path.add(nxt)
+                stack.append(iter(adj[nxt]))
+                break
+        else:
+            stack.pop()
+            on_path.discard(path.pop())
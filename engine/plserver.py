@@ -0,0 +1,183 @@
+import os
+import re
+import atexit
+import logging
+import threading
+import subprocess as sp
+
+from engine.results import ResultReader
+
+log = logging.getLogger(__name__)
+
+SERVER_BINARY = "inst_server"
+END_OF_RESULT = "end_of_result"
+
+# Prolog node ids (s12, o345) and numeric cap/ext arguments are the only
+# things we put into a request. Anything else goes to the one-shot binaries.
+NODE_RE = re.compile(r'^[a-z][a-zA-Z0-9_]*$')
+NUMBER_RE = re.compile(r'^[0-9]+$')
+WILDCARDS = ["_", "*"]
+
+class PrologServerError(Exception):
+    pass
+
+class PrologServer(object):
+    """
+    A long-lived inst_server process for a single db_dir. The facts are
+    loaded once when the process starts and every query after that is a
+    single framed request/response over the process' stdin/stdout.
+
+    command replaces the compiled binary, e.g. to run logic/server.pl
+    through swipl directly against a facts file.
+    """
+    def __init__(self, db_dir, command=None):
+        self.db_dir = db_dir
+        self.binary_path = os.path.join(db_dir, SERVER_BINARY)
+        self.command = command
+        self.binary_mtime = None
+        self.proc = None
+        self.lock = threading.Lock()
+
+    def available(self):
+        if self.command:
+            return True
+
+        return os.access(self.binary_path, os.X_OK)
+
+    def start(self):
+        if self.command:
+            command = self.command
+            mtime = None
+        else:
+            command = [self.binary_path]
+            mtime = os.stat(self.binary_path).st_mtime
+
+        if self.proc and self.proc.poll() is None:
+            # restart if the facts were recompiled underneath us
+            if mtime == self.binary_mtime:
+                return
+
+            self.stop()
+
+        log.debug("Starting prolog query server %s", " ".join(command))
+        self.proc = sp.Popen(command, stdin=sp.PIPE, stdout=sp.PIPE)
+        self.binary_mtime = mtime
+
+    def stop(self):
+        if not self.proc:
+            return
+
+        try:
+            self.proc.stdin.close()
+            self.proc.wait(timeout=1)
+        except (OSError, sp.TimeoutExpired):
+            self.proc.kill()
+            self.proc.wait()
+
+        self.proc = None
+
+    def query(self, level, start, end, cutoff, cap=None, source=None, limit=None):
+        """
+        Run query<level> and return a ResultReader over the result, the
+        same output the inst<level> binary would have printed.
+        With a limit, the shortest paths come first and at most limit paths
+        are returned. Errors are raised while reading, as PrologServerError.
+        """
+        request = "query(%d, %s, %s, %d, %s, %s, %d).\n" % (level,
+                _node_term(start), _node_term(end), int(cutoff),
+                _number_term(cap), _number_term(source), int(limit or 0))
+
+        return ResultReader(self._read_lines(request))
+
+    def _read_lines(self, request):
+        # the whole answer is read before the first line is handed out, so
+        # the lock is never held by a reader that stopped halfway or by the
+        # caller's own next query
+        for line in self._read_response(request):
+            yield line
+
+    def _read_response(self, request):
+        finished = False
+        lines = []
+
+        with self.lock:
+            try:
+                self.start()
+                self.proc.stdin.write(request.encode())
+                self.proc.stdin.flush()
+
+                while True:
+                    line = self.proc.stdout.readline()
+
+                    if not line:
+                        raise PrologServerError("query server exited unexpectedly")
+
+                    line = line.decode().rstrip("\n")
+
+                    if line == END_OF_RESULT:
+                        finished = True
+                        break
+
+                    lines += [line]
+            except (OSError, PrologServerError):
+                self.stop()
+                raise PrologServerError("query server failed on request %s" % request.strip())
+            finally:
+                # the server is mid-answer if reading was interrupted, so its
+                # output can't be trusted anymore
+                if not finished and self.proc:
+                    self.proc.kill()
+                    self.proc.wait()
+                    self.proc = None
+
+        return lines
+
+def node_arg(node):
+    """
+    A start or end argument of the inst binaries. Every wildcard becomes
+    `_`, which they read as an unbound variable like the native engine does.
+    """
+    return "_" if node in WILDCARDS else node
+
+def _node_term(node):
+    if node in WILDCARDS:
+        return "_"
+
+    if not NODE_RE.match(node):
+        raise ValueError("Invalid prolog node '%s'" % node)
+
+    return node
+
+def _number_term(value):
+    if value is None or value in WILDCARDS:
+        return "_"
+
+    if not NUMBER_RE.match(str(value)):
+        raise ValueError("Invalid prolog number '%s'" % value)
+
+    return str(value)
+
+_servers = {}
+
+def get_server(db_dir):
+    """
+    Return the shared query server for db_dir or None if it has not been
+    compiled. Callers are expected to fall back to the inst binaries.
+    """
+    key = os.path.realpath(db_dir)
+
+    if key not in _servers:
+        _servers[key] = PrologServer(db_dir)
+
+    server = _servers[key]
+
+    if not server.available():
+        return None
+
+    return server
+
+def stop_all():
+    for server in _servers.values():
+        server.stop()
+
+atexit.register(stop_all)
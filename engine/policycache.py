@@ -0,0 +1,234 @@
+"""
+Cache of SELinuxPolicyGraph.build_graph() results, shared by every image
+(POLICY_GRAPH_CACHE_DIR), so a sepolicy binary is only parsed with setools
+once even when many firmware ship the same one.
+
+Entries are named after the SHA-256 of the sepolicy file, FORMAT_VERSION
+and segraph.py. They are not pickles of the networkx graphs: the graph
+node names, classes and permissions are interned in a string table and
+the edges stored as flat lists of indexes, all as zlib compressed JSON.
+The PolicyIndex (type ids and permission masks) is rebuilt on load.
+Loading an entry adds the nodes and then the edges back in their original
+order, so the graphs are identical to freshly built ones (including the
+iteration order and the edge keys).
+
+The cache is bounded in size and evicts the least recently used entries,
+using the file modification time as the access time.
+"""
+import os
+import json
+import zlib
+import hashlib
+import logging
+import tempfile
+
+import networkx as nx
+
+from android.sepolicy import index_policy
+from engine.cache import file_sha256, code_hash
+
+log = logging.getLogger(__name__)
+
+MAGIC = b"SEAPG1\n"
+ENTRY_SUFFIX = ".spg"
+# bump whenever the entry layout changes
+FORMAT_VERSION = 2
+DEFAULT_MAX_BYTES = 512*1024*1024
+
+# build_graph() result keys stored as plain JSON
+PLAIN_KEYS = ["classes", "attributes", "commons", "types", "aliases", "genfs", "fs_use"]
+
+class _Interner(object):
+    def __init__(self):
+        self.strings = []
+        self.index = {}
+
+    def __call__(self, s):
+        i = self.index.get(s)
+
+        if i is None:
+            i = self.index[s] = len(self.strings)
+            self.strings.append(s)
+
+        return i
+
+def encode_policy(policy):
+    """The compact entry data of a build_graph() result"""
+    intern = _Interner()
+    permsets = {}
+
+    allow = []
+    for u, v, data in policy["graphs"]["allow"].edges(data=True):
+        # most edges share one of a few thousand permission lists
+        perms = tuple([intern(p) for p in data["perms"]])
+        ps = permsets.get(perms)
+
+        if ps is None:
+            ps = permsets[perms] = len(permsets)
+
+        allow += [intern(u), intern(v), intern(data["teclass"]), ps]
+
+    transition = []
+    for u, v, data in policy["graphs"]["transition"].edges(data=True):
+        name = data["name"]
+        transition += [intern(u), intern(v), intern(data["teclass"]), intern(data["through"]),
+                -1 if name is None else intern(name)]
+
+    entry = dict([[key, policy[key]] for key in PLAIN_KEYS])
+    entry["strings"] = intern.strings
+    entry["permsets"] = [list(p) for p, _ in sorted(permsets.items(), key=lambda x: x[1])]
+    entry["allow"] = allow
+    entry["transition"] = transition
+    # the edges are listed by source, which is not the order the nodes were added in
+    entry["nodes"] = dict([[name, [intern(n) for n in G.nodes()]]
+        for name, G in policy["graphs"].items()])
+
+    return zlib.compress(json.dumps(entry, separators=(",", ":")).encode())
+
+def decode_policy(data):
+    """The build_graph() result of compact entry data"""
+    entry = json.loads(zlib.decompress(data).decode())
+    strings = entry["strings"]
+    permsets = [[strings[p] for p in ps] for ps in entry["permsets"]]
+
+    G_allow = nx.MultiDiGraph()
+    G_allow.add_nodes_from([strings[n] for n in entry["nodes"]["allow"]])
+    allow = entry["allow"]
+    G_allow.add_edges_from([(strings[allow[i]], strings[allow[i+1]],
+        {"teclass": strings[allow[i+2]], "perms": list(permsets[allow[i+3]])})
+        for i in range(0, len(allow), 4)])
+
+    G_transition = nx.MultiDiGraph()
+    G_transition.add_nodes_from([strings[n] for n in entry["nodes"]["transition"]])
+    tr = entry["transition"]
+    G_transition.add_edges_from([(strings[tr[i]], strings[tr[i+1]],
+        {"teclass": strings[tr[i+2]], "through": strings[tr[i+3]],
+            "name": None if tr[i+4] == -1 else strings[tr[i+4]]})
+        for i in range(0, len(tr), 5)])
+
+    policy = dict([[key, entry[key]] for key in PLAIN_KEYS])
+    policy["graphs"] = {"allow": G_allow, "transition": G_transition}
+
+    # the type ids and permission masks are cheap to recompute
+    return index_policy(policy)
+
+class PolicyGraphCache(object):
+    def __init__(self, cache_dir, max_bytes=DEFAULT_MAX_BYTES):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+
+    def make_key(self, sepolicy_path):
+        """The name of the entry of a sepolicy file"""
+        h = hashlib.sha256()
+        h.update(("%d %s %s" % (FORMAT_VERSION, file_sha256(sepolicy_path),
+            code_hash(["segraph.py"]))).encode())
+
+        return h.hexdigest()
+
+    def _entry_path(self, key):
+        return os.path.join(self.cache_dir, key + ENTRY_SUFFIX)
+
+    def get(self, key):
+        """The cached build_graph() result of key, or None"""
+        path = self._entry_path(key)
+
+        try:
+            with open(path, 'rb') as fp:
+                if fp.read(len(MAGIC)) != MAGIC:
+                    return None
+
+                policy = decode_policy(fp.read())
+        except IOError:
+            return None
+        except (ValueError, KeyError, IndexError, zlib.error) as e:
+            log.warning("Ignoring the corrupt cached policy graph %s: %s", path, e)
+            return None
+
+        # mark as recently used
+        try:
+            os.utime(path, None)
+        except OSError:
+            pass
+
+        return policy
+
+    def put(self, key, policy):
+        path = self._entry_path(key)
+
+        try:
+            if not os.path.isdir(self.cache_dir):
+                os.makedirs(self.cache_dir)
+
+            # other images may be storing the same entry at the same time
+            fd, tmp_path = tempfile.mkstemp(dir=self.cache_dir, suffix=".tmp")
+
+            try:
+                with os.fdopen(fd, 'wb') as fp:
+                    fp.write(MAGIC)
+                    fp.write(encode_policy(policy))
+
+                os.replace(tmp_path, path)
+            except:
+                os.unlink(tmp_path)
+                raise
+        except (IOError, OSError) as e:
+            log.warning("Failed to cache the policy graph: %s", e)
+            return
+
+        self.evict()
+
+    def entries(self):
+        """(mtime, size, path) of every entry"""
+        entries = []
+
+        for name in os.listdir(self.cache_dir):
+            if not name.endswith(ENTRY_SUFFIX):
+                continue
+
+            path = os.path.join(self.cache_dir, name)
+
+            try:
+                st = os.stat(path)
+            except OSError:
+                continue
+
+            entries += [(st.st_mtime, st.st_size, path)]
+
+        return entries
+
+    def evict(self):
+        entries = sorted(self.entries())
+        total = sum([size for _, size, _ in entries])
+
+        # least recently used first
+        for _, size, path in entries:
+            if total <= self.max_bytes:
+                break
+
+            try:
+                os.unlink(path)
+            except OSError:
+                continue
+
+            total -= size
+
+    def build_graph(self, sepolicy_path, policy_class):
+        """
+        The build_graph() result of a sepolicy file, from the cache if it
+        is there, otherwise parsed with policy_class (SELinuxPolicyGraph)
+        and cached. Raises OSError if the file cannot be read or parsed.
+        """
+        key = self.make_key(sepolicy_path)
+        policy = self.get(key)
+
+        if policy is not None:
+            log.info("Using the cached SEPolicy graph %s", key[:16])
+            return policy
+
+        policy_graph = policy_class(sepolicy_path)
+
+        log.info("Building SEPolicy graph")
+        policy = policy_graph.build_graph()
+        self.put(key, policy)
+
+        return policy
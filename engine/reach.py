@@ -0,0 +1,195 @@
+"""
+Reachability index over the emitted graph, for "can X reach Y (within k
+edges)" questions that do not need the paths themselves.
+
+The graph is condensed into its strongly connected components, which are
+numbered in topological order. Two nodes of the same component always
+reach each other, and a component can only reach components with a higher
+number, which prunes most negative answers without a search. The remaining
+questions are answered with a search over the condensed graph (or a BFS
+over the nodes for distances) whose results are kept in a small cache.
+"""
+import logging
+from collections import OrderedDict, deque
+
+log = logging.getLogger(__name__)
+
+# number of searches kept per kind
+DEFAULT_CACHE_SIZE = 64
+
+def strongly_connected_components(adj):
+    """
+    Tarjan's algorithm without recursion. Returns comp, the component of
+    each node, numbered so that every edge u -> v has comp[u] <= comp[v].
+    """
+    n = len(adj)
+    index = [-1]*n
+    low = [0]*n
+    on_stack = [False]*n
+    comp = [-1]*n
+    stack = []
+    order = 0
+    ncomp = 0
+
+    for root in range(n):
+        if index[root] != -1:
+            continue
+
+        index[root] = low[root] = order
+        order += 1
+        stack.append(root)
+        on_stack[root] = True
+        work = [(root, 0)]
+
+        while work:
+            u, i = work[-1]
+
+            if i < len(adj[u]):
+                work[-1] = (u, i+1)
+                v = adj[u][i]
+
+                if index[v] == -1:
+                    index[v] = low[v] = order
+                    order += 1
+                    stack.append(v)
+                    on_stack[v] = True
+                    work.append((v, 0))
+                elif on_stack[v] and index[v] < low[u]:
+                    low[u] = index[v]
+
+                continue
+
+            work.pop()
+
+            if work:
+                parent = work[-1][0]
+                if low[u] < low[parent]:
+                    low[parent] = low[u]
+
+            if low[u] == index[u]:
+                while True:
+                    v = stack.pop()
+                    on_stack[v] = False
+                    comp[v] = ncomp
+
+                    if v == u:
+                        break
+
+                ncomp += 1
+
+    # Tarjan finds sinks first, flip that into a topological order
+    return [ncomp - 1 - c for c in comp]
+
+class ReachIndex(object):
+    def __init__(self, graph, use_dac=True, cache_size=DEFAULT_CACHE_SIZE):
+        self.graph = graph
+        self.adj = graph.adjacency(use_dac=use_dac)
+        self.radj = graph.adjacency(use_dac=use_dac, reverse=True)
+        self.comp = strongly_connected_components(self.adj)
+
+        ncomp = max(self.comp) + 1 if self.comp else 0
+        succ = [set() for _ in range(ncomp)]
+
+        for u, vs in enumerate(self.adj):
+            cu = self.comp[u]
+            for v in vs:
+                if self.comp[v] != cu:
+                    succ[cu].add(self.comp[v])
+
+        # condensed DAG
+        self.comp_succ = [sorted(s) for s in succ]
+        self.cache_size = cache_size
+        self._comp_reach = OrderedDict()
+        self._distances = OrderedDict()
+
+        log.info("Reachability index: %d nodes in %d components", len(self.adj), ncomp)
+
+    def _cached(self, cache, key, compute):
+        if key in cache:
+            cache.move_to_end(key)
+            return cache[key]
+
+        value = compute(key)
+        cache[key] = value
+
+        if len(cache) > self.cache_size:
+            cache.popitem(last=False)
+
+        return value
+
+    def _reachable_comps(self, c):
+        """Every component reachable from component c, including itself"""
+        seen = set([c])
+        todo = [c]
+
+        while todo:
+            for d in self.comp_succ[todo.pop()]:
+                if d not in seen:
+                    seen.add(d)
+                    todo.append(d)
+
+        return seen
+
+    def _bfs(self, key):
+        u, reverse = key
+        adj = self.radj if reverse else self.adj
+        dist = {u: 0}
+        todo = deque([u])
+
+        while todo:
+            x = todo.popleft()
+            d = dist[x] + 1
+
+            for y in adj[x]:
+                if y not in dist:
+                    dist[y] = d
+                    todo.append(y)
+
+        return dist
+
+    def _node(self, name):
+        return self.graph.index[name]
+
+    def distances(self, u, reverse=False):
+        """{node index: number of edges} of every node reachable from u (or reaching u)"""
+        return self._cached(self._distances, (u, reverse), self._bfs)
+
+    def reachable(self, u, v, max_hops=None):
+        """
+        True if Prolog node u reaches v, within max_hops edges if given.
+        Every node reaches itself. Raises KeyError for unknown nodes.
+        """
+        iu, iv = self._node(u), self._node(v)
+        cu, cv = self.comp[iu], self.comp[iv]
+
+        if cu > cv:
+            return False
+
+        if max_hops is not None:
+            d = self.distances(iu).get(iv)
+            return d is not None and d <= max_hops
+
+        if cu == cv:
+            return True
+
+        return cv in self._cached(self._comp_reach, cu, self._reachable_comps)
+
+    def distance(self, u, v):
+        """Number of edges of the shortest path from u to v, 0 if u is v, None if unreachable"""
+        iu, iv = self._node(u), self._node(v)
+
+        if self.comp[iu] > self.comp[iv]:
+            return None
+
+        return self.distances(iu).get(iv)
+
+    def reachable_set(self, u, max_hops=None, reverse=False):
+        """
+        Sorted Prolog ids of the nodes reachable from u (or, with reverse,
+        that reach u) within max_hops edges, not counting u itself
+        """
+        i = self._node(u)
+        names = self.graph.names
+
+        return sorted([names[x] for x, d in self.distances(i, reverse).items()
+            if x != i and (max_hops is None or d <= max_hops)])
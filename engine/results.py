@@ -0,0 +1,100 @@
+"""
+Incremental reader for the result format streamed by logic/main2..5.pl and
+logic/server.pl (see stream_paths/2 in logic/sea_impl.pl):
+
+    s12 o345 s67        one path per line, node ids separated by a space
+    % count 3           metadata lines start with '% '
+    % time 12
+
+Paths are parsed as they are read, so memory use is proportional to a
+single path and the consumer can stop at any point.
+"""
+import logging
+import subprocess as sp
+
+log = logging.getLogger(__name__)
+
+METADATA_PREFIX = "% "
+
+class MalformedResultError(Exception):
+    pass
+
+class ResultReader(object):
+    """
+    Iterate over the paths (lists of Prolog node ids) of a result. lines
+    can be any iterable of str or bytes lines, such as a pipe or a
+    generator. lines and close are closed once the lines are exhausted or
+    the consumer stops early.
+    """
+    def __init__(self, lines, close=None):
+        self.lines = lines
+        self.on_close = close
+        self.count = None
+        self.time_ms = None
+        self.paths_read = 0
+
+    def __iter__(self):
+        try:
+            for line in self.lines:
+                if isinstance(line, bytes):
+                    line = line.decode()
+
+                line = line.rstrip("\n")
+
+                if line.startswith(METADATA_PREFIX):
+                    self._parse_metadata(line[len(METADATA_PREFIX):])
+                    continue
+
+                if line == "":
+                    continue
+
+                self.paths_read += 1
+                yield line.split(" ")
+        finally:
+            self.close()
+
+    def _parse_metadata(self, line):
+        key, _, value = line.partition(" ")
+
+        if key == "count":
+            self.count = int(value)
+        elif key == "time":
+            self.time_ms = int(value)
+        else:
+            log.debug("Ignoring unknown result metadata '%s'", line)
+
+    def complete(self):
+        """True if the whole result was read and it had the expected size"""
+        return self.count is not None and self.count == self.paths_read
+
+    def read_all(self):
+        paths = list(self)
+
+        if not self.complete():
+            raise MalformedResultError("result ended after %d paths (expected %s)" % (
+                self.paths_read, self.count))
+
+        return paths
+
+    def close(self):
+        # stop the producer too (e.g. a generator holding a server lock)
+        if hasattr(self.lines, "close"):
+            self.lines.close()
+
+        if self.on_close:
+            on_close, self.on_close = self.on_close, None
+            on_close()
+
+def read_process(cmdline):
+    """Run an inst binary and read its result while it is running"""
+    proc = sp.Popen(cmdline, stdout=sp.PIPE)
+
+    def close():
+        # only still running if the consumer stopped early
+        if proc.poll() is None:
+            proc.kill()
+
+        proc.stdout.close()
+        proc.wait()
+
+    return ResultReader(proc.stdout, close=close)
@@ -0,0 +1,93 @@
+"""
+Strength ranking of every process in a single pass over the DAC filtered
+adjacency, instead of one `[proc, _, 1]` query per process.
+
+The strength of a process is based on what it reaches in one hop, i.e. the
+paths of query3 with a cutoff of 1:
+    ntype          - number of distinct types of the reached objects
+    nobj           - number of reached objects
+    ipc/file       - number of reached IPC/file objects
+    type_strength  - sum of 1/freq(type) over the reached types, where freq
+                     is the number of processes reaching the type (not
+                     counting a process reaching its own IPC first)
+"""
+import logging
+import overlay
+
+log = logging.getLogger(__name__)
+
+# column of each sort key in a strength row
+STRENGTH_KEYS = {"type": 0, "obj": 1, "ipc": 2, "file": 3, "type_strength": 4}
+
+def process_strengths(graph, processes, node_id_map, node_objs, include_empty=False):
+    """
+    Return {process node name: [ntype, nobj, nipc, nfile, type_strength]}
+    in the order of processes.
+
+    graph is the engine.graph.FactGraph of the emitted facts, node_id_map
+    maps node names to Prolog ids and node_objs node names to objects.
+    Processes without any reachable object are left out unless
+    include_empty is set.
+    """
+    adj = graph.adjacency(use_dac=True)
+    names = graph.names
+    node_id_map_inv = dict([[v, k] for k, v in node_id_map.items()])
+
+    type_freq = {}
+    intermediate_results = {}
+
+    for p in processes:
+        name = p.get_node_name()
+        plnode = node_id_map.get(name)
+
+        if plnode not in graph.index:
+            log.warning("could not find %s in node_id_map", name)
+            continue
+
+        i = graph.index[plnode]
+        # same order as the sorted query results, which matters for the
+        # first object of each type below
+        targets = sorted([names[j] for j in adj[i] if j != i])
+
+        uniq_types = set()
+        n_obj = 0
+        n_ipc = 0
+        n_file = 0
+
+        for target in targets:
+            try:
+                obj = node_objs[node_id_map_inv[target]]
+            except KeyError as e:
+                log.warning("Could not find component %s in node_id_map", str(e))
+                continue
+
+            n_obj += 1
+
+            if obj.sid.type not in uniq_types:
+                uniq_types.add(obj.sid.type)
+
+                type_freq[obj.sid.type] = type_freq.get(obj.sid.type, 0)
+                if not (isinstance(obj, overlay.IPCNode) and obj.owner == p):
+                    type_freq[obj.sid.type] += 1
+
+            if isinstance(obj, overlay.IPCNode):
+                n_ipc += 1
+            elif isinstance(obj, overlay.FileNode):
+                n_file += 1
+
+        if n_obj == 0 and not include_empty:
+            continue
+
+        intermediate_results[name] = [uniq_types, n_obj, n_ipc, n_file]
+
+    results = {}
+
+    for node_name, (uniq_types, n_obj, n_ipc, n_file) in intermediate_results.items():
+        type_strength = sum(1 / type_freq[t] for t in uniq_types if type_freq[t] != 0)
+        results[node_name] = [len(uniq_types), n_obj, n_ipc, n_file, type_strength]
+
+    return results
+
+def rank_strengths(results, sort_key):
+    """Sort process_strengths() results by a STRENGTH_KEYS column, then nobj"""
+    return sorted(list(results.items()), key=lambda x: (x[1][sort_key], x[1][1]), reverse=True)
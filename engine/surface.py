@@ -0,0 +1,42 @@
+"""
+Two-hop attack surface of a target: every writer -> object -> target path
+that passes DAC. These are exactly the paths of query3(_, target, 2) that
+are not already paths of query3(_, target, 1), computed from the
+predecessor sets of the target instead of running and diffing both
+queries.
+"""
+import logging
+
+log = logging.getLogger(__name__)
+
+class AttackSurface(object):
+    def __init__(self, graph):
+        self.graph = graph
+        # predecessors over the DAC filtered edges, shared by every target
+        self.pred = graph.adjacency(use_dac=True, reverse=True)
+
+    def paths(self, target):
+        """
+        The [writer, object, target] paths of target (a Prolog node id),
+        sorted like query results. Raises KeyError for unknown targets.
+        """
+        t = self.graph.index[target]
+        names = self.graph.names
+        paths = []
+
+        for x in self.pred[t]:
+            if x == t:
+                continue
+
+            for w in self.pred[x]:
+                # simple paths only, like travel/5
+                if w == t or w == x:
+                    continue
+
+                paths += [[names[w], names[x], names[t]]]
+
+        return sorted(paths)
+
+    def paths_many(self, targets):
+        """paths() of many targets at once, as {target: paths}"""
+        return dict([[target, self.paths(target)] for target in targets])
@@ -0,0 +1,149 @@
+#!/usr/bin/env python3
+"""
+Time SEPolicyInst.inflate_graph(), and fully_instantiate() (and
+flatten_subject_graph(), which it starts with) on a saved db/inst, for one
+or more source trees.
+
+Each tree is run in its own interpreter so that the pickled instance is
+loaded with that tree's overlay.py. To compare a change against the
+revision before it:
+
+    git worktree add /tmp/before HEAD~1
+    eval/tools/bench-instantiate.py eval/.../db/inst --root /tmp/before --root .
+
+The peak memory is the tracemalloc peak of a separate run, since tracing
+slows the stage down. The graph digest is a hash of the sorted nodes and
+edges (with their type), of the flattened and of the instantiated graph,
+which should match between the trees.
+"""
+import argparse
+import hashlib
+import json
+import logging
+import os
+import pickle
+import subprocess as sp
+import sys
+import time
+import tracemalloc
+
+ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), "..", ".."))
+
+log = logging.getLogger("bench-instantiate")
+
+def load_inst(path):
+    with open(path, 'rb') as fp:
+        inst = pickle.load(fp)
+
+    # a db/inst saved before the policy index, run by a tree that has it
+    if "index" not in inst.sepolicy:
+        try:
+            from android.sepolicy import index_policy
+        except ImportError:
+            return inst
+
+        index_policy(inst.sepolicy)
+
+    return inst
+
+def graph_digest(G):
+    h = hashlib.sha256()
+
+    for node in sorted(G.nodes()):
+        h.update(("n %s\n" % node).encode())
+
+    # edges without a type sort like the others
+    for line in sorted(["e %s %s %s\n" % (u, v, ty) for u, v, ty in G.edges(data="ty")]):
+        h.update(line.encode())
+
+    return h.hexdigest()[:16]
+
+def worker(inst_path, repeat):
+    result = {}
+
+    best = None
+    for _ in range(repeat):
+        inst = load_inst(inst_path)
+        stime = time.time()
+        inst.inflate_graph(expand_all_objects=True, skip_fileless_subjects=True)
+        elapsed = time.time() - stime
+        best = elapsed if best is None else min(best, elapsed)
+
+    result["inflate_s"] = best
+
+    best = None
+    for _ in range(repeat):
+        inst = load_inst(inst_path)
+        stime = time.time()
+        FL = inst.flatten_subject_graph()
+        elapsed = time.time() - stime
+        best = elapsed if best is None else min(best, elapsed)
+
+    result["flatten_s"] = best
+    result["flat_digest"] = graph_digest(FL)
+
+    best = None
+    for _ in range(repeat):
+        inst = load_inst(inst_path)
+        stime = time.time()
+        G = inst.fully_instantiate()
+        elapsed = time.time() - stime
+        best = elapsed if best is None else min(best, elapsed)
+
+    result["instantiate_s"] = best
+    result["nodes"] = len(G)
+    result["edges"] = G.number_of_edges()
+    result["digest"] = graph_digest(G)
+
+    inst = load_inst(inst_path)
+    tracemalloc.start()
+    inst.fully_instantiate()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    result["peak_mib"] = peak / 1024.0 / 1024
+
+    print(json.dumps(result))
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("inst", help="a saved db/inst")
+    parser.add_argument("--root", action="append", help="source tree to run (default: this one)")
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--worker", action="store_true", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.worker:
+        # keep the log quiet, fully_instantiate logs every process
+        logging.basicConfig(level=logging.ERROR)
+        worker(args.inst, args.repeat)
+        return 0
+
+    logging.basicConfig(level=logging.INFO)
+
+    print("%-30s %10s %10s %10s %10s %10s %10s %18s %18s" % ("root", "inflate s", "flatten s", "inst s",
+        "peak MiB", "nodes", "edges", "flat digest", "digest"))
+
+    for root in args.root or [ROOT]:
+        root = os.path.abspath(root)
+        cmdline = [sys.executable, os.path.abspath(__file__), "--worker",
+                "--repeat", str(args.repeat), os.path.abspath(args.inst)]
+
+        env = dict(os.environ)
+        env["PYTHONPATH"] = root
+
+        proc = sp.Popen(cmdline, cwd=root, env=env, stdout=sp.PIPE)
+        stdout, _ = proc.communicate()
+
+        if proc.returncode != 0:
+            log.error("%s failed", root)
+            continue
+
+        r = json.loads(stdout.decode().strip().split("\n")[-1])
+        print("%-30s %10.2f %10.2f %10.2f %10.1f %10d %10d %18s %18s" % (root[-30:], r["inflate_s"], r["flatten_s"],
+            r["instantiate_s"], r["peak_mib"], r["nodes"], r["edges"], r["flat_digest"], r["digest"]))
+
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,106 @@
+#!/usr/bin/env python3
+"""
+Time Prolog queries against one or more facts/engine combinations.
+
+Each run is FACTS or FACTS:SEA_IMPL (default logic/sea_impl.pl). For
+example, to compare query3 before and after a fact schema change on the
+bundled sailfish facts:
+
+    git show <old-rev>:logic/sea_impl.pl > /tmp/sea_impl_old.pl
+    eval/tools/upgrade-facts.py facts/sailfish-*.pl -o /tmp/sailfish.pl
+    eval/tools/bench-prolog.py facts/sailfish-*.pl:/tmp/sea_impl_old.pl /tmp/sailfish.pl
+
+The query time is the one reported by the query itself ("Execution
+took"), the load time is the rest of the swipl wall clock time.
+"""
+import argparse
+import logging
+import os
+import re
+import subprocess as sp
+import sys
+import time
+
+ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), "..", ".."))
+
+log = logging.getLogger("bench-prolog")
+
+EXEC_RE = re.compile(r'^Execution took ([0-9]+) ms')
+COUNT_RE = re.compile(r'^Path number ([0-9]+)')
+
+DEFAULT_QUERIES = [
+    "query3(n0, _, 1, _)",
+    "query3(n0, _, 2, _)",
+    "query3(_, n0, 2, _)",
+    "query3(n0, _, 3, _)",
+]
+
+def run_query(swipl, facts, impl, query):
+    cmdline = [swipl, "-q", facts, impl, "-g", query, "-t", "halt"]
+
+    stime = time.time()
+    proc = sp.Popen(cmdline, stdout=sp.PIPE, stderr=sp.STDOUT)
+    stdout, _ = proc.communicate()
+    wall = time.time() - stime
+
+    query_ms = None
+    count = None
+
+    for line in stdout.decode().split("\n"):
+        m = EXEC_RE.match(line)
+        if m:
+            query_ms = int(m.group(1))
+
+        m = COUNT_RE.match(line)
+        if m:
+            count = int(m.group(1))
+
+    if query_ms is None:
+        log.error("%s did not complete: %s", " ".join(cmdline), stdout.decode().strip()[-500:])
+
+    return wall, query_ms, count
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("runs", nargs="+", help="FACTS or FACTS:SEA_IMPL")
+    parser.add_argument("--query", action="append", help="goal to time (default: a set of query3 goals)")
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--swipl", default="swipl")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+
+    queries = args.query or DEFAULT_QUERIES
+
+    print("%-40s %-26s %10s %10s %8s" % ("run", "query", "query ms", "load s", "paths"))
+
+    for run in args.runs:
+        if ":" in run:
+            facts, impl = run.split(":", 1)
+        else:
+            facts, impl = run, os.path.join(ROOT, "logic", "sea_impl.pl")
+
+        for query in queries:
+            best = None
+
+            for _ in range(args.repeat):
+                wall, query_ms, count = run_query(args.swipl, facts, impl, query)
+
+                if query_ms is None:
+                    break
+
+                if best is None or query_ms < best[1]:
+                    best = (wall, query_ms, count)
+
+            if best is None:
+                print("%-40s %-26s %10s" % (os.path.basename(facts), query, "FAILED"))
+                continue
+
+            wall, query_ms, count = best
+            print("%-40s %-26s %10d %10.2f %8d" % (os.path.basename(facts)[:40], query,
+                query_ms, wall - query_ms/1000.0, count))
+
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,188 @@
+#!/usr/bin/env python3
+"""
+Check that the native path engine (engine/paths.py) returns exactly the
+same path sets as the Prolog query2..query5 on a facts file.
+
+    eval/tools/engine-parity.py facts/sailfish-opm1.171019.011-factory-56d15350-nodev.pl
+
+Prolog is run through logic/server.pl with swipl, so nothing needs to be
+compiled first. As both engines follow the same dac_edge/2 facts, which
+are emitted by engine/dac.py, every edge is also checked against the
+dac/2 rules of logic/sea_impl.pl. Facts from before dac_edge/2 and is_sub/1 / is_obj/1 (such
+as the ones under facts/) are brought up to date with upgrade-facts.py
+into a temporary file first.
+"""
+import argparse
+import importlib.machinery
+import logging
+import os
+import random
+import subprocess as sp
+import sys
+import tempfile
+import time
+
+ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), "..", ".."))
+sys.path.insert(0, ROOT)
+
+from engine.graph import FactGraph
+from engine.paths import PathEngine
+from engine.plserver import PrologServer
+
+log = logging.getLogger("engine-parity")
+
+# prints "A B DAC DAC_EDGE" for each edge where dac/2 and dac_edge/2 disagree
+DAC_CHECK_GOAL = ("forall(edge(A, B), ("
+        "(dac(A, B) -> D = true ; D = false), "
+        "(dac_edge(A, B) -> E = true ; E = false), "
+        "(D == E -> true ; format('~w ~w ~w ~w~n', [A, B, D, E]))))")
+
+def load_upgrade_tool():
+    path = os.path.join(os.path.dirname(os.path.abspath(__file__)), "upgrade-facts.py")
+    return importlib.machinery.SourceFileLoader("upgrade_facts", path).load_module()
+
+def current_facts(path):
+    """The path of path's facts in the current schema, and whether it is a temporary file"""
+    upgrade = load_upgrade_tool()
+
+    if upgrade.is_current(path):
+        return path, False
+
+    fd, tmp_path = tempfile.mkstemp(prefix="parity-", suffix=".pl")
+
+    with os.fdopen(fd, 'w') as fp:
+        upgrade.write_upgraded(path, fp)
+
+    log.info("Upgraded %s to the current fact schema", path)
+
+    return tmp_path, True
+
+def check_dac(swipl, facts_path):
+    """
+    The (A, B, dac/2, dac_edge/2) of every edge where the emitted
+    dac_edge/2 facts disagree with the dac/2 rules
+    """
+    command = [swipl, "-g", DAC_CHECK_GOAL, "-g", "halt",
+            facts_path, os.path.join(ROOT, "logic", "sea_impl.pl")]
+
+    proc = sp.Popen(command, stdout=sp.PIPE, stderr=sp.DEVNULL)
+    stdout, _ = proc.communicate()
+
+    if proc.returncode != 0:
+        raise OSError("%s exited with status %d" % (swipl, proc.returncode))
+
+    mismatches = []
+
+    for line in stdout.decode().splitlines():
+        fields = line.split()
+
+        if len(fields) == 4:
+            mismatches += [tuple(fields)]
+
+    return mismatches
+
+def make_cases(graph, samples, cutoffs, seed):
+    rng = random.Random(seed)
+    nodes = graph.names
+    subjects = [graph.names[i] for i in range(len(graph)) if graph.is_subject(i)]
+    caps = sorted(set([c for i in range(len(graph)) for c in range(64) if graph.has_cap(i, c)]))
+    tags = sorted(set([t for i in range(len(graph)) for t in range(64) if graph.has_tag(i, t)]))
+
+    cases = []
+
+    for cutoff in cutoffs:
+        for _ in range(samples):
+            start = rng.choice(nodes)
+            end = rng.choice(nodes)
+            sub = rng.choice(subjects)
+
+            for level in [2, 3]:
+                cases += [(level, start, "_", cutoff, None, None)]
+                cases += [(level, "_", end, cutoff, None, None)]
+                cases += [(level, start, end, cutoff, None, None)]
+
+            for cap in [None] + caps[:2]:
+                cases += [(4, sub, "_", cutoff, cap, None)]
+
+            for tag in [None] + tags[:2]:
+                cases += [(5, "_", sub, cutoff, None, tag)]
+
+    return cases
+
+def run_native(engine, level, start, end, cutoff, cap, source):
+    return engine.query(start, end, cutoff, cap, source, mac_only=level == 2)
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("facts")
+    parser.add_argument("--samples", type=int, default=5)
+    parser.add_argument("--cutoff", type=int, action="append")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--swipl", default="swipl")
+    parser.add_argument("--debug", action="store_true")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.DEBUG if args.debug else logging.INFO)
+
+    cutoffs = args.cutoff or [1, 2, 3]
+
+    graph = FactGraph.from_facts(args.facts)
+    engine = PathEngine(graph)
+
+    facts_path, temporary = current_facts(args.facts)
+
+    command = [args.swipl, facts_path,
+            os.path.join(ROOT, "logic", "sea_impl.pl"),
+            os.path.join(ROOT, "logic", "server.pl")]
+    server = PrologServer(os.path.dirname(os.path.abspath(args.facts)), command=command)
+
+    failures = 0
+    cases = make_cases(graph, args.samples, cutoffs, args.seed)
+
+    try:
+        mismatches = check_dac(args.swipl, facts_path)
+
+        for a, b, rule, fact in mismatches[:20]:
+            log.info("DAC MISMATCH edge(%s, %s): dac/2 %s, dac_edge/2 %s", a, b, rule, fact)
+
+        log.info("%d edges where dac_edge/2 and dac/2 disagree", len(mismatches))
+
+        for case in cases:
+            level, start, end, cutoff, cap, source = case
+
+            stime = time.time()
+            expected = sorted(server.query(level, start, end, cutoff, cap, source).read_all())
+            ptime = time.time() - stime
+
+            stime = time.time()
+            actual = run_native(engine, *case)
+            ntime = time.time() - stime
+
+            status = "OK"
+            if actual != expected:
+                status = "MISMATCH"
+                failures += 1
+
+            log.info("%-8s query%d(%s, %s, %d, cap=%s, ext=%s): %d paths, prolog %.2fs, native %.2fs",
+                    status, level, start, end, cutoff, cap, source, len(expected), ptime, ntime)
+
+            if actual != expected:
+                missing = [p for p in expected if p not in actual]
+                extra = [p for p in actual if p not in expected]
+                log.info("  missing %s", missing[:5])
+                log.info("  extra   %s", extra[:5])
+    except OSError as e:
+        log.error("Unable to run %s: %s", args.swipl, e)
+        return 1
+    finally:
+        server.stop()
+
+        if temporary:
+            os.unlink(facts_path)
+
+    log.info("%d/%d queries matched", len(cases) - failures, len(cases))
+
+    return 1 if failures or mismatches else 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,106 @@
+#!/usr/bin/env python3
+"""
+Bring a facts file emitted by an older version of prolog.py up to the
+current fact schema, so that it can be used with logic/sea_impl.pl.
+
+    eval/tools/upgrade-facts.py facts/old.pl -o facts/new.pl
+
+Added relations:
+    dac_edge/2   - the edges that pass dac/2
+    is_sub/1     - one fact per subject, replacing sub_db/2
+    is_obj/1     - one fact per object, replacing obj_db/2
+"""
+import argparse
+import logging
+import os
+import re
+import sys
+
+ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), "..", ".."))
+sys.path.insert(0, ROOT)
+
+from engine.graph import FactGraph
+
+log = logging.getLogger("upgrade-facts")
+
+# relations that are regenerated (or dropped) by this tool
+REPLACED_RE = re.compile(r'^(dac_edge|is_sub|is_obj|sub_db|obj_db)\(')
+
+def read_kept_lines(path):
+    lines = []
+    skipping = False
+
+    with open(path, 'r') as fp:
+        for line in fp:
+            # obj_db/2 lists are split over multiple lines
+            if not skipping and REPLACED_RE.match(line):
+                skipping = True
+
+            if skipping:
+                skipping = not line.rstrip().endswith(").")
+                continue
+
+            lines += [line]
+
+    while lines and lines[-1].strip() == "":
+        lines.pop()
+
+    return lines
+
+def is_current(path):
+    """True if the facts file already has the relations this tool adds"""
+    with open(path, 'r') as fp:
+        return any([line.startswith("dac_edge(") for line in fp])
+
+def write_upgraded(path, fp):
+    """
+    Write the facts of path in the current schema to the file object fp.
+    Returns (edges passing DAC, edges).
+    """
+    graph = FactGraph.from_facts(path)
+
+    lines = read_kept_lines(path)
+
+    names = graph.names
+    src = graph.edge_sources().tolist()
+    dst = graph.fwd_idx.tolist()
+    mask = graph.dac_mask().tolist()
+
+    fp.writelines(lines)
+    fp.write("\n")
+
+    for i, name in enumerate(names):
+        if graph.is_subject(i):
+            fp.write("is_sub(%s).\n" % name)
+
+    fp.write("\n")
+
+    for i, name in enumerate(names):
+        if graph.is_object(i):
+            fp.write("is_obj(%s).\n" % name)
+
+    fp.write("\n")
+
+    for u, v, allowed in zip(src, dst, mask):
+        if allowed:
+            fp.write("dac_edge(%s, %s).\n" % (names[u], names[v]))
+
+    return sum(mask), len(mask)
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("facts")
+    parser.add_argument("-o", "--output", required=True)
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+
+    with open(args.output, 'w') as fp:
+        allowed, total = write_upgraded(args.facts, fp)
+
+    log.info("Wrote %s: %d of %d edges pass DAC", args.output, allowed, total)
+
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -7,5 +7,5 @@ main(Argv) :-
 	atom_number(Cutoff, CutoffN),
 	read_term_from_atom(Start, StartT, []),
 	read_term_from_atom(End, EndT, []),
-	query3(StartT, EndT, CutoffN, Z),
-	print(Z).
+	limit_arg(Argv, 3, Limit),
+	stream_query(3, StartT, EndT, CutoffN, _, _, Limit).
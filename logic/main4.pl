@@ -9,5 +9,5 @@ main(Argv) :-
 	read_term_from_atom(Cap, CapT, []),
 	read_term_from_atom(Start, StartT, []),
 	read_term_from_atom(End, EndT, []),
-	query4(StartT, EndT, CutoffN, CapT, Z),
-	print(Z).
+	limit_arg(Argv, 4, Limit),
+	stream_query(4, StartT, EndT, CutoffN, CapT, _, Limit).
@@ -11,5 +11,5 @@ main(Argv) :-
 	read_term_from_atom(Ext, ExtT, []),
 	read_term_from_atom(Start, StartT, []),
 	read_term_from_atom(End, EndT, []),
-	query5(StartT, EndT, CutoffN, CapT, ExtT, Z),
-	print(Z).
+	limit_arg(Argv, 5, Limit),
+	stream_query(5, StartT, EndT, CutoffN, CapT, ExtT, Limit).
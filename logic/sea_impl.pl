@@ -102,14 +102,9 @@ query2(A,B,C,Z) :-
 % DAC: based on different information flow
 % NOTE: we assume an edge exists already thus no checking on this
 % sub->obj and obj->sub, we have 2 different implementations
-% DAC_SUB_OBJ
-is_sub(A) :-
-	sub_db(all,L),
-	member(A,L).
-
-is_obj(A) :-
-	obj_db(all,L),
-	member(A,L).
+% NOTE: is_sub/1 and is_obj/1 are emitted as one fact per node together
+% with sub/7 and obj/7, so they are looked up through the first argument
+% index. The older sub_db/2 and obj_db/2 lists needed a member/2 scan.
 
 is_root(A) :-
 	sub(A,U,G,_,_,_,_),
@@ -217,12 +212,25 @@ dac_work([H|T],W,D) :-
 dac_proc(P,Z) :-
 	filter(dac_path,P,Z).
 
+% DAC graph traversal
+% Same as travel/5, but only follows the edges that passed dac/2 when the
+% facts were emitted (dac_edge/2). DAC only depends on the two ends of an
+% edge, so this gives the same paths as filtering with dac_path/1 without
+% checking every pair of every candidate path again.
+dac_travel(A,B,P,[B|P],_) :-
+	dac_edge(A,B).
+dac_travel(A,B,Visited,Path,Cut) :-
+	dac_edge(A,C),
+	C \== B,
+	\+member(C,Visited),
+	length(Visited,Len),
+	Len < Cut,
+	dac_travel(C,B,[C|Visited],Path,Cut).
+
 path3(A,B,C,Path) :-
-	travel(A,B,[A],Q,C),
+	dac_travel(A,B,[A],Q,C),
 	is_uniq(Q),	% NOTE: to workaround cycles in wildcard queries
-	reverse(Q,Q1),
-	dac_path(Q1),
-	Path = Q1.
+	reverse(Q,Path).
 
 query3(A,B,C,Z) :-
 	statistics(walltime, [TimeSinceStart | [TimeSinceLastCall]]),
@@ -276,11 +284,10 @@ cap_proc(P,C,Z) :-
 % D: capability (wildcard exponential) 
 % Z: paths (returned)
 path4(A,B,C,D,Path) :-
-        travel(A,B,[A],Q,C),
+        dac_travel(A,B,[A],Q,C),
         is_uniq(Q),     % NOTE: to workaround cycles in wildcard queries
         reverse(Q,Q1),
-        dac_path(Q1),
-	cap_path(Q1,D),
+	once(cap_path(Q1,D)),	% NOTE: cap_last/cap_prev may both succeed
         Path = Q1.
 
 query4(A,B,C,D,Z) :-
@@ -321,12 +328,11 @@ ext_proc(P,E,Z) :-
 % E: external attack surface
 % Z: paths (returned)
 path5(A,B,C,D,E,Path) :-
-        travel(A,B,[A],Q,C),
+        dac_travel(A,B,[A],Q,C),
         is_uniq(Q),     % NOTE: to workaround cycles in wildcard queries
         reverse(Q,Q1),
-        dac_path(Q1),
-        cap_path(Q1,D),
-	ext_path(Q1,E),
+        once(cap_path(Q1,D)),
+	once(ext_path(Q1,E)),	% NOTE: wildcard E matches every tag
         Path = Q1.
 
 query5(A,B,C,D,E,Z) :-
@@ -340,4 +346,79 @@ query5(A,B,C,D,E,Z) :-
 	%dac_proc(P,P1),
 	%cap_proc(P1,D,P2),
 	%ext_proc(P2,E,Z).
-	
+
+
+
+% Streaming query interface
+% Instead of collecting every path with findall/3 and printing one huge
+% list, print each path on its own line as soon as it is found:
+%
+%   s12 o345 s67	node ids separated by a space
+%   % count 3		metadata lines start with '% '
+%   % time 12		walltime in ms
+%
+% Every path is found exactly once (simple graph, filters wrapped in
+% once/1), so no sort/2 is needed to remove duplicates.
+print_path([H|T]) :-
+	write(H),
+	forall(member(X,T), (write(' '), write(X))),
+	nl.
+
+count_path :-
+	flag(path_count, N, N+1).
+
+% Limit 0 means no limit
+limit_reached(Limit) :-
+	Limit > 0,
+	flag(path_count, N, N),
+	N >= Limit.
+
+stream_paths(Goal, Path, Limit) :-
+	statistics(walltime, [_ | [_]]),
+	flag(path_count, _, 0),
+	(   call(Goal),
+	    print_path(Path),
+	    count_path,
+	    limit_reached(Limit)
+	->  true
+	;   true
+	),
+	flag(path_count, Len, Len),
+	statistics(walltime, [_ | [ExecutionTime]]),
+	write('% count '), write(Len), nl,
+	write('% time '), write(ExecutionTime), nl,
+	flush_output.
+
+% Level selects path2..path5, D and E are ignored by the levels that do
+% not use them
+level_path(2,A,B,C,_,_,Path) :-
+	path2(A,B,C,Path).
+level_path(3,A,B,C,_,_,Path) :-
+	path3(A,B,C,Path).
+level_path(4,A,B,C,D,_,Path) :-
+	path4(A,B,C,D,Path).
+level_path(5,A,B,C,D,E,Path) :-
+	path5(A,B,C,D,E,Path).
+
+% Iterative deepening over the cutoff: first every path of 1 edge, then
+% of 2 edges and so on, so the shortest paths come out first and a limit
+% can stop the search before the longer paths are enumerated
+shortest_path(Level,A,B,C,D,E,Path) :-
+	MaxCut is max(C,1),
+	between(1,MaxCut,Cut),
+	Len is Cut + 1,
+	level_path(Level,A,B,Cut,D,E,Path),
+	length(Path,Len).
+
+stream_query(Level,A,B,C,D,E,0) :-
+	!,
+	stream_paths(level_path(Level,A,B,C,D,E,X), X, 0).
+stream_query(Level,A,B,C,D,E,Limit) :-
+	stream_paths(shortest_path(Level,A,B,C,D,E,X), X, Limit).
+
+% Optional trailing limit argument of the inst binaries
+limit_arg(Argv, N, Limit) :-
+	(   nth0(N, Argv, L)
+	->  atom_number(L, Limit)
+	;   Limit = 0
+	).
@@ -0,0 +1,36 @@
+% Persistent query server
+%
+% Loads the facts and the SEA engine once and then answers one request
+% per line read from standard input, until end of file. This avoids
+% paying for process startup and fact loading on every query.
+%
+% Request:  query(Level, Start, End, Cutoff, Cap, Ext[, Limit]).
+%           Level is 2-5 and selects query2..query5. Cap and Ext are
+%           ignored by the levels that do not use them. With a Limit
+%           above 0 the shortest paths are returned first and the
+%           search stops after Limit paths.
+% Response: the same streamed output as the matching inst binary (see
+%           stream_paths/2), followed by a line containing only
+%           `end_of_result`.
+
+:- initialization(main, main).
+
+main(_) :-
+	prompt(_, ''),
+	repeat,
+	read_term(user_input, Request, []),
+	(   Request == end_of_file
+	->  !
+	;   (   catch(serve(Request), E, (print_message(error, E), fail))
+	    ->  true
+	    ;   true
+	    ),
+	    write(end_of_result), nl,
+	    flush_output,
+	    fail
+	).
+
+serve(query(Level, A, B, C, D, E)) :-
+	serve(query(Level, A, B, C, D, E, 0)).
+serve(query(Level, A, B, C, D, E, Limit)) :-
+	stream_query(Level, A, B, C, D, E, Limit).
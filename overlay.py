@@ -1,5 +1,6 @@
 import logging
 import os
+import time
 import networkx as nx
 import copy
 import re
@@ -8,8 +9,10 @@ from IPython import embed
 from fnmatch import fnmatch
 
 from android.dac import Cred, AID_MAP, AID_MAP_INV
-from android.sepolicy import SELinuxContext
+from android.sepolicy import SELinuxContext, index_policy
 from android.capabilities import Capabilities
+from util.timer import StepTimer
+from sematrix import PolicyMatrices
 
 log = logging.getLogger(__name__)
 
@@ -255,6 +258,14 @@ class SEPolicyInst(object):
         # Fully instantiated graph
         self.processes = {}
 
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+
+        # db/inst saved before the policy carried its PolicyIndex
+        if self.sepolicy is not None and "index" not in self.sepolicy:
+            log.info("Indexing the SEPolicy of an older db/inst")
+            index_policy(self.sepolicy)
+
     def instantiate(self, draw_graph=False, expand_obj=False, skip_fileless=False):
         """
         Recreate a running system's state from a combination of MAC and DAC policies.
@@ -409,66 +420,11 @@ class SEPolicyInst(object):
         return node
 
     def get_dataflow_direction(self, edge):
-        # We consider binder:call and *:ioctl to be bi-directional
-
-        # ignore fd:use for now
-        # we ignore getattr as this is not security sensitive enough
-        # ignore DRMservice for now (pread)
-
-        # TODO: handle class key*
-        # TODO: handle class security
-        # TODO: handle class filesystem
-        # TODO: handle class system
-        read_types = [
-            'read', 'ioctl', 'unix_read', 'search',
-            'recv', 'receive', 'recv_msg',  'recvfrom', 'rawip_recv', 'tcp_recv', 'dccp_recv', 'udp_recv',
-            'nlmsg_read', 'nlmsg_readpriv',
-            # Android specific
-            'call', # binder
-            'list', # service_manager
-            'find', # service_manager
-        ]
-
-        # ignore setattr for now. ignore create types
-        write_types = [
-            'write', 'append',
-            #'ioctl',
-            'add_name', 'unix_write', 'enqueue',
-            'send', 'send_msg',  'sendto', 'rawip_send', 'tcp_send', 'dccp_send', 'udp_send',
-            'connectto',
-            'nlmsg_write',
-            # Android specific
-            'call', # binder
-            #'transfer', # binder
-            'set', # property_service
-            'add', # service_manager
-            'find', # service_manager - this is not necessarily a write type,
-                    #but why bother finding a service if you aren't going to send a message to it?
-            'ptrace',
-            'transition',
-        ]
-
-        # management types
-        manage_types = [
-            'create', 'open'
-        ]
-
-        teclass = edge["teclass"]
-        perms = edge["perms"]
-
-        has_read = False
-        has_write = False
-        has_manage = False
-
-        for perm in perms:
-            if perm in write_types:
-                has_write = True
-            if perm in read_types:
-                has_read = True
-            if perm in manage_types:
-                has_manage = True
-
-        return has_read, has_write, has_manage
+        """
+        (read, write, manage) of an allow edge, from the permission masks of
+        its class (see android.sepolicy.READ_PERMS and friends)
+        """
+        return self.sepolicy["index"].dataflow(edge)
 
     def gen_file_mapping(self):
         """
@@ -504,6 +460,7 @@ class SEPolicyInst(object):
 
     def recover_subject_hierarchy(self):
         G = self.sepolicy["graphs"]["allow"]
+        index = self.sepolicy["index"]
         Gt = self.sepolicy["graphs"]["transition"]
 
         self.gen_file_mapping()
@@ -550,7 +507,7 @@ class SEPolicyInst(object):
             for child in node:
                 for _, edge in G[subject_name][child].items():
                     if edge["teclass"] == "process" and \
-                            ("dyntransition" in edge["perms"] or "transition" in edge["perms"]) and \
+                            index.has_perm(edge, "dyntransition", "transition") and \
                             subject_name != child:
 
                         # We may have already caught this during the file mapping, but that's why
@@ -625,6 +582,7 @@ class SEPolicyInst(object):
 
     def extract_selinux_capabilities(self):
         G = self.sepolicy["graphs"]["allow"]
+        index = self.sepolicy["index"]
 
         for subject_name, subject in self.subjects.items():
             for obj_name in G[subject_name]:
@@ -639,7 +597,7 @@ class SEPolicyInst(object):
                                 edge['teclass'], subject_name, ", ".join(edge["perms"]), obj_name)
                         continue
 
-                    for cap in edge["perms"]:
+                    for cap in index.perms(edge["teclass"], edge["perm_mask"]):
                         subject.cred.cap.add("selinux", cap)
 
     def gen_process_tree(self):
@@ -650,6 +608,7 @@ class SEPolicyInst(object):
         simulation.
         """
         G = self.sepolicy["graphs"]["allow"]
+        index = self.sepolicy["index"]
         self.processes = {}
 
         # Start from the top of hierarchy
@@ -699,13 +658,13 @@ class SEPolicyInst(object):
                 transition = False
 
                 if fc.type in G[parent_process.subject.sid.type]:
-                    exec_rule_parent = "execute_no_trans" in G[parent_process.subject.sid.type][fc.type][0]
+                    exec_rule_parent = index.has_perm(G[parent_process.subject.sid.type][fc.type][0], "execute_no_trans")
                 if fc.type in G[child_subject.sid.type]:
-                    exec_rule_child = "execute_no_trans" in G[child_subject.sid.type][fc.type][0]["perms"]
+                    exec_rule_child = index.has_perm(G[child_subject.sid.type][fc.type][0], "execute_no_trans")
                 if child_subject.sid.type in G[parent_process.subject.sid.type]:
-                    parent_child_edge = G[parent_process.subject.sid.type][child_subject.sid.type][0]["perms"]
-                    dyntransition = "dyntransition" in parent_child_edge
-                    transition = "transition" in parent_child_edge
+                    parent_child_edge = G[parent_process.subject.sid.type][child_subject.sid.type][0]
+                    dyntransition = index.has_perm(parent_child_edge, "dyntransition")
+                    transition = index.has_perm(parent_child_edge, "transition")
 
                 # if only dyntransitions, child exe doesn't change, so make sure child processes respect that
                 if dyntransition and not transition:
@@ -1410,10 +1369,18 @@ Groups:\t%s
         log.info("Flattening subject graph...")
 
         GS = self.sepolicy["graphs"]["dataflow"]
-        obj_refs = nx.get_node_attributes(GS, 'obj')
-        edge_refs = nx.get_edge_attributes(GS, 'ty')
+        group_names = set([x.get_node_name() for x in self.subject_groups.values()])
+
+        # Build the flattened graph directly instead of copying GS and
+        # deleting the subject groups afterwards. Nodes, edges, keys and
+        # their order come out the same as with GS.copy().
+        GS_flat = nx.MultiDiGraph()
+        GS_flat.graph.update(GS.graph)
+        GS_flat.add_nodes_from([(n, d.copy()) for n, d in GS.nodes(data=True) if n not in group_names])
+        GS_flat.add_edges_from([(u, v, k, d.copy()) for u, v, k, d in GS.edges(keys=True, data=True)
+            if u not in group_names and v not in group_names])
 
-        GS_flat = GS.copy()
+        member_edges = []
 
         # Flatten all subject groups into each domain member
         for sn, subject in self.subject_groups.items():
@@ -1422,23 +1389,21 @@ Groups:\t%s
             member_domains = []
 
             for u, v, e in in_edges:
-                if obj_refs[u].get_obj_type() == "subject":
-                    if obj_refs[u].sid.type in self.subject_groups:
+                if GS.nodes[u]["obj"].get_obj_type() == "subject":
+                    if GS.nodes[u]["obj"].sid.type in self.subject_groups:
                         raise ValueError("Crap subject groups linked: %s -> %s" % (u, v))
                     member_domains += [u]
 
+            # the objects the group reads from and writes to, once per group
+            read_objs = [u for u, _, _ in in_edges if not u.startswith("subject")]
+            write_objs = [v for u, v, k in out_edges if GS.edges[u, v, k]['ty'] == 'write']
+
             # Copy all edges from subject_group to domain
             for member in member_domains:
-                in_edges_member = list(filter(lambda x: not x[0].startswith("subject"), in_edges))
-                out_edges_member = list(filter(lambda x: edge_refs[x] == 'write', out_edges))
-
-                in_edges_member = list(map(lambda x: (x[0], member), in_edges_member))
-                out_edges_member = list(map(lambda x: (member, x[1]), out_edges_member))
-                GS_flat.add_edges_from(in_edges_member)
-                GS_flat.add_edges_from(out_edges_member)
+                member_edges += [(u, member) for u in read_objs]
+                member_edges += [(member, v) for v in write_objs]
 
-        # Finally delete all the subject groups
-        GS_flat.remove_nodes_from(list(map(lambda x: x.get_node_name(), self.subject_groups.values())))
+        GS_flat.add_edges_from(member_edges)
 
         """
               [SubD]                       [SubD] (w.r.t)
@@ -1578,9 +1543,17 @@ Groups:\t%s
 
         log.info("Using %d/%d processes", len(running_proc), len(self.processes))
 
+        # owner processes of each type, in running_proc order
+        procs_by_type = {}
+        for proc in running_proc:
+            if proc.sid is not None:
+                procs_by_type.setdefault(proc.sid.type, []).append(proc)
+
         GG = nx.DiGraph()
 
         obj_inst = {}
+        obj_nodes = []
+        seen = set()
 
         ### fully inflate all objects
         for node in FL.nodes():
@@ -1621,10 +1594,11 @@ Groups:\t%s
                         name += "_alias"
 
                     assert name not in obj_inst[node_name]
-                    assert name not in GG
+                    assert name not in seen
 
                     obj_inst[node_name][name] = new_fo
-                    GG.add_node(name, obj=new_fo)
+                    obj_nodes += [(name, {"obj": new_fo})]
+                    seen.add(name)
             elif ty == "ipc":
 
                 if not ref.owner:
@@ -1636,7 +1610,7 @@ Groups:\t%s
                     continue
 
                 # find all owner processes
-                owner_proc = list(filter(lambda x: x.sid.type == ref.owner.sid.type, running_proc))
+                owner_proc = procs_by_type.get(ref.owner.sid.type, [])
 
                 if len(owner_proc) == 0:
                     log.warning("Dropping IPC %s as no RUNNING owners", ref)
@@ -1655,21 +1629,32 @@ Groups:\t%s
                     name = "%s_%d" % (node_name, instid)
 
                     assert name not in obj_inst[node_name]
-                    assert name not in GG
+                    assert name not in seen
 
-                    GG.add_node(name, obj=new_ipc)
+                    obj_nodes += [(name, {"obj": new_ipc})]
+                    seen.add(name)
                     obj_inst[node_name][name] = new_ipc
             else:
                 assert 0
 
+        GG.add_nodes_from(obj_nodes)
+
         cnt = 0
         dropped = 0
 
+        # (read, write, dropped) object instances of each subject, shared by
+        # all of its processes
+        subject_edges = {}
+        edges = []
+        read = {"ty": "read"}
+        write = {"ty": "write"}
+
         # okay all objects in graph PERFORM THE JOINING!!!!
         for proc in running_proc:
             node_name = proc.get_node_name()
-            assert node_name not in GG
+            assert node_name not in seen
             GG.add_node(node_name, obj=proc)
+            seen.add(node_name)
             subject = proc.subject
             subject_nn = subject.get_node_name()
 
@@ -1680,38 +1665,40 @@ Groups:\t%s
                 log.warning("Not fully inst. %s", subject_nn)
                 continue
 
-            FL[subject_nn]
-            ie = FL.in_edges(subject_nn) # O -> S (read)
-            oe = FL.out_edges(subject_nn) # S -> O (write)
+            if subject_nn not in subject_edges:
+                readable = []
+                writable = []
+                subject_dropped = 0
 
-            # in_edges('subject:atfwd') (file:usb_device_w, _)
+                for o, _ in FL.in_edges(subject_nn): # O -> S (read)
+                    # object was dropped!
+                    if o not in obj_inst:
+                        subject_dropped += 1
+                        continue
 
-            nbefore = len(GG.nodes())
+                    readable += list(obj_inst[o])
 
-            log.info("%s", proc)
-            for o, s in ie:
-                # object was dropped!
-                if o not in obj_inst:
-                    dropped += 1
-                    #log.warn("%s dropped", o)
-                    continue
+                for _, o in FL.out_edges(subject_nn): # S -> O (write)
+                    if o not in obj_inst:
+                        subject_dropped += 1
+                        continue
 
-                for subobname, subob in obj_inst[o].items():
-                    cnt += 1
-                    GG.add_edge(subobname, node_name, ty="read")
+                    writable += list(obj_inst[o])
 
-            for s, o in oe:
-                # object was dropped!
-                if o not in obj_inst:
-                    dropped += 1
-                    #log.warn("%s dropped", o)
-                    continue
+                subject_edges[subject_nn] = (readable, writable, subject_dropped)
 
-                for subobname, subob in obj_inst[o].items():
-                    cnt += 1
-                    GG.add_edge(node_name, subobname, ty="write")
+            readable, writable, subject_dropped = subject_edges[subject_nn]
 
-            assert len(GG.nodes()) == nbefore
+            log.info("%s", proc)
+
+            edges += [(subobname, node_name, read) for subobname in readable]
+            edges += [(node_name, subobname, write) for subobname in writable]
+            cnt += len(readable) + len(writable)
+            dropped += subject_dropped
+
+        nbefore = len(GG)
+        GG.add_edges_from(edges)
+        assert len(GG) == nbefore
 
         num_edges = len(GG.edges())
         edge_inflation = float(num_edges) / len(FL.edges())
@@ -1731,12 +1718,20 @@ Groups:\t%s
         them in a graph based off of dataflow.
         """
         G = self.sepolicy["graphs"]["allow"]
+        index = self.sepolicy["index"]
         Gt = self.sepolicy["graphs"]["transition"]
 
+        timer = StepTimer()
+        stime = time.time()
+
         # Create our dataflow graph
         GS = self.sepolicy["graphs"]["dataflow"] = nx.MultiDiGraph()
 
         self.objects = {}
+        objects_created = 0
+
+        with timer.step("service_manager owner index"):
+            add_owners = self.add_permission_owners()
 
         for _, s in self.subjects.items():
             if skip_fileless_subjects and len(s.backing_files) == 0:
@@ -1759,6 +1754,9 @@ Groups:\t%s
                 # add a is-a edge between the subjects as they are effectively the same
                 GS.add_edge(self.subjects[domain].get_node_name(), s.get_node_name())
 
+        timer.add("subjects and groups", time.time()-stime)
+        stime = time.time()
+
         # TODO: handle actions applied attributes containing domains
         #for subject_name, subject in self.subjects.items():
         for subject_name in list(self.subjects) + self.domain_attributes:
@@ -1790,7 +1788,7 @@ Groups:\t%s
                             continue
                         elif edge["teclass"] == "process":
                             if subject_name != obj_name and \
-                                    "ptrace" in edge["perms"]:
+                                    index.has_perm(edge, "ptrace"):
                                 # TODO: might be interesting to trace which subjects
                                 # can ptrace each other
                                 pass
@@ -1798,7 +1796,7 @@ Groups:\t%s
                             continue
                         elif edge["teclass"] == "process":
                             if subject_name != obj_name and \
-                                    "ptrace" in edge["perms"]:
+                                    index.has_perm(edge, "ptrace"):
                                 # TODO: might be interesting to trace which subjects
                                 # can ptrace each other
                                 pass
@@ -1830,8 +1828,11 @@ Groups:\t%s
                     else:
                         object_expansion = [obj_name]
 
-                    for ty in object_expansion:
-                        new_obj = copy.deepcopy(obj)
+                    for i, ty in enumerate(object_expansion):
+                        # a fresh node per type, like obj (which is still
+                        # untouched and can be used for the first one)
+                        new_obj = obj if i == 0 else self.get_object_node(edge)
+                        objects_created += 1
                         new_obj.sid = SELinuxContext.FromString("u:object_t:%s:s0" % ty)
                         obj_type = new_obj.get_obj_type()
 
@@ -1840,23 +1841,14 @@ Groups:\t%s
                                 new_obj.owner = self.subjects[ty]
                             else:
                                 if new_obj.ipc_type.endswith("service_manager"):
-                                    found_ipc_owner = False
-
-                                    # find all vectors to this type
-                                    for source, target in G.in_edges(self.actualize(new_obj.sid.type)):
-                                        for _, obj_edge in G[source][target].items():
-                                            # find any that have the add permission
-                                            if "add" in obj_edge["perms"]:
-                                                # expand - hal_graphics_allocator_server 9.0
-                                                # XXX: just take the first owner we see...
-                                                source_type = self.expand_attribute(source)[0]
-
-                                                new_obj.owner = self.subjects[source_type]
-
-                                                found_ipc_owner = True
-                                                break
-
-                                        if found_ipc_owner:
+                                    # find all vectors to this type with the add permission
+                                    for target in self.actualize(new_obj.sid.type):
+                                        if target in add_owners:
+                                            # expand - hal_graphics_allocator_server 9.0
+                                            # XXX: just take the first owner we see...
+                                            source_type = self.expand_attribute(add_owners[target])[0]
+
+                                            new_obj.owner = self.subjects[source_type]
                                             break
                                 elif new_obj.ipc_type == "property_service":
                                     new_obj.owner = self.subjects["init"]
@@ -1912,6 +1904,29 @@ Groups:\t%s
                             # if df_m and 'manage' not in edge_types:
                             #     GS.add_edge(domain_name, obj_node_name, ty="manage", color='purple')
 
+        timer.add("objects", time.time()-stime)
+        timer.report(log, "inflate_graph timings")
+
+        log.info("Created %d objects (%d unique) with %d dataflow edges",
+                objects_created, len(self.objects), len(GS.edges()))
+
+    def add_permission_owners(self):
+        """
+        {type: the first type with the add permission on it}, in the order of
+        G.in_edges(type), for finding the owners of service_manager objects
+        """
+        G = self.sepolicy["graphs"]["allow"]
+        index = self.sepolicy["index"]
+        owners = {}
+
+        for target in G:
+            for source, edges in G.pred[target].items():
+                if any([index.has_perm(edge, "add") for edge in edges.values()]):
+                    owners[target] = source
+                    break
+
+        return owners
+
     def stats(self):
         log.info("------- STATS --------")
         log.info("---[File Contexts Report]---")
@@ -1968,8 +1983,18 @@ Groups:\t%s
 
         log.info("------- END STATS --------")
 
+    def access_matrices(self):
+        """The type-level PolicyMatrices of the policy, built on first use"""
+        matrices = getattr(self, "_access_matrices", None)
+
+        if matrices is None:
+            matrices = self._access_matrices = PolicyMatrices(self.sepolicy)
+
+        return matrices
+
     def path_query(self, source, target, length=None):
         G = self.sepolicy["graphs"]["allow"]
+        matrices = self.access_matrices()
 
         if source in self.sepolicy["aliases"]:
             source_new = self.sepolicy["types"][source]
@@ -1988,10 +2013,8 @@ Groups:\t%s
         elif source in self.sepolicy["types"]:
             print("%s is a type" % source)
 
-            for attr, types in self.sepolicy["attributes"].items():
-                # add all attributes as sources, only if they appear in the access matrix
-                if source in types:
-                    source_nodes += [attr]
+            # add all attributes as sources, only if they appear in the access matrix
+            source_nodes += matrices.attributes_of(source)
         else:
             print("%s is an invalid type" % source)
             return
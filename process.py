@@ -10,6 +10,8 @@ import json
 
 import networkx as nx
 from prolog import Prolog
+from engine import instgraph, manifest
+from engine.policycache import PolicyGraphCache
 from config import *
 from security_policy import ASPCodec, AndroidSecurityPolicy
 from android.file_contexts import read_file_contexts
@@ -128,11 +130,20 @@ def main():
             fp.write(inst.list_processes())
             
     if args.compile_prolog or args.prolog:
-        G = inst.fully_instantiate()
+        if args.load or args.save:
+            # inst is the one in db/inst, so its graph can be reused
+            inst, G = instgraph.load(aspc.db_dir, inst)
+        else:
+            G = inst.fully_instantiate()
 
         pl = Prolog(G, aspc.db_dir, inst, asp)
 
         is_compiled = pl.compile_all()
+
+        # only describes db/ if the facts came from db/inst
+        if is_compiled and (args.load or args.save):
+            manifest.DbManifest(aspc.db_dir).record("prolog")
+
         if is_compiled and args.prolog:
             pl.interact()
        
@@ -230,18 +241,15 @@ def main_process(args, asp, aspc, file_contexts, primary_filesystem, android_ver
         if args.save_policy:
             policy = SELinuxPolicyDump(sepolicy)
             log.info("Saving sepolicy.txt")
-            policy_fp = open(os.path.join(aspc.results_dir, "sepolicy.txt"), 'w')
-            policy_fp.write(str(policy))
-            policy_fp.close()
+            with open(os.path.join(aspc.results_dir, "sepolicy.txt"), 'w') as policy_fp:
+                policy.dump(policy_fp)
 
-        policy_graph = SELinuxPolicyGraph(sepolicy)
+        policy_cache = PolicyGraphCache(POLICY_GRAPH_CACHE_DIR, POLICY_GRAPH_CACHE_MAX_BYTES)
+        graph = policy_cache.build_graph(sepolicy, SELinuxPolicyGraph)
     except OSError:
         log.error("Unable to load SEAndroid policy file. Use --debug for more details")
         return 1
 
-    log.info("Building SEPolicy graph")
-    graph = policy_graph.build_graph()
-
     log.info("Created SEPolicy graph with %d nodes and %d edges",
              len(graph["graphs"]["allow"].nodes()), len(graph["graphs"]["allow"].edges()))
 
@@ -269,6 +277,7 @@ def main_process(args, asp, aspc, file_contexts, primary_filesystem, android_ver
         #inst.init = None
         #inst.file_mapping = {}
         aspc._save_db(inst, "inst")
+        manifest.DbManifest(aspc.db_dir).record("inst")
 
     return inst
 
@@ -2,24 +2,91 @@ import logging
 import time
 import shlex
 import readline
-import re
 import os
 import sys
 import networkx as nx
 import glob
 import pickle
 import hashlib
+import heapq
 import shutil
+import tempfile
 import pprint
 import overlay
+import sematrix
+
+from engine import cache, csr, plserver, strength
+from engine.results import MalformedResultError, read_process
+from engine.dac import DacNode, SUBJECT, OBJECT, dac
+from engine.graph import FactGraph
+from engine.paths import PathEngine, WILDCARDS
+from engine.reach import ReachIndex
+from engine.count import PathCounter, top_counts, MAX_COUNT
+from engine.surface import AttackSurface
 
 from android.capabilities import Capabilities
+from util.timer import StepTimer
 from subprocess import Popen, PIPE, STDOUT
+from concurrent.futures import ThreadPoolExecutor
 
 log = logging.getLogger(__name__)
 
 HISTORY_FILENAME = ".query_history"
 FACTS_OUTPUT_FILE = 'facts.pl'
+# key=value options accepted by query and query_mac
+QUERY_OPTIONS = ["limit", "max_length"]
+# number of paths shown by `print more` if no previous page size is known
+PRINT_PAGE_SIZE = 50
+# nodes listed per table by `count`
+COUNT_TOP = 10
+
+def write_file_atomic(path, data):
+    tmp_path = path + ".tmp"
+
+    with open(tmp_path, 'w') as fp:
+        fp.write(data)
+
+    os.replace(tmp_path, path)
+
+class FactsWriter(object):
+    """
+    Writes the facts to a temporary file next to path and hashes them on
+    the way. commit() renames the file into place, discard() removes it.
+    """
+    def __init__(self, path):
+        self.path = path
+        fd, self.tmp_path = tempfile.mkstemp(prefix=".facts-", suffix=".pl",
+                dir=os.path.dirname(os.path.abspath(path)))
+        self.fp = os.fdopen(fd, 'wb')
+        self.sha256 = hashlib.sha256()
+
+    def write(self, data):
+        data = data.encode('ascii')
+        self.sha256.update(data)
+        self.fp.write(data)
+
+    def hexdigest(self):
+        return self.sha256.hexdigest()
+
+    def close(self):
+        if not self.fp.closed:
+            self.fp.close()
+
+    def commit(self):
+        self.close()
+        os.replace(self.tmp_path, self.path)
+
+    def discard(self):
+        self.close()
+
+        try:
+            os.unlink(self.tmp_path)
+        except OSError:
+            pass
+
+def path_order(path):
+    """Sort key of query results: shortest first, then by node ids"""
+    return (len(path), path)
 
 class Prolog(object):
     def __init__(self, G, save_dir, inst, asp):
@@ -36,9 +103,16 @@ class Prolog(object):
         self.db_dir = save_dir
         self.inst_map_path = os.path.join(self.db_dir, 'inst-map')
         self.facts_path = os.path.join(self.db_dir, FACTS_OUTPUT_FILE)
+        self.facts_hash_path = self.facts_path + cache.FACTS_HASH_SUFFIX
         self.saved_queries_path = os.path.join(self.db_dir, "saved_queries")
+        self.dac_report_path = os.path.join(self.db_dir, "dac-pruned")
 
         self.mac_only = False
+        # "prolog" (inst binaries / query server) or "native" (engine.paths)
+        self.engine = "prolog"
+        self.path_engine = None
+        self.reach_index = None
+        self.query_cache = cache.QueryCache(self.db_dir, self.facts_path)
         self.special_file_map = {
             "all": 0,
             "usb": 1,
@@ -54,10 +128,20 @@ class Prolog(object):
             "nfc": [],
         }
         self.sub_trusted = []
+        # (result, next start, page size) of the last `print N`
+        self.print_page = None
+        # graph edges that fail dac/2 and are left out of dac_edge/2
+        self.dac_pruned = []
 
         self.commands = [
                 {'name' : 'query', 'handler': self.query},
                 {'name' : 'query_mac', 'handler': self.query_mac_only},
+                {'name' : 'engine', 'handler': self.set_engine},
+                {'name' : 'cache', 'handler': self.cache_info},
+                {'name' : 'reach', 'handler': self.reach},
+                {'name' : 'count', 'handler': self.count_paths},
+                {'name' : 'access', 'handler': self.type_access},
+                {'name' : 'flow', 'handler': self.type_flow},
                 {'name' : 'print', 'handler': self.print_paths},
                 {'name' : 'print_ipc', 'handler': self.print_ipc_paths},
                 {'name' : 'print_trust', 'handler': self.print_trust_paths},
@@ -75,19 +159,32 @@ class Prolog(object):
         ]
 
     def query_attack_surface(self, args):
-        target = args[0]
+        if len(args) < 1:
+            log.error("Attack surface needs at least one target")
+            return
 
-        self.result = []
-        self.query(["_", target, "1"])
-        result_1 = self.result.copy()
+        targets = []
+        for target in args:
+            pltarget, _ = self.node_lookup(target)
+
+            if not pltarget:
+                log.error("Unable to lookup target node %s", target)
+                return
+
+            targets += [pltarget]
+
+        # the predecessor index is built once and shared by all targets
+        surfaces = AttackSurface(self._native_engine().graph).paths_many(targets)
 
         self.result = []
-        self.query(["_", target, "2"])
-        result_2 = self.result.copy()
+        for target, pltarget in zip(args, targets):
+            if len(args) > 1:
+                print("Target %s" % target)
 
-        diff_result = self._diff(result_1, result_2, "right", return_rendered=False)
-        self.result = diff_result
+            self._print_attack_surface(surfaces[pltarget])
+            self.result += surfaces[pltarget]
 
+    def _print_attack_surface(self, diff_result):
         uniq_procs = set()
         uniq_ipc = set()
         uniq_types = set()
@@ -135,72 +232,22 @@ class Prolog(object):
 
 
     def print_strongest(self, args):
-        results = {}
-        count = 0
-
         sort_key = 1 # sort by nobj by default 
         if args:
             obj_type_str = args[0].lower().strip()
 
-            OBJ_TYPE_IX = {"type": 0, "obj": 1, "ipc": 2, "file": 3, "type_strength": 4}
+            OBJ_TYPE_IX = strength.STRENGTH_KEYS
             if obj_type_str not in OBJ_TYPE_IX:
                 log.error("Invalid strength sort key '%s' Valid options are %s" % (obj_type_str, list(OBJ_TYPE_IX.keys())))
                 return
 
             sort_key = OBJ_TYPE_IX[obj_type_str]
 
-        type_freq = {}
-        # frequency of occurence of an object type
-        # might be interesting to use this as an indicator of strength
-        # then sort objects by the combined strength of the types it has access to
-        # intuitively types with less objects that can access them are stronger...
-        intermediate_results = {}
-        for pn, p in self.inst.processes.items():
-            name = p.get_node_name()
-            self.result = []
-            log.setLevel(logging.WARNING)
-            self.query([name, "_", "1"])
-            log.setLevel(logging.INFO)
-
-            if len(self.result) > 0:
-                uniq_types = set()
-                obj_types = {"ipc": [], "file": []}
-
-                for path in self.result:
-                    target = path[1]
-                    obj = self.node_objs[self.node_id_map_inv[target]]
-                    if obj.sid.type not in uniq_types:
-                        uniq_types.add(obj.sid.type)
-                        
-                        type_freq[obj.sid.type] = type_freq.get(obj.sid.type, 0)
-                        if not (isinstance(obj, overlay.IPCNode) and obj.owner == p):
-                            type_freq[obj.sid.type] += 1
-
-                    if isinstance(obj, overlay.IPCNode):
-                        obj_types["ipc"].append(obj)
-
-                    elif isinstance(obj, overlay.FileNode):
-                        obj_types["file"].append(obj)
-
-                intermediate_results[name] = [uniq_types, len(self.result), obj_types["ipc"],
-                        obj_types["file"]]
-
-            count += 1
-
-            if count % 10 == 0:
-                print("Progress %d/%d" % (count, len(self.inst.processes)))
-
-        for node_name, res in intermediate_results.items():
-            uniq_types = res[0]
-            n_uniq_type = len(uniq_types)
-            n_obj = res[1]
-            n_ipc = len(res[2])
-            n_file = len(res[3])
-            type_strength = sum(1 / type_freq[t] for t in uniq_types if type_freq[t] != 0)
-
-            results[node_name] = [n_uniq_type, n_obj, n_ipc, n_file, type_strength]
-        
-        results = sorted(list(results.items()), key=lambda x: (x[1][sort_key], x[1][1]), reverse=True)
+        # every process at once from the DAC filtered adjacency (see engine.strength)
+        results = strength.process_strengths(self._native_engine().graph,
+                self.inst.processes.values(), self.node_id_map, self.node_objs)
+        results = strength.rank_strengths(results, sort_key)
+
         for i, res in enumerate(results):
             print("%3d: ntype=%-5d nobj=%-5d ipc=%-5d file=%-5d str=%-5.2f %s" % (i+1,
                 res[1][0], res[1][1], res[1][2], res[1][3], res[1][4], res[0]))
@@ -212,37 +259,75 @@ class Prolog(object):
         self.node_id_map_inv = dict([[v,k] for k,v in self.node_id_map.items()])
 
     def save_node_map(self):
-        with open(self.inst_map_path, 'wb') as fp:
+        # write-then-rename so a reader never sees a partial map
+        tmp_path = self.inst_map_path + ".tmp"
+
+        with open(tmp_path, 'wb') as fp:
             pickle.dump(self.node_id_map, fp)
 
+        os.replace(tmp_path, self.inst_map_path)
+
+    def save_graph_export(self, facts_hash):
+        """Write db/facts.csr, unless it is already up to date with the facts"""
+        path = csr.csr_path(self.facts_path)
+
+        try:
+            if csr.read_header(path)["facts_sha256"] == facts_hash:
+                return
+        except (csr.CsrFormatError, IOError):
+            pass
+
+        graph = FactGraph.from_facts(self.facts_path)
+
+        try:
+            csr.save_csr(graph, path, facts_hash)
+        except IOError as e:
+            log.warning("Failed to export the graph to %s: %s", path, e)
+
+        # the native engine can use the graph we just loaded
+        self.path_engine = PathEngine(graph)
+
     def compile_all(self):
-        new_facts = self._emit_facts()
+        timer = StepTimer()
 
-        if not new_facts:
-            log.error("Failed to emit facts")
-            return False
+        # the facts are streamed to a temporary file and hashed on the way,
+        # they are never held in memory as a whole
+        writer = FactsWriter(self.facts_path)
 
         try:
-            with open(self.facts_path, 'r') as fp:
-                old_facts = fp.read()
-        except IOError:
-            old_facts = ""
+            with timer.step("emit facts"):
+                emitted = self._emit_facts(writer)
 
-        new_facts_sha256 = hashlib.sha256(new_facts.encode('ascii')).digest()
-        old_facts_sha256 = hashlib.sha256(old_facts.encode('ascii')).digest()
-        recompile = False
+            writer.close()
+        except:
+            writer.discard()
+            raise
 
-        if old_facts_sha256 != new_facts_sha256:
+        if not emitted:
+            writer.discard()
+            log.error("Failed to emit facts")
+            return False
+
+        stime = time.time()
+        if cache.stored_facts_hash(self.facts_path) != writer.hexdigest():
             log.info("Facts have changed! Recompiling prolog helpers...")
 
-            with open(FACTS_OUTPUT_FILE, 'w') as fp:
-                fp.write(new_facts)
+            writer.commit()
+            write_file_atomic(self.facts_hash_path, writer.hexdigest())
 
-            # save a copy of the facts to make sure they stay in sync
-            shutil.copyfile(FACTS_OUTPUT_FILE, self.facts_path)
+            # keep a copy in the current directory, like before
+            shutil.copyfile(self.facts_path, FACTS_OUTPUT_FILE)
 
             self.save_node_map()
-            recompile = True
+            self.save_dac_report()
+            self.path_engine = None
+        else:
+            writer.discard()
+
+        timer.add("hash and write facts", time.time()-stime)
+
+        with timer.step("export graph"):
+            self.save_graph_export(writer.hexdigest())
 
         # make sure we can load the node map
         try:
@@ -259,14 +344,86 @@ class Prolog(object):
                 log.error("Permanently failed to load the prolog node map file %", e)
                 return False
 
+        # Load the facts from a .qlf compiled once instead of having every
+        # binary parse facts.pl again
+        with timer.step("qcompile facts"):
+            facts_input = self.qcompile_facts()
+
+        jobs = []
         for q in range(2, 6):
             name = os.path.join(self.db_dir, "inst%d" % q)
-            if not self.compile(name, [FACTS_OUTPUT_FILE, 'logic/main%d.pl' % q, 'logic/sea_impl.pl']):
+            jobs += [(name, ['logic/main%d.pl' % q, 'logic/sea_impl.pl'], True)]
+
+        # The query server is optional: queries fall back to the binaries above
+        name = os.path.join(self.db_dir, plserver.SERVER_BINARY)
+        jobs += [(name, ['logic/server.pl', 'logic/sea_impl.pl'], False)]
+
+        with timer.step("compile binaries (parallel)"):
+            compiled = self.compile_many([(name, [facts_input] + inputs) for name, inputs, _ in jobs], timer)
+
+            # not every swipl can build a saved state from a .qlf
+            if facts_input != self.facts_path and not all(compiled):
+                log.warning("Compiling from %s failed, retrying with %s", facts_input, self.facts_path)
+                compiled = self.compile_many([(name, [self.facts_path] + inputs)
+                    for name, inputs, _ in jobs], timer)
+
+        timer.report(log, "Prolog compile timings")
+
+        for (name, _, required), ok in zip(jobs, compiled):
+            if ok:
+                continue
+
+            if required:
                 return False
 
+            log.warning("Failed to compile %s. Queries will be slower", name)
+
         return True
 
-    def compile(self, binary, inputs):
+    def qcompile_facts(self):
+        """
+        Compile the facts to facts.qlf next to facts.pl and return the file
+        the binaries should load the facts from
+        """
+        qlf_path = os.path.splitext(self.facts_path)[0] + ".qlf"
+        goal = "qcompile('%s')" % self.facts_path.replace("'", "\\'")
+        # halt exits with a non-zero status if the goal raised or any error
+        # was printed while loading the facts
+        cmdline = ["swipl", "--on-error=status", "-g", goal, "-g", "halt"]
+
+        proc = Popen(cmdline, stdout=PIPE, stderr=STDOUT)
+        stdout, _ = proc.communicate()
+
+        if proc.returncode != 0 or not os.path.isfile(qlf_path):
+            log.warning("Failed to qcompile the facts, compiling from %s", self.facts_path)
+
+            for line in stdout.decode().splitlines():
+                log.debug(line)
+
+            return self.facts_path
+
+        return qlf_path
+
+    def compile_many(self, jobs, timer=None):
+        """Run compile() for each (binary, inputs) at once, returns whether each succeeded"""
+        with ThreadPoolExecutor(max_workers=len(jobs)) as pool:
+            futures = [pool.submit(self.compile, binary, inputs, timer) for binary, inputs in jobs]
+            return [f.result() for f in futures]
+
+    def save_dac_report(self):
+        """
+        Write out the edges that were dropped from dac_edge/2 so that the
+        DAC pruning can be audited
+        """
+        with open(self.dac_report_path, 'w') as fp:
+            fp.write("# %d edges denied by DAC\n" % len(self.dac_pruned))
+
+            for u, v in self.dac_pruned:
+                fp.write("%s %s -> %s %s\n" % (self.node_id_map[u], u, self.node_id_map[v], v))
+
+        log.info("Saved DAC pruned edges to %s", self.dac_report_path)
+
+    def compile(self, binary, inputs, timer=None):
         log.info("Compiling prolog %s...", binary)
         cmdline = ["swipl", "--goal=main", "-o", binary, "-c"] + inputs
 
@@ -282,8 +439,8 @@ class Prolog(object):
             if "warning" in line.lower():
                 warning_lines += [line[9:]]
 
-        if len(error_lines):
-            log.info("Prolog failed to compile:")
+        if proc.returncode != 0 or len(error_lines):
+            log.info("Prolog failed to compile (exit status %d):", proc.returncode)
 
             # remove any binary that failed to compile
             try:
@@ -291,13 +448,17 @@ class Prolog(object):
             except OSError:
                 pass
 
-            for l in error_lines:
+            for l in error_lines or stdout.decode().splitlines():
                 log.error(l)
 
             return False
         else:
             log.info("Prolog successfully compiled to %s in %.2f seconds",
                     binary, time.time()-start)
+
+            if timer:
+                timer.add("  " + os.path.basename(binary), time.time()-start)
+
             return True
 
     def object_info(self, args):
@@ -367,18 +528,45 @@ class Prolog(object):
         self._pretty_print_results(cutoff=cutoff)
         self.result = tmp_result
 
+    def _print_page(self, args):
+        """
+        Parse the arguments of print/print_trust: nothing for every path,
+        N for the first N paths or `more` for the page after the last one
+        printed. Returns (start, count) or None on bad arguments.
+        """
+        if len(args) == 0:
+            self.print_page = None
+            return 0, None
+
+        if args[0] in ["more", "next"]:
+            result, start, count = self.print_page or (None, 0, PRINT_PAGE_SIZE)
+
+            # a new result starts from the top again
+            if result is not self.result:
+                start = 0
+        else:
+            try:
+                start, count = 0, int(args[0])
+            except ValueError:
+                return None
+
+        self.print_page = (self.result, start+count, count)
+
+        if start >= len(self.result):
+            print("No more results")
+
+        return start, count
+
     def print_paths(self, args):
         if not self.result:
             return
 
-        cutoff = None
-        if len(args) > 0:
-            try:
-                cutoff = int(args[0])
-            except ValueError:
-                return
+        page = self._print_page(args)
+        if page is None:
+            return
 
-        self._pretty_print_results(cutoff=cutoff)
+        start, cutoff = page
+        self._pretty_print_results(cutoff=cutoff, start=start)
         # for pathid, path in enumerate(sorted(self.result)):
         #     if cutoff is not None and (pathid+1 > cutoff):
         #         break
@@ -413,14 +601,12 @@ class Prolog(object):
         if not self.result:
             return
 
-        cutoff = None
-        if len(args) > 0:
-            try:
-                cutoff = int(args[0])
-            except ValueError:
-                return
+        page = self._print_page(args)
+        if page is None:
+            return
 
-        self._pretty_print_results(cutoff=cutoff, colorized=True)
+        start, cutoff = page
+        self._pretty_print_results(cutoff=cutoff, colorized=True, start=start)
         # for pathid, path in enumerate(sorted(self.result)):
         #     if cutoff is not None and (pathid+1 > cutoff):
         #         break
@@ -504,12 +690,17 @@ class Prolog(object):
         except IOError as e:
             log.error("Failed to save file: %s", e)
 
-    def _pretty_print_results(self, cutoff=None, colorized=False, file=sys.stdout):
+    def _pretty_print_results(self, cutoff=None, colorized=False, file=sys.stdout, start=0):
         n_lines_printed = 0
-        for pathid, path in enumerate(sorted(self.result)):
-            if cutoff is not None and (pathid+1 > cutoff):
-                break
 
+        # only order and render the paths that are shown, shortest first
+        # like query() stores them
+        if cutoff is None:
+            paths = sorted(self.result, key=path_order)
+        else:
+            paths = heapq.nsmallest(start+cutoff, self.result, key=path_order)
+
+        for pathid, path in enumerate(paths[start:], start):
             pretty_path = self._render_path(path, colorized=colorized)
             print("%d: %s" % (pathid+1, pretty_path), file=file)
             n_lines_printed += 1
@@ -703,12 +894,290 @@ class Prolog(object):
 
         return plnode, pretty
 
+    def set_engine(self, args):
+        if len(args) < 1:
+            print("Query engine: %s" % self.engine)
+            return
+
+        if args[0] not in ["prolog", "native"]:
+            log.error("Invalid engine '%s'. Valid options are prolog and native", args[0])
+            return
+
+        self.engine = args[0]
+        log.info("Using the %s query engine", self.engine)
+
+    def cache_info(self, args):
+        if len(args) > 0 and args[0] == "clear":
+            self.query_cache.clear()
+            log.info("Cleared the query cache")
+            return
+
+        stats = self.query_cache.stats()
+        print("Query cache %s: %d entries, %.1f/%.1f MiB, %d hits, %d misses" % (
+            self.query_cache.cache_dir, stats["entries"], stats["bytes"]/1024.0/1024,
+            stats["max_bytes"]/1024.0/1024, stats["hits"], stats["misses"]))
+
+    def _native_engine(self):
+        if self.path_engine is None:
+            self.path_engine = PathEngine(csr.load_graph(self.facts_path))
+
+        return self.path_engine
+
+    def _reach_index(self):
+        graph = self._native_engine().graph
+
+        # rebuilt whenever the facts (and thus the graph) change
+        if self.reach_index is None or self.reach_index.graph is not graph:
+            self.reach_index = ReachIndex(graph)
+
+        return self.reach_index
+
+    def reach(self, args):
+        """
+        reach FROM TO [MAX]  - whether FROM can influence TO and how close
+        reach FROM * [MAX]   - every node FROM can influence
+        reach * TO [MAX]     - every node that can influence TO
+        """
+        if len(args) < 2:
+            log.error("Usage: reach FROM|* TO|* [MAX_HOPS]")
+            return
+
+        max_hops = None
+        if len(args) > 2:
+            try:
+                max_hops = int(args[2])
+            except ValueError:
+                log.error("Invalid max hops '%s'", args[2])
+                return
+
+        if args[0] in WILDCARDS and args[1] in WILDCARDS:
+            log.error("reach needs at least one node")
+            return
+
+        nodes = []
+        for arg in args[:2]:
+            if arg in WILDCARDS:
+                nodes += [None]
+                continue
+
+            plnode, _ = self.node_lookup(arg)
+            if not plnode:
+                log.error("Unable to lookup node %s", arg)
+                return
+
+            nodes += [plnode]
+
+        index = self._reach_index()
+        start, end = nodes
+
+        if start is not None and end is not None:
+            distance = index.distance(start, end)
+
+            if distance is None or (max_hops is not None and distance > max_hops):
+                print("%s cannot reach %s" % (args[0], args[1]))
+            else:
+                print("%s reaches %s in %d hop(s)" % (args[0], args[1], distance))
+
+            return
+
+        if start is not None:
+            reached = index.reachable_set(start, max_hops)
+        else:
+            reached = index.reachable_set(end, max_hops, reverse=True)
+
+        for plnode in reached:
+            print(self.node_id_map_inv.get(plnode, plnode))
+
+        print("%d node(s)" % len(reached))
+
+    def count_paths(self, args):
+        """
+        count FROM TO CUTOFF [CAP [SOURCE]] - number of paths of a query,
+        the nodes most paths end at and the nodes most paths go through
+        """
+        if len(args) < 3 or len(args) > 5:
+            log.error("Usage: count FROM|* TO|* CUTOFF [CAP [SOURCE]]")
+            return
+
+        nodes = []
+        for arg in args[:2]:
+            if arg in WILDCARDS:
+                nodes += [arg]
+                continue
+
+            plnode, _ = self.node_lookup(arg)
+            if not plnode:
+                log.error("Unable to lookup node %s", arg)
+                return
+
+            nodes += [plnode]
+
+        cap = args[3] if len(args) > 3 else None
+        source = args[4] if len(args) > 4 else None
+
+        stime = time.time()
+
+        try:
+            result = PathCounter(self._native_engine().graph).count(nodes[0], nodes[1], args[2], cap, source)
+        except (ValueError, OverflowError) as e:
+            log.error("Unable to count the paths: %s", e)
+            return
+
+        log.info("Counted in %.2f seconds", time.time()-stime)
+
+        def count_str(count):
+            # saturated bounds only say there are at least that many walks
+            return ">=%d" % count if count >= MAX_COUNT else "%d" % count
+
+        if result.exact:
+            print("%d path(s)" % result.total)
+        else:
+            print("At most %s path(s) (too many to count exactly, counts below are upper bounds)" %
+                    count_str(result.total))
+
+        through = "Paths through"
+        if cap is not None and not result.exact:
+            through += " (bounds ignore CAP)"
+
+        for title, counts in [("Paths ending at", result.per_end), (through, result.per_node)]:
+            if not counts:
+                continue
+
+            print("%s:" % title)
+            for plnode, count in top_counts(counts, COUNT_TOP):
+                print("  %10s  %s" % (count_str(count), self.node_id_map_inv.get(plnode, plnode)))
+
+    def type_access(self, args):
+        """
+        access SUBJECT read|write|any OBJECT [CLASS] - whether SUBJECT has the access to OBJECT
+        access SUBJECT read|write|any * [CLASS]      - every type SUBJECT has the access to
+        access * read|write|any OBJECT [CLASS]       - every type with the access to OBJECT
+        SUBJECT and OBJECT are SELinux types or attributes
+        """
+        if len(args) < 3 or len(args) > 4:
+            log.error("Usage: access SUBJECT|* read|write|any OBJECT|* [CLASS]")
+            return
+
+        subject, kind, obj = args[:3]
+        teclass = args[3] if len(args) > 3 else None
+
+        if kind not in sematrix.KINDS:
+            log.error("Unknown access kind '%s' (one of %s)", kind, ", ".join(sematrix.KINDS))
+            return
+
+        if subject in WILDCARDS and obj in WILDCARDS:
+            log.error("access needs at least one type")
+            return
+
+        matrices = self.inst.access_matrices()
+
+        try:
+            if subject in WILDCARDS:
+                types = matrices.accessing(obj, kind, teclass)
+            elif obj in WILDCARDS:
+                types = matrices.accessed_by(subject, kind, teclass)
+            else:
+                if matrices.can_access(subject, kind, obj, teclass):
+                    print("%s has %s access to %s" % (subject, kind, obj))
+                else:
+                    print("%s has no %s access to %s" % (subject, kind, obj))
+
+                return
+        except KeyError as e:
+            log.error("Unknown type, attribute or class %s", e)
+            return
+
+        for ty in types:
+            print(ty)
+
+        print("%d type(s)" % len(types))
+
+    def type_flow(self, args):
+        """
+        flow FROM TO [MAX_STEPS] - whether data of SELinux type FROM can flow
+        to TO through write and read accesses, and in how many steps
+        flow FROM * [MAX_STEPS]  - every type data of FROM can flow to
+        """
+        if len(args) < 2 or len(args) > 3:
+            log.error("Usage: flow FROM TO|* [MAX_STEPS]")
+            return
+
+        max_steps = None
+        if len(args) > 2:
+            try:
+                max_steps = int(args[2])
+            except ValueError:
+                log.error("Invalid max steps '%s'", args[2])
+                return
+
+        matrices = self.inst.access_matrices()
+
+        try:
+            reached = matrices.flows(args[0], max_steps)
+            targets = None if args[1] in WILDCARDS else matrices.members_of(args[1])
+        except KeyError as e:
+            log.error("Unknown type or attribute %s", e)
+            return
+
+        if targets is None:
+            for ty, steps in sorted(reached.items(), key=lambda x: (x[1], x[0])):
+                print("%3d  %s" % (steps, ty))
+
+            print("%d type(s)" % len(reached))
+            return
+
+        steps = [reached[ty] for ty in targets if ty in reached]
+
+        if steps:
+            print("%s flows to %s in %d step(s)" % (args[0], args[1], min(steps)))
+        else:
+            print("%s cannot flow to %s" % (args[0], args[1]))
+
     def query_mac_only(self, args):
         self.mac_only = True
         self.query(args)
         self.mac_only = False
 
+    def _split_query_options(self, args):
+        """
+        Separate the key=value options (limit=N, max_length=N) from the
+        positional query arguments. Returns None on a bad option.
+        """
+        options = {}
+        positional = []
+
+        for arg in args:
+            if "=" not in arg:
+                positional += [arg]
+                continue
+
+            key, value = arg.split("=", 1)
+
+            if key not in QUERY_OPTIONS:
+                log.error("Unknown query option '%s'. Valid options are %s", key, ", ".join(QUERY_OPTIONS))
+                return None
+
+            try:
+                options[key] = int(value)
+            except ValueError:
+                log.error("Query option %s needs a number", key)
+                return None
+
+            if options[key] <= 0:
+                log.error("Query option %s must be positive", key)
+                return None
+
+        return options, positional
+
     def query(self, args):
+        split = self._split_query_options(args)
+
+        if split is None:
+            return
+
+        options, args = split
+        limit = options.get("limit")
+
         if len(args) < 3:
             log.error("Query needs 3 arguments")
             return
@@ -734,6 +1203,13 @@ class Prolog(object):
         end = args[1]
         cutoff = args[2]
 
+        if "max_length" in options:
+            try:
+                cutoff = str(min(int(cutoff), options["max_length"]))
+            except ValueError:
+                log.error("Cutoff must be a number")
+                return
+
         if start in ["_", "*"]:
             plstart, start_pretty = start, start
         else:
@@ -755,78 +1231,108 @@ class Prolog(object):
         log.info("Start %f", time.time())
         log.info("Query <%s> -> <%s> (cutoff %s)",
                 start_pretty, end_pretty, cutoff)
-        cmdline = [plstart, plend, cutoff]
+        cmdline = [plserver.node_arg(plstart), plserver.node_arg(plend), cutoff]
 
         if self.mac_only:
-            binary = "inst2"
+            level = 2
         else:
-            binary = "inst3"
+            level = 3
 
         if cap:
             cmdline += [cap]
             log.info("Cap %s", cap)
-            binary = "inst4"
+            level = 4
 
         if source:
             cmdline += [source]
             log.info("External Source %s", source)
-            binary = "inst5"
+            level = 5
 
-        log.info("executing '%s' args : %s", binary, cmdline)
-        binary_path = os.path.join(self.db_dir, binary)
-        proc = Popen([binary_path] + cmdline, stdout=PIPE)
+        if limit:
+            # the binaries take the limit as an optional last argument
+            cmdline += [str(limit)]
+            log.info("Limit %d (shortest paths first)", limit)
+
+        binary = "inst%d" % level
 
         stime = time.time()
+        result = None
+        cache_key = None
+
         try:
-            stdout, stderr = proc.communicate()
-        except KeyboardInterrupt:
-            proc.kill()
-            print("Query interrupted")
-            return
+            cache_key = self.query_cache.make_query_key(self.engine, level,
+                plstart, plend, cutoff, cap, source, limit)
+            result = self.query_cache.get(cache_key)
+        except (IOError, OSError) as e:
+            log.warning("Query cache unavailable: %s", e)
 
-        etime = time.time()
+        cached = result is not None
+        if cached:
+            log.info("Using the cached result")
 
-        self.result = self._parse_result(stdout)
-        # show the shortest (easiest) paths first
-        self.result = sorted(self.result, key=lambda x: len(x))
+        if self.engine == "native" and result is None:
+            log.info("native query%d args : %s", level, cmdline)
 
-        if len(self.result) > 0:
-            log.info("Got %d paths in %.2f seconds (use `print` or `print_trust` to display)",
-                    len(self.result), etime-stime)
-        else:
-            log.info("No results in %.2f seconds", etime-stime)
+            try:
+                result = self._native_engine().query(plstart, plend, cutoff, cap, source,
+                        mac_only=self.mac_only, limit=limit)
+            except (KeyError, ValueError) as e:
+                log.error("Native query failed: %s", e)
+                return
+            except KeyboardInterrupt:
+                print("Query interrupted")
+                return
 
-    def _parse_result(self, result):
-        if len(result) == 0:
-            return []
+        server = None if result is not None else plserver.get_server(self.db_dir)
 
-        orig_result = result.decode()
-        lines = orig_result.split("\n")
+        if server:
+            log.info("querying server with '%s' args : %s", binary, cmdline)
 
-        if len(lines) < 5:
-            print("Result was malformed")
-            return []
+            try:
+                result = server.query(level, plstart, plend, cutoff, cap, source,
+                        limit=limit).read_all()
+            except (plserver.PrologServerError, MalformedResultError, ValueError) as e:
+                log.warning("Query server unavailable, falling back to %s: %s", binary, e)
+            except KeyboardInterrupt:
+                print("Query interrupted")
+                return
 
-        result = lines[-1]
+        if result is None:
+            log.info("executing '%s' args : %s", binary, cmdline)
+            binary_path = os.path.join(self.db_dir, binary)
 
-        # remove all whitespace
-        result = re.sub(r'\s+', ' ', result)
-        result = re.sub(r'([a-zA-Z0-9]),([a-zA-Z0-9])', "\\1','\\2", result)
-        result = re.sub(r'\[([a-zA-Z0-9])', r'[' + r"'\1", result)
-        result = re.sub(r'([a-zA-Z0-9])\]', r'\1' + "'" + ']', result)
+            try:
+                result = read_process([binary_path] + cmdline).read_all()
+            except MalformedResultError as e:
+                log.error("Result was malformed: %s", e)
+                return
+            except KeyboardInterrupt:
+                print("Query interrupted")
+                return
 
-        try:
-            res = eval(result)
-        except SyntaxError:
-            log.error("Result was malformed")
+        etime = time.time()
 
-            with open('bad-result', 'w') as fp:
-                fp.write(orig_result)
-            return []
+        if cache_key is not None and not cached:
+            self.query_cache.put(cache_key, result)
+
+        self.result = result
+        # show the shortest (easiest) paths first
+        self.result = sorted(self.result, key=path_order)
 
-        return res
+        if limit and len(self.result) == limit:
+            log.info("Got the %d shortest paths in %.2f seconds (use `print N` and `print more` to display)",
+                    len(self.result), etime-stime)
+        elif len(self.result) > 0:
+            log.info("Got %d paths in %.2f seconds (use `print` or `print_trust` to display)",
+                    len(self.result), etime-stime)
+        else:
+            log.info("No results in %.2f seconds", etime-stime)
 
-    def _emit_facts(self):
+    def _emit_facts(self, out):
+        """
+        Write the facts of the graph to out (anything with a write(str)
+        method) line by line. Returns False if nothing could be emitted.
+        """
         G = self.graph
         log.info("Emitting prolog facts...")
 
@@ -893,10 +1399,9 @@ class Prolog(object):
 
         sub_db = []
         obj_db = []
+        dac_nodes = {}
         self.node_id_map = {}
 
-        facts = ""
-
         def get_node_type(n):
             return node_objs[n].get_obj_type()
 
@@ -926,6 +1431,8 @@ class Prolog(object):
             line = "sub(%s, %d, %s, 7, 7, 7, %s)." % (
                     node_name, uid, groups, caps)
             sub_db += [node_name]
+            dac_nodes[node_name] = DacNode(SUBJECT, uid, gid, 7, 7, 7,
+                    frozenset([gid] + list(obj.cred.groups)))
             
             if obj.trusted:
                 self.sub_trusted.append(node)
@@ -933,8 +1440,8 @@ class Prolog(object):
             self.node_id_map[node] = node_name
             node_id += 1
 
-            facts += "% " + node + "\n"
-            facts += line + "\n"
+            out.write("% " + node + "\n")
+            out.write(line + "\n")
 
         node_id = 0
 
@@ -987,39 +1494,56 @@ class Prolog(object):
             else:
                 assert 0
 
+            dac_nodes[node_name] = DacNode(OBJECT, uid, gid, uperm, gperm, operm, frozenset())
             self.node_id_map[node] = node_name
             node_id += 1
 
             comment = node + extra_comment
-            facts += "% " + comment + "\n"
-            facts += line + "\n"
-
-        facts += "\nsub_db(all, %s).\n" % str(sub_db).replace('\'', '')
-        obj_db_str = "["
-        for i, o in enumerate(obj_db):
-            last = i+1 == len(obj_db)
-            if last:
-                obj_db_str += "%s]" % str(o)
-                break
+            out.write("% " + comment + "\n")
+            out.write(line + "\n")
 
-            if i > 0 and i % 10 == 0:
-                obj_db_str += "%s,\n" % str(o)
-            else:
-                obj_db_str += "%s, " % str(o)
+        # One clause per node so is_sub/1 and is_obj/1 are answered by
+        # first argument indexing instead of member/2 over a list
+        out.write("\n")
+        for node_name in sub_db:
+            out.write("is_sub(%s).\n" % node_name)
+
+        out.write("\n")
+        for node_name in obj_db:
+            out.write("is_obj(%s).\n" % node_name)
 
-        facts += "obj_db(all, %s).\n\n" % obj_db_str
+        out.write("\n")
 
         # Emit edges
-        for edge in sorted(list(G.edges())):
+        # DAC only depends on the two ends of an edge, so decide it here once
+        # instead of for every pair of every path at query time
+        self.dac_pruned = []
+        edges = sorted(list(G.edges()))
+
+        for edge in edges:
             u = self.node_id_map[edge[0]]
             v = self.node_id_map[edge[1]]
 
-            facts += "edge(%s, %s).\n" % (u, v)
+            out.write("edge(%s, %s).\n" % (u, v))
+
+        out.write("\n")
+
+        # second pass so that the dac_edge/2 clauses stay together
+        for edge in edges:
+            u = self.node_id_map[edge[0]]
+            v = self.node_id_map[edge[1]]
+
+            if dac(dac_nodes[u], dac_nodes[v]):
+                out.write("dac_edge(%s, %s).\n" % (u, v))
+            else:
+                self.dac_pruned += [edge]
+
+        log.info("DAC pruned %d of %d edges", len(self.dac_pruned), len(edges))
 
         # Sort all special files
         self.sort_special_files()
 
         log.info("Prolog facts emitted")
 
-        return facts
+        return True
 
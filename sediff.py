@@ -0,0 +1,400 @@
+#!/usr/bin/env python3
+"""
+Rule-level diff of SEPolicies, e.g. across OTA versions or vendors.
+
+Each policy is reduced to a PolicySummary: its allow rules as
+{(source, target, class): permission mask}, its type_transition rules as
+{(source, target, class, filename): default type}, its types and the
+members of its attributes. The masks of every summary share one
+PermissionSpace, so comparing two policies is a pass over the keys of
+both, linear in the number of rules.
+
+Policies are read through the shared policy graph cache, so only the
+sepolicy binaries that were never processed are parsed with setools.
+--pairwise only counts the differences, straight from the summaries, and
+keeps at most --max-loaded summaries in memory: it holds a block of them
+and streams every later policy past the block.
+
+    sediff.py OLD NEW [--format json|csv] [-o OUT]
+    sediff.py --pairwise POLICY... [--max-loaded N] [--format json|csv] [-o OUT]
+
+A policy is a sepolicy binary or a directory holding one (such as a
+policy results directory).
+"""
+from __future__ import print_function
+
+import argparse
+import csv
+import json
+import logging
+import os
+import sys
+from collections import OrderedDict
+
+from config import *
+from engine.policycache import PolicyGraphCache
+
+logging.basicConfig(stream=sys.stderr, format="%(levelname)s: %(message)s", level=logging.INFO)
+log = logging.getLogger(__name__)
+
+# the binary policy files, in order of preference (as in process.py)
+SEPOLICY_NAMES = ["sepolicy", "precompiled_sepolicy"]
+
+CSV_FIELDS = ["section", "change", "source", "target", "class", "detail"]
+PAIRWISE_FIELDS = ["left", "right", "allow_added", "allow_removed", "allow_changed",
+        "transition_added", "transition_removed", "transition_changed",
+        "types_added", "types_removed", "attributes_added", "attributes_removed",
+        "attributes_changed"]
+
+# summaries kept in memory at once by --pairwise
+DEFAULT_MAX_LOADED = 16
+
+class PermissionSpace(object):
+    """A bit per permission of each class, shared by the summaries compared together"""
+    def __init__(self):
+        self.bits = {}
+        self.names = {}
+
+    def mask(self, teclass, perms):
+        bits = self.bits.setdefault(teclass, {})
+        names = self.names.setdefault(teclass, [])
+        mask = 0
+
+        for perm in perms:
+            if perm not in bits:
+                bits[perm] = 1 << len(names)
+                names.append(perm)
+
+            mask |= bits[perm]
+
+        return mask
+
+    def perms(self, teclass, mask):
+        return [perm for i, perm in enumerate(self.names.get(teclass, [])) if mask & (1 << i)]
+
+class PolicySummary(object):
+    def __init__(self, policy, space):
+        self.space = space
+        index = policy["index"]
+
+        # translate the masks of the policy into the shared space, once per
+        # distinct class and mask
+        masks = {}
+        self.allow = {}
+
+        for u, v, edge in policy["graphs"]["allow"].edges(data=True):
+            local = (edge["teclass"], edge["perm_mask"])
+            mask = masks.get(local)
+
+            if mask is None:
+                mask = masks[local] = space.mask(edge["teclass"], index.perms(*local))
+
+            # several rules of the same source, target and class add up
+            key = (u, v, edge["teclass"])
+            self.allow[key] = self.allow.get(key, 0) | mask
+
+        self.transition = {}
+
+        for u, v, edge in policy["graphs"]["transition"].edges(data=True):
+            self.transition[(u, edge["through"], edge["teclass"], edge["name"])] = v
+
+        self.types = set(index.names[:index.ntypes])
+        self.attributes = dict([[attr, frozenset(members)]
+            for attr, members in policy["attributes"].items()])
+
+def _diff_maps(left, right):
+    """(added keys, removed keys, changed keys) of two dicts, sorted"""
+    added = sorted([k for k in right if k not in left], key=repr)
+    removed = sorted([k for k in left if k not in right], key=repr)
+    changed = sorted([k for k, v in left.items() if k in right and right[k] != v], key=repr)
+
+    return added, removed, changed
+
+def diff_policies(left, right, left_name=None, right_name=None):
+    """The differences from PolicySummary left to right, as a JSON-ready dict"""
+    space = left.space
+    assert right.space is space
+
+    def allow_rule(key, mask):
+        return {"source": key[0], "target": key[1], "class": key[2],
+                "perms": space.perms(key[2], mask)}
+
+    def transition_rule(key, default):
+        return {"source": key[0], "target": key[1], "class": key[2], "name": key[3],
+                "default": default}
+
+    added, removed, changed = _diff_maps(left.allow, right.allow)
+    allow = {
+        "added": [allow_rule(k, right.allow[k]) for k in added],
+        "removed": [allow_rule(k, left.allow[k]) for k in removed],
+        "changed": [dict(allow_rule(k, right.allow[k]),
+            added_perms=space.perms(k[2], right.allow[k] & ~left.allow[k]),
+            removed_perms=space.perms(k[2], left.allow[k] & ~right.allow[k]))
+            for k in changed],
+    }
+
+    added, removed, changed = _diff_maps(left.transition, right.transition)
+    transition = {
+        "added": [transition_rule(k, right.transition[k]) for k in added],
+        "removed": [transition_rule(k, left.transition[k]) for k in removed],
+        "changed": [dict(transition_rule(k, right.transition[k]),
+            old_default=left.transition[k]) for k in changed],
+    }
+
+    added, removed, changed = _diff_maps(left.attributes, right.attributes)
+    attributes = {
+        "added": added,
+        "removed": removed,
+        "changed": [{"attribute": attr,
+            "added_members": sorted(right.attributes[attr] - left.attributes[attr]),
+            "removed_members": sorted(left.attributes[attr] - right.attributes[attr])}
+            for attr in changed],
+    }
+
+    return {
+        "left": left_name,
+        "right": right_name,
+        "allow": allow,
+        "type_transition": transition,
+        "types": {"added": sorted(right.types - left.types),
+            "removed": sorted(left.types - right.types)},
+        "attributes": attributes,
+    }
+
+def _count_maps(left, right):
+    """(added, removed, changed) key counts of two dicts"""
+    common = left.keys() & right.keys()
+    changed = sum([1 for k in common if left[k] != right[k]])
+
+    return len(right) - len(common), len(left) - len(common), changed
+
+def count_differences(left, right):
+    """
+    The number of differences of each kind from PolicySummary left to
+    right, as diff_policies() would find them, without listing them
+    """
+    allow = _count_maps(left.allow, right.allow)
+    transition = _count_maps(left.transition, right.transition)
+    attributes = _count_maps(left.attributes, right.attributes)
+    types_added = len(right.types - left.types)
+
+    return {
+        "allow_added": allow[0],
+        "allow_removed": allow[1],
+        "allow_changed": allow[2],
+        "transition_added": transition[0],
+        "transition_removed": transition[1],
+        "transition_changed": transition[2],
+        "types_added": types_added,
+        "types_removed": len(left.types) - (len(right.types) - types_added),
+        "attributes_added": attributes[0],
+        "attributes_removed": attributes[1],
+        "attributes_changed": attributes[2],
+    }
+
+def reverse_counts(counts):
+    """The count_differences() from right to left of one from left to right"""
+    reverse = dict(counts)
+
+    for name in ["allow", "transition", "types", "attributes"]:
+        reverse[name + "_added"] = counts[name + "_removed"]
+        reverse[name + "_removed"] = counts[name + "_added"]
+
+    return reverse
+
+def diff_rows(diff):
+    """The differences of a diff_policies() result as CSV_FIELDS rows"""
+    rows = []
+
+    for change in ["added", "removed", "changed"]:
+        for rule in diff["allow"][change]:
+            if change == "changed":
+                detail = " ".join(["+" + p for p in rule["added_perms"]] +
+                        ["-" + p for p in rule["removed_perms"]])
+            else:
+                detail = " ".join(rule["perms"])
+
+            rows += [["allow", change, rule["source"], rule["target"], rule["class"], detail]]
+
+    for change in ["added", "removed", "changed"]:
+        for rule in diff["type_transition"][change]:
+            detail = rule["default"]
+
+            if change == "changed":
+                detail = "%s -> %s" % (rule["old_default"], rule["default"])
+            if rule["name"] is not None:
+                detail += " \"%s\"" % rule["name"]
+
+            rows += [["type_transition", change, rule["source"], rule["target"], rule["class"], detail]]
+
+    for change in ["added", "removed"]:
+        for ty in diff["types"][change]:
+            rows += [["type", change, ty, "", "", ""]]
+
+        for attr in diff["attributes"][change]:
+            rows += [["attribute", change, attr, "", "", ""]]
+
+    for attr in diff["attributes"]["changed"]:
+        rows += [["attribute", "changed", attr["attribute"], "", "",
+            " ".join(["+" + t for t in attr["added_members"]] + ["-" + t for t in attr["removed_members"]])]]
+
+    return rows
+
+def find_sepolicy(path):
+    """The sepolicy binary of path, a file or a directory holding one"""
+    if os.path.isfile(path):
+        return path
+
+    for name in SEPOLICY_NAMES:
+        for dirpath, _, filenames in sorted(os.walk(path)):
+            if name in filenames:
+                return os.path.join(dirpath, name)
+
+    return None
+
+def parse_sepolicy(path):
+    # setools is only needed for the policies that are not cached
+    from segraph import SELinuxPolicyGraph
+
+    return SELinuxPolicyGraph(path)
+
+class PolicyLoader(object):
+    """
+    PolicySummary of policy files, all in the same PermissionSpace. The
+    summaries are not kept, callers hold the ones they compare.
+    """
+    def __init__(self):
+        self.cache = PolicyGraphCache(POLICY_GRAPH_CACHE_DIR, POLICY_GRAPH_CACHE_MAX_BYTES)
+        self.space = PermissionSpace()
+
+    def key(self, sepolicy):
+        """The key of a sepolicy file in the policy graph cache, shared by identical policies"""
+        return self.cache.make_key(sepolicy)
+
+    def load(self, sepolicy):
+        policy = self.cache.build_graph(sepolicy, parse_sepolicy)
+        return PolicySummary(policy, self.space)
+
+def pairwise_counts(loader, policies, max_loaded=DEFAULT_MAX_LOADED):
+    """
+    {(key, key): count_differences()} of every pair of the distinct
+    (key, sepolicy) policies, in their order. A block of max_loaded - 1
+    summaries is held at a time and every later policy is loaded once per
+    block to be compared with it.
+    """
+    block_size = max_loaded - 1
+    counts = {}
+
+    for lo in range(0, len(policies), block_size):
+        block = policies[lo:lo+block_size]
+        lefts = [(key, loader.load(sepolicy)) for key, sepolicy in block]
+
+        for i, (left_key, left) in enumerate(lefts):
+            for right_key, right in lefts[i+1:]:
+                counts[(left_key, right_key)] = count_differences(left, right)
+
+        for right_key, sepolicy in policies[lo+block_size:]:
+            right = loader.load(sepolicy)
+
+            for left_key, left in lefts:
+                counts[(left_key, right_key)] = count_differences(left, right)
+
+    return counts
+
+def write_output(args, data, rows, fields):
+    fp = open(args.output, 'w', newline='') if args.output else sys.stdout
+
+    try:
+        if args.format == "json":
+            json.dump(data, fp, indent=2)
+            fp.write("\n")
+        else:
+            writer = csv.writer(fp)
+            writer.writerow(fields)
+            writer.writerows(rows)
+    finally:
+        if args.output:
+            fp.close()
+
+def main():
+    parser = argparse.ArgumentParser(description="Diff the rules of SEPolicies")
+    parser.add_argument("policies", nargs="+", help="sepolicy binaries or directories holding one")
+    parser.add_argument("--pairwise", action="store_true",
+            help="Compare every pair of policies and only output the number of differences")
+    parser.add_argument("--max-loaded", type=int, default=DEFAULT_MAX_LOADED,
+            help="Policies kept in memory at once with --pairwise (default: %(default)s)")
+    parser.add_argument("--format", choices=["json", "csv"], default="json")
+    parser.add_argument("-o", "--output", help="Output file (default: stdout)")
+    parser.add_argument('--debug', action='store_true', help="Enable debug logging.")
+
+    args = parser.parse_args()
+
+    if args.debug:
+        logging.getLogger().setLevel(logging.DEBUG)
+
+    if not args.pairwise and len(args.policies) != 2:
+        log.error("Give two policies to compare, or use --pairwise")
+        return 1
+
+    if args.pairwise and len(args.policies) < 2:
+        log.error("--pairwise needs at least two policies")
+        return 1
+
+    if args.max_loaded < 2:
+        log.error("--max-loaded must be at least 2")
+        return 1
+
+    sepolicies = []
+
+    for path in args.policies:
+        sepolicy = find_sepolicy(path)
+
+        if sepolicy is None:
+            log.error("No sepolicy found in %s", path)
+            return 1
+
+        sepolicies += [(path, sepolicy)]
+
+    loader = PolicyLoader()
+    names = [name for name, _ in sepolicies]
+
+    try:
+        if args.pairwise:
+            keys = [loader.key(sepolicy) for _, sepolicy in sepolicies]
+            # each distinct policy once, many firmware share theirs
+            distinct = list(OrderedDict(zip(keys, [sepolicy for _, sepolicy in sepolicies])).items())
+            pair_counts = pairwise_counts(loader, distinct, args.max_loaded)
+        else:
+            left, right = [loader.load(sepolicy) for _, sepolicy in sepolicies]
+    except OSError as e:
+        log.error("Unable to load SEAndroid policy file: %s", e)
+        return 1
+
+    if not args.pairwise:
+        diff = diff_policies(left, right, names[0], names[1])
+        write_output(args, diff, diff_rows(diff), CSV_FIELDS)
+        return 0
+
+    no_differences = dict([[field, 0] for field in PAIRWISE_FIELDS[2:]])
+    counts = []
+
+    for i in range(len(keys)):
+        for j in range(i+1, len(keys)):
+            if keys[i] == keys[j]:
+                pair = no_differences
+            elif (keys[i], keys[j]) in pair_counts:
+                pair = pair_counts[(keys[i], keys[j])]
+            else:
+                pair = reverse_counts(pair_counts[(keys[j], keys[i])])
+
+            counts += [dict(pair, left=names[i], right=names[j])]
+
+    log.info("Compared %d pairs of %d policies (%d distinct pairs)",
+            len(counts), len(keys), len(pair_counts))
+
+    write_output(args, counts, [[c[f] for f in PAIRWISE_FIELDS] for c in counts], PAIRWISE_FIELDS)
+
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
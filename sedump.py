@@ -21,11 +21,37 @@ import setools
 from setools.policyrep import terule
 from setools.policyrep import exception
 
+# characters written to the file at a time by SELinuxPolicyDump.dump()
+DUMP_CHUNK_SIZE = 1024*1024
+
 class SELinuxPolicyDump(setools.SELinuxPolicy):
     """Overloaded SELinuxPolicy"""
 
     def __str__(self):
         """Output statements in an human readable and compiler ready format."""
+        return "".join(self.statements())
+
+    def dump(self, fp, chunk_size=DUMP_CHUNK_SIZE):
+        """Write the statements to the file object fp, about chunk_size characters at a time"""
+        chunk = []
+        size = 0
+
+        for stmt in self.statements():
+            chunk.append(stmt)
+            size += len(stmt)
+
+            if size >= chunk_size:
+                fp.write("".join(chunk))
+                chunk = []
+                size = 0
+
+        fp.write("".join(chunk))
+
+    def statements(self):
+        """
+        Generate the statements of the policy, in an human readable and
+        compiler ready format, a few lines at a time
+        """
 
         sort = True
 
@@ -38,77 +64,75 @@ class SELinuxPolicyDump(setools.SELinuxPolicy):
             comment = ''.join("# {0}\n".format(x) for x in value.splitlines())
             return "#\n{0}#\n\n".format(comment)
 
-        stmt = ""
-
         # security object classes
-        stmt += comment("Define the security object classes")
+        yield comment("Define the security object classes")
         for class_ in cond_sort(self.classes()):
-            stmt += "class {0}\n".format(class_)
-        stmt += "\n"
+            yield "class {0}\n".format(class_)
+        yield "\n"
 
         # initial security identifiers
-        stmt += comment("Define the initial security identifiers")
+        yield comment("Define the initial security identifiers")
         for sid_ in cond_sort(self.initialsids()):
-            stmt += "sid {0}\n".format(sid_)
-        stmt += "\n"
+            yield "sid {0}\n".format(sid_)
+        yield "\n"
 
         # access vectors
-        stmt += comment("Define common prefixes for access vectors")
+        yield comment("Define common prefixes for access vectors")
         for common_ in cond_sort(self.commons()):
-            stmt += "{0}\n\n".format(common_.statement())
+            yield "{0}\n\n".format(common_.statement())
 
-        stmt += comment("Define the access vectors")
+        yield comment("Define the access vectors")
         for class_ in cond_sort(self.classes()):
-            stmt += "{0}\n{1}".format(class_.statement(), "\n" if len(class_.perms) > 0 else "")
+            yield "{0}\n{1}".format(class_.statement(), "\n" if len(class_.perms) > 0 else "")
 
         # define MLS sensitivities, categories and levels
-        stmt += comment("Define MLS sensitivities, categories and levels")
+        yield comment("Define MLS sensitivities, categories and levels")
         for sensitivity_ in cond_sort(self.sensitivities()):
-            stmt += "{0}\n".format(sensitivity_.statement())
-        stmt += "\n"
+            yield "{0}\n".format(sensitivity_.statement())
+        yield "\n"
 
         sensitivities_ = ["{0}".format(x) for x in sorted(self.sensitivities())]
-        stmt += "dominance {{ {0} }}\n\n".format(', '.join(sensitivities_))
+        yield "dominance {{ {0} }}\n\n".format(', '.join(sensitivities_))
 
         for category_ in cond_sort(self.categories()):
-            stmt += "category {0};\n".format(category_)
-        stmt += "\n"
+            yield "category {0};\n".format(category_)
+        yield "\n"
         for level_ in cond_sort(self.levels()):
-            stmt += "{0}\n".format(level_.statement())
-        stmt += "\n"
+            yield "{0}\n".format(level_.statement())
+        yield "\n"
 
         # define MLS policy constraints
-        stmt += comment("Define MLS policy constraints")
+        yield comment("Define MLS policy constraints")
         for mlscontrain_ in cond_sort(self.constraints()):
-            stmt += "{0}\n".format(mlscontrain_.statement())
-        stmt += "\n"
+            yield "{0}\n".format(mlscontrain_.statement())
+        yield "\n"
 
         # define policy cap
-        stmt += comment("Define policy capabilities")
+        yield comment("Define policy capabilities")
         for policycap_ in cond_sort(self.polcaps()):
-            stmt += "{0}\n".format(policycap_.statement())
-        stmt += "\n"
+            yield "{0}\n".format(policycap_.statement())
+        yield "\n"
 
         # define type attributes
-        stmt += comment("Define attribute identifiers")
+        yield comment("Define attribute identifiers")
         for attribute_ in cond_sort(self.typeattributes()):
-            stmt += "{0}\n".format(attribute_.statement())
-        stmt += "\n"
+            yield "{0}\n".format(attribute_.statement())
+        yield "\n"
 
         # define types, aliases and attributes
-        stmt += comment("Define type identifiers")
+        yield comment("Define type identifiers")
         for type_ in cond_sort(self.types()):
-            stmt += "{0}\n".format(type_.statement())
-        stmt += "\n"
+            yield "{0}\n".format(type_.statement())
+        yield "\n"
 
         # define booleans
-        stmt += comment("Define booleans")
+        yield comment("Define booleans")
         for bool_ in cond_sort(self.bools()):
-            stmt += "{0}\n".format(bool_.statement())
-        stmt += "\n"
+            yield "{0}\n".format(bool_.statement())
+        yield "\n"
 
         # define type enforcement rules
-        stmt += comment("Define type enforcement rules")
+        yield comment("Define type enforcement rules")
         for terule_ in cond_sort(self.terules()):
             # NOTE: the following is a rip of setools/policyrep/terule
             # stmt += "{0}\n".format(terule_.statement())
@@ -148,53 +172,51 @@ class SELinuxPolicyDump(setools.SELinuxPolicy):
                 raise RuntimeError("Unhandled TE rule")
 
             try:
-                stmt += "if ({0}) {{\n" \
+                yield "if ({0}) {{\n" \
                         "    {1}\n" \
                         "}}\n".format(terule_.conditional, rule_)
             except exception.RuleNotConditional:
-                stmt += "{0}\n".format(rule_)
-        stmt += "\n"
+                yield "{0}\n".format(rule_)
+        yield "\n"
 
         # define roles
-        stmt += comment("Define roles identifiers")
+        yield comment("Define roles identifiers")
         for role_ in cond_sort(self.roles()):
-            stmt += "role {0};\n".format(role_)
+            yield "role {0};\n".format(role_)
             # NOTE: the following loop builds statements that are semantically similar to
             # stmt += "{0}\n".format(role_.statement()). It has been splitted in individual
             # statements as checkpolicy's parser has a low YYLMAX limit
             for type_ in role_.types():
-                stmt += "role {0} types {1};\n".format(role_, type_)
-            stmt += "\n"
-        stmt += "\n"
+                yield "role {0} types {1};\n".format(role_, type_)
+            yield "\n"
+        yield "\n"
 
         # define users
-        stmt += comment("Define users")
+        yield comment("Define users")
         for user_ in cond_sort(self.users()):
-            stmt += "{0}\n".format(user_.statement())
-        stmt += "\n"
+            yield "{0}\n".format(user_.statement())
+        yield "\n"
 
         # define signature id
-        stmt += comment("Define the initial sid contexts")
+        yield comment("Define the initial sid contexts")
         for sid_ in cond_sort(self.initialsids()):
-            stmt += "{0}\n".format(sid_.statement())
-        stmt += "\n"
+            yield "{0}\n".format(sid_.statement())
+        yield "\n"
 
         # define fs_use contexts
-        stmt += comment("Label inodes via fs_use_xxx")
+        yield comment("Label inodes via fs_use_xxx")
         for fs_use_ in cond_sort(self.fs_uses()):
-            stmt += "{0}\n".format(fs_use_.statement())
-        stmt += "\n"
+            yield "{0}\n".format(fs_use_.statement())
+        yield "\n"
 
         # define genfs contexts
-        stmt += comment("Label inodes via genfscon")
+        yield comment("Label inodes via genfscon")
         for genfscon_ in cond_sort(self.genfscons()):
-            stmt += "{0}\n".format(genfscon_.statement())
-        stmt += "\n"
+            yield "{0}\n".format(genfscon_.statement())
+        yield "\n"
 
         # define portcon contexts
-        stmt += comment("Label ports via portcon")
+        yield comment("Label ports via portcon")
         for portcon_ in cond_sort(self.portcons()):
-            stmt += "{0}\n".format(portcon_.statement())
-        stmt += "\n"
-
-        return stmt
+            yield "{0}\n".format(portcon_.statement())
+        yield "\n"
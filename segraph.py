@@ -19,6 +19,8 @@
 import setools
 import networkx as nx
 
+from android.sepolicy import index_policy
+
 from setools.policyrep import terule
 from setools.policyrep import exception
 
@@ -154,6 +156,7 @@ class SELinuxPolicyGraph(setools.SELinuxPolicy):
         policy = {
             "classes" : classes,
             "attributes" : attributes,
+            "commons" : commons,
             "types": types,
             "aliases": aliases,
             "genfs": genfs,
@@ -164,4 +167,4 @@ class SELinuxPolicyGraph(setools.SELinuxPolicy):
             },
         }
 
-        return policy
+        return index_policy(policy)
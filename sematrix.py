@@ -0,0 +1,270 @@
+"""
+Type-level access matrices of a SEPolicy: a sparse boolean matrix (subject
+type x object type) of the allow rules, with the attributes of both sides
+expanded to their member types, for "who can write type X" and "what can D
+read" questions without walking the allow graph.
+
+The matrices are numpy CSR arrays, built with sparse boolean products: for
+the rule matrix E over the type and attribute ids of the PolicyIndex and
+the membership matrix M (id -> member types, a type being its own only
+member), the access matrix is M^T E M. They are built per class and kind
+of access (read/write/any, see android.sepolicy.READ_PERMS) on first use.
+
+Multi-step questions go through the flow matrix, where a type flows to the
+types it writes and to the domains that read it, and are answered with
+vector-matrix products, one per step.
+"""
+import logging
+import numpy as np
+
+log = logging.getLogger(__name__)
+
+KINDS = ["read", "write", "any"]
+
+# largest dense block (in cells) and number of products per block of a product
+BLOCK_CELLS = 16*1024*1024
+BLOCK_PRODUCTS = 8*1024*1024
+
+class BoolMatrix(object):
+    """Sparse boolean matrix in compressed sparse rows (sorted, no duplicates)"""
+    def __init__(self, shape, indptr, indices):
+        self.shape = shape
+        self.indptr = indptr
+        self.indices = indices
+
+    @staticmethod
+    def from_pairs(shape, rows, cols):
+        rows = np.asarray(rows, dtype=np.int64)
+        cols = np.asarray(cols, dtype=np.int64)
+
+        # sorted unique (row, col) pairs
+        keys = np.unique(rows * shape[1] + cols)
+        rows = keys // shape[1]
+
+        indptr = np.zeros(shape[0]+1, dtype=np.int64)
+        np.cumsum(np.bincount(rows, minlength=shape[0]), out=indptr[1:])
+
+        return BoolMatrix(shape, indptr, (keys % shape[1]).astype(np.int32))
+
+    def nnz(self):
+        return len(self.indices)
+
+    def row_ids(self):
+        """The row of every stored entry"""
+        return np.repeat(np.arange(self.shape[0]), np.diff(self.indptr))
+
+    def row(self, i):
+        return self.indices[self.indptr[i]:self.indptr[i+1]]
+
+    def transpose(self):
+        return BoolMatrix.from_pairs((self.shape[1], self.shape[0]), self.indices, self.row_ids())
+
+    def union(self, other):
+        assert self.shape == other.shape
+
+        return BoolMatrix.from_pairs(self.shape,
+                np.concatenate([self.row_ids(), other.row_ids()]),
+                np.concatenate([self.indices, other.indices]))
+
+    def dot(self, other):
+        """Boolean product self x other"""
+        assert self.shape[1] == other.shape[0]
+
+        ncols = other.shape[1]
+        k = self.indices
+        counts = other.indptr[k+1] - other.indptr[k]
+        # products before each row of self
+        work = np.zeros(len(k)+1, dtype=np.int64)
+        np.cumsum(counts, out=work[1:])
+        row_work = work[self.indptr]
+
+        indptr = np.zeros(self.shape[0]+1, dtype=np.int64)
+        indices = []
+        start = 0
+
+        # rows are expanded in blocks into a dense array, which drops the
+        # duplicates without sorting them
+        while start < self.shape[0]:
+            end = min(self.shape[0], start + max(1, BLOCK_CELLS // max(ncols, 1)))
+            end = max(start+1, min(end, int(np.searchsorted(row_work,
+                row_work[start] + BLOCK_PRODUCTS, side='right')) - 1))
+
+            lo, hi = self.indptr[start], self.indptr[end]
+            block_counts = counts[lo:hi]
+            total = int(block_counts.sum())
+
+            rows = np.repeat(self.row_ids()[lo:hi] - start, block_counts)
+            offsets = np.arange(total) - np.repeat(np.cumsum(block_counts) - block_counts, block_counts)
+            cols = other.indices[np.repeat(other.indptr[k[lo:hi]], block_counts) + offsets]
+
+            dense = np.zeros((end - start, ncols), dtype=bool)
+            dense[rows, cols] = True
+            dense_rows, dense_cols = np.nonzero(dense)
+
+            indptr[start+1:end+1] = indptr[start] + np.cumsum(dense.sum(axis=1))
+            indices += [dense_cols.astype(np.int32)]
+            start = end
+
+        return BoolMatrix((self.shape[0], ncols), indptr,
+                np.concatenate(indices) if indices else np.zeros(0, dtype=np.int32))
+
+    def vecmul(self, vector):
+        """The boolean row vector vector x self"""
+        out = np.zeros(self.shape[1], dtype=bool)
+        rows = np.flatnonzero(vector)
+
+        if len(rows):
+            starts, ends = self.indptr[rows], self.indptr[rows+1]
+            counts = ends - starts
+            offsets = np.arange(int(counts.sum())) - np.repeat(np.cumsum(counts) - counts, counts)
+            out[self.indices[np.repeat(starts, counts) + offsets]] = True
+
+        return out
+
+class PolicyMatrices(object):
+    def __init__(self, policy):
+        self.index = index = policy["index"]
+        self.ntypes = index.ntypes
+        n = len(index.names)
+
+        # id -> member types
+        rows = list(range(self.ntypes))
+        cols = list(range(self.ntypes))
+
+        for attr, members in policy["attributes"].items():
+            for ty in members:
+                rows += [index.ids[attr]]
+                cols += [index.ids[ty]]
+
+        self.members = BoolMatrix.from_pairs((n, self.ntypes), rows, cols)
+        self.members_t = self.members.transpose()
+
+        # one row per allow edge
+        G = policy["graphs"]["allow"]
+        classes = {}
+        src, dst, cls, read, write = [], [], [], [], []
+
+        for u, v, edge in G.edges(data=True):
+            r, w, _ = index.dataflow(edge)
+            src += [index.ids[u]]
+            dst += [index.ids[v]]
+            cls += [classes.setdefault(edge["teclass"], len(classes))]
+            read += [r]
+            write += [w]
+
+        self.classes = classes
+        self.edge_src = np.asarray(src, dtype=np.int64)
+        self.edge_dst = np.asarray(dst, dtype=np.int64)
+        self.edge_class = np.asarray(cls, dtype=np.int32)
+        self.edge_kind = {
+            "read": np.asarray(read, dtype=bool),
+            "write": np.asarray(write, dtype=bool),
+            "any": np.ones(len(src), dtype=bool),
+        }
+
+        self._matrices = {}
+        self._flow = None
+
+    def _type_ids(self, name):
+        """The member types of a type or attribute, as ids"""
+        return self.members.row(self.index.ids[name])
+
+    def _names(self, ids):
+        names = self.index.names
+        return sorted([names[i] for i in ids])
+
+    def matrix(self, kind="any", teclass=None):
+        """The (subject type x object type) BoolMatrix of kind (read, write or any) accesses"""
+        if kind not in KINDS:
+            raise ValueError("Unknown access kind %s" % kind)
+
+        key = (kind, teclass)
+
+        if key not in self._matrices:
+            select = self.edge_kind[kind]
+
+            if teclass is not None:
+                if teclass not in self.classes:
+                    raise KeyError(teclass)
+
+                select = select & (self.edge_class == self.classes[teclass])
+
+            n = len(self.index.names)
+            rules = BoolMatrix.from_pairs((n, n), self.edge_src[select], self.edge_dst[select])
+            self._matrices[key] = self.members_t.dot(rules).dot(self.members)
+
+            log.debug("Access matrix %s/%s: %d entries", kind, teclass, self._matrices[key].nnz())
+
+        return self._matrices[key]
+
+    def can_access(self, subject, kind, obj, teclass=None):
+        """True if some type of subject has a kind access to some type of obj"""
+        M = self.matrix(kind, teclass)
+        targets = self._type_ids(obj)
+
+        for i in self._type_ids(subject):
+            if np.intersect1d(M.row(i), targets, assume_unique=True).size:
+                return True
+
+        return False
+
+    def accessed_by(self, subject, kind="any", teclass=None):
+        """Sorted types subject (a type or attribute) has a kind access to"""
+        M = self.matrix(kind, teclass)
+        vector = np.zeros(self.ntypes, dtype=bool)
+        vector[self._type_ids(subject)] = True
+
+        return self._names(np.flatnonzero(M.vecmul(vector)))
+
+    def accessing(self, obj, kind="any", teclass=None):
+        """Sorted types with a kind access to obj (a type or attribute)"""
+        key = ("transposed", kind, teclass)
+
+        if key not in self._matrices:
+            self._matrices[key] = self.matrix(kind, teclass).transpose()
+
+        vector = np.zeros(self.ntypes, dtype=bool)
+        vector[self._type_ids(obj)] = True
+
+        return self._names(np.flatnonzero(self._matrices[key].vecmul(vector)))
+
+    def flow_matrix(self):
+        """Type x type matrix of one dataflow step: writer -> written, read -> reader"""
+        if self._flow is None:
+            self._flow = self.matrix("write").union(self.matrix("read").transpose())
+
+        return self._flow
+
+    def flows(self, source, max_steps=None, matrix=None):
+        """
+        {type: steps} of every type data of source (a type or attribute)
+        reaches within max_steps dataflow steps, the types of source itself
+        at 0 steps. matrix replaces the flow matrix, e.g. matrix("any") for
+        the allow rules regardless of their direction.
+        """
+        F = self.flow_matrix() if matrix is None else matrix
+        visited = np.zeros(self.ntypes, dtype=bool)
+        visited[self._type_ids(source)] = True
+        frontier = visited.copy()
+        steps = np.where(visited, 0, -1)
+        step = 0
+
+        while frontier.any() and (max_steps is None or step < max_steps):
+            step += 1
+            frontier = F.vecmul(frontier) & ~visited
+            visited |= frontier
+            steps[frontier] = step
+
+        names = self.index.names
+        return dict([[names[i], int(steps[i])] for i in np.flatnonzero(visited)])
+
+    def members_of(self, name):
+        """Sorted member types of an attribute, or the type itself"""
+        return self._names(self._type_ids(name))
+
+    def attributes_of(self, ty):
+        """The attributes of a type, in policy order"""
+        ntypes = self.ntypes
+        names = self.index.names
+
+        return [names[i] for i in self.members_t.row(self.index.ids[ty]) if i >= ntypes]
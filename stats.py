@@ -11,6 +11,7 @@ import json
 import networkx as nx
 from prolog import Prolog
 from config import *
+from engine.policycache import PolicyGraphCache
 from security_policy import ASPCodec, AndroidSecurityPolicy
 from android.file_contexts import read_file_contexts
 from android.initrc import AndroidInit
@@ -169,14 +170,12 @@ def process(args, asp, aspc):
             log.error("STAT: No compiled sepolicy found. Cannot continue")
             return
 
-        policy_graph = SELinuxPolicyGraph(sepolicy)
+        policy_cache = PolicyGraphCache(POLICY_GRAPH_CACHE_DIR, POLICY_GRAPH_CACHE_MAX_BYTES)
+        graph = policy_cache.build_graph(sepolicy, SELinuxPolicyGraph)
     except OSError:
         log.error("STAT: Unable to load SEAndroid policy file. Use --debug for more details")
         return
 
-    log.info("Building SEPolicy graph")
-    graph = policy_graph.build_graph()
-
     log.info("STAT: SEPolicy %d nodes and %d allow edges",
              len(graph["graphs"]["allow"].nodes()), len(graph["graphs"]["allow"].edges()))
 
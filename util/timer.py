@@ -0,0 +1,27 @@
+import time
+from contextlib import contextmanager
+
+class StepTimer(object):
+    """Collects the wall clock time of named steps for a timing report"""
+    def __init__(self):
+        self.steps = []
+
+    @contextmanager
+    def step(self, name):
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.add(name, time.time()-start)
+
+    def add(self, name, seconds):
+        self.steps += [(name, seconds)]
+
+    def total(self):
+        return sum([seconds for _, seconds in self.steps])
+
+    def report(self, log, title):
+        log.info("%s:", title)
+
+        for name, seconds in self.steps:
+            log.info("  %-32s %8.2fs", name, seconds)